@@ -0,0 +1,316 @@
+import asyncio
+import io
+import sys
+import time
+from threading import Thread
+from typing import Dict, Optional, Tuple
+
+from backend import Backend
+from containers import *
+from filehandler import FileHandler
+from dispatch import STREAMING, SERIAL, Dispatcher, SerialExecutor
+from metrics import Metrics
+from protocol import CHUNK_SIZE, HEADER, FileChunks, Head, PayloadReader, Source, is_replayable, make_head, pack_head, \
+    read_head
+
+
+async def read_head_async(reader: asyncio.StreamReader) -> Optional[Head]:
+    try:
+        fixed = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError(f"connection closed, header is not whole")
+    user, command, name_len, length = HEADER.unpack(fixed)
+    name = await reader.readexactly(name_len)
+    return make_head(user, command, name, length)
+
+
+class AsyncConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, ip: str):
+        self.reader = reader
+        self.writer = writer
+        self.ip = ip
+        self.agent: Optional[Agent] = None
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        self.receiving = False
+        self.closed = False
+
+    async def send(self, user: bytes, command: bytes, name: bytes, source: Source, request: int = 0) -> None:
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            if self.closed:
+                raise ConnectionError(f"connection to {self.ip} is closed")
+            self.writer.write(pack_head(user, command, name, source.length, request))
+            sent = 0
+            if isinstance(source.chunks, FileChunks) and source.chunks.length == source.length:
+                # the loop hands the file to the kernel, falling back to reads on an executor
+                await self.writer.drain()
+                with source.chunks.path.open("rb") as f:
+                    sent = await loop.sendfile(self.writer.transport, f, source.chunks.offset, source.length)
+            elif isinstance(source.chunks, (tuple, list)):
+                for chunk in source.chunks:
+                    sent += len(chunk)
+                    self.writer.write(chunk)
+            else:
+                # chunks may come from the disk, never read them on the loop
+                chunks = iter(source.chunks)
+                while True:
+                    chunk = await loop.run_in_executor(None, next, chunks, None)
+                    if chunk is None:
+                        break
+                    sent += len(chunk)
+                    self.writer.write(chunk)
+                    await self.writer.drain()
+            if sent != source.length:
+                self.close()
+                raise IOError(f"payload is {sent} bytes, announced {source.length}")
+            await self.writer.drain()
+            self.last_used = time.monotonic()
+        if Metrics.enabled:
+            peer = self.agent.name.decode("ascii", "replace") if self.agent is not None else self.ip
+            Metrics.transferred("out", peer, HEADER.size + len(name) + source.length)
+
+    @property
+    def busy(self) -> bool:
+        return self.receiving or self.lock.locked()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+
+class Discovery(asyncio.DatagramProtocol):
+    def __init__(self, engine: "AsyncEngine"):
+        self.engine = engine
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        recv = io.BytesIO(data).read
+        try:
+            head = read_head(recv)
+        except ConnectionError:
+            print(f"datagram from {addr[0]} is not whole", file=sys.stderr)
+            return
+        if head is not None:
+            payload = PayloadReader(recv, head.length)
+            future = self.engine.executor.submit(None, self.engine.f_recv, head, payload, addr[0])
+            future.add_done_callback(Dispatcher._report)
+
+
+class AsyncEngine:
+    """
+    One event loop serves every connection and the discovery datagrams, TCP and UDP on one port.
+    Handlers still run on the bounded worker pool, with the same per-user ordering as Dispatcher.
+    """
+    def __init__(self, ip: str, port: int, f_recv, workers: int = 8, max_connections: int = 4096,
+                 backlog: int = 128, idle_timeout: float = 60, connect_timeout: float = 2, bind: bool = False):
+        """
+        bind: discovery listens on ip only and connections go out from it, so several nodes can share a machine
+        """
+        self.ip = ip
+        self.bind = bind
+        self.port = port
+        self.f_recv = f_recv
+        self.max_connections = max_connections
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.executor = SerialExecutor(workers)
+        self._conns: Dict[Agent, AsyncConnection] = dict()
+        Metrics.gauge("handlers.queued", self.executor.depth)
+        Metrics.gauge("connections", lambda: len(self._conns))
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name="asyncio-engine", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        except OSError as e:
+            print('Failed to create sockets', file=sys.stderr)
+            print(e, file=sys.stderr)
+            print(f"{self.ip}:{self.port}", file=sys.stderr)
+            sys.exit(1)
+
+    async def _start(self) -> None:
+        self.slots = asyncio.Semaphore(self.max_connections)
+        self.server = await asyncio.start_server(self._accept, self.ip, self.port, backlog=self.backlog)
+        self.udp, _ = await self.loop.create_datagram_endpoint(
+            lambda: Discovery(self), local_addr=(self.ip if self.bind else '0.0.0.0', self.port), allow_broadcast=True)
+        self.loop.create_task(self._reap_forever())
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        conn = AsyncConnection(reader, writer, writer.get_extra_info("peername")[0])
+        async with self.slots:
+            await self._serve(conn)
+
+    def _recv_blocking(self, reader: asyncio.StreamReader):
+        # for handlers on worker threads, they stream the payload straight off the loop
+        def recv(n: int) -> bytes:
+            return asyncio.run_coroutine_threadsafe(reader.read(n), self.loop).result()
+        return recv
+
+    async def _serve(self, conn: AsyncConnection) -> None:
+        try:
+            while True:
+                head = await read_head_async(conn.reader)
+                if head is None:
+                    break
+                conn.receiving = True
+                if Metrics.enabled:
+                    Metrics.transferred("in", head.user.decode("ascii", "replace"),
+                                        HEADER.size + len(head.name) + head.length)
+                if conn.agent is None:
+                    conn.agent = Agent(name=head.user, ip=conn.ip)
+                    current = self._conns.get(conn.agent)
+                    if current is None or current.closed:
+                        self._conns[conn.agent] = conn
+                key = head.user if head.command in SERIAL else None
+                if head.command in STREAMING:
+                    payload = PayloadReader(self._recv_blocking(conn.reader), head.length)
+                    await asyncio.wrap_future(self.executor.submit(key, self.f_recv, head, payload, conn.ip))
+                    while payload.remaining > 0:
+                        part = await conn.reader.read(min(CHUNK_SIZE, payload.remaining))
+                        if not part:
+                            raise ConnectionError(f"connection closed, {payload.remaining} payload bytes missing")
+                        payload.remaining -= len(part)
+                else:
+                    data = await conn.reader.readexactly(head.length)
+                    payload = PayloadReader(io.BytesIO(data).read, len(data))
+                    self.executor.submit(key, self.f_recv, head, payload, conn.ip).add_done_callback(Dispatcher._report)
+                conn.receiving = False
+                conn.last_used = time.monotonic()
+        except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+            if not conn.closed:
+                print(f"Connection with {conn.ip} broken: {e}", file=sys.stderr)
+        finally:
+            self._discard(conn)
+
+    def _discard(self, conn: AsyncConnection) -> None:
+        conn.close()
+        if conn.agent is not None and self._conns.get(conn.agent) is conn:
+            del self._conns[conn.agent]
+
+    async def _get(self, agent: Agent) -> AsyncConnection:
+        conn = self._conns.get(agent)
+        if conn is not None and not conn.closed:
+            return conn
+        local = (self.ip, 0) if self.bind else None
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(agent.ip, self.port, local_addr=local),
+                                                self.connect_timeout)
+        conn = self._conns.get(agent)
+        if conn is not None and not conn.closed:
+            writer.close()
+            return conn
+        conn = AsyncConnection(reader, writer, agent.ip)
+        conn.agent = agent
+        self._conns[agent] = conn
+        self.loop.create_task(self._serve(conn))
+        return conn
+
+    async def asend(self, agent: Agent, user: bytes, command: bytes, name: bytes, source: Source,
+                    request: int = 0) -> bool:
+        attempts = 2 if is_replayable(source) else 1
+        for attempt in range(attempts):
+            try:
+                conn = await self._get(agent)
+            except (OSError, asyncio.TimeoutError) as e:
+                print(e, file=sys.stderr)
+                return False
+            try:
+                await conn.send(user, command, name, source, request)
+                return True
+            except (ConnectionError, OSError) as e:
+                self._discard(conn)
+                if attempt == attempts - 1:
+                    print(e, file=sys.stderr)
+        return False
+
+    def send(self, agent: Agent, user: bytes, command: bytes, name: bytes, source: Source, request: int = 0) -> bool:
+        # blocking, for handlers and the CLI, never call it on the loop
+        return asyncio.run_coroutine_threadsafe(self.asend(agent, user, command, name, source, request),
+                                                self.loop).result()
+
+    def broadcast(self, packet: bytes) -> bool:
+        self.loop.call_soon_threadsafe(self.udp.sendto, packet, ("<broadcast>", self.port))
+        return True
+
+    async def _reap_forever(self) -> None:
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 4, 0.1))
+            now = time.monotonic()
+            for conn in list(self._conns.values()):
+                if not conn.busy and now - conn.last_used > self.idle_timeout:
+                    self._discard(conn)
+
+
+class AsyncBackend(Backend):
+    """
+    Backend on the asyncio engine, same _inc_* semantics.
+    The out_* methods still block for the CLI, out_*_async are their coroutine versions to be awaited on engine.loop.
+    """
+    def _make_engine(self, port: Optional[int], workers: int, max_connections: int, backlog: int):
+        return AsyncEngine(self.ip, port or self.PORT_TCP, self._f_tcp_recv, workers,
+                           max(max_connections, 1), max(backlog, 1), bind=self.bind)
+
+    async def _asend(self, agent: Agent, command: bytes, name: bytes = b"", source: Source = Source(0, ()),
+                     request: int = 0) -> bool:
+        return await self.engine.asend(agent, self.username, command, name, source, request)
+
+    async def out_status_async(self, agent: Agent) -> bool:
+        self.overviews_since_request = list()
+        request = self._overview_request(agent)
+        if not await self._asend(agent, b"S", self._overview_ask(agent), request=request.id):
+            RequestHandler.cancel(request)
+            return False
+        return True
+
+    async def out_status_broadcast_async(self) -> bool:
+        self.overviews_since_request = list()
+        for agent in AgentHandler.agents():
+            self._overview_request(agent)
+        self.engine.udp.sendto(pack_head(self.username, b"S", VERSION_ASK, 0), ("<broadcast>", self.engine.port))
+        return True
+
+    async def out_upload_async(self, agent: Agent, filepath: Path, filename: Optional[bytes] = None) -> bool:
+        source = FileHandler.client_file_read(filepath)
+        if source is None:
+            return False
+        if filename is None:
+            filename = filepath.name.encode("ascii", "replace")
+        loop = asyncio.get_running_loop()
+        algo = self._hash_for(agent)
+        # hashing and compressing are disk and CPU work, keep them off the loop
+        digest = await loop.run_in_executor(None, FileHandler.hash_cache().digest, filepath, algo) \
+            if algo is not None else None
+        name, source = await loop.run_in_executor(None, self._encoded, filename, source, self._codec_for(agent))
+        return await self._asend(agent, b"U", self._hashed(name, algo, digest), source)
+
+    async def out_overview_async(self, agent: Agent, overview: Overview) -> bool:
+        return await self._asend(agent, b"O", source=Source.of_bytes(overview.to_bjson()))
+
+    async def out_failure_async(self, agent: Agent, fail: Fail) -> bool:
+        return await self._asend(agent, b"F", source=Source.of_bytes(fail.to_bin()))
+
+    async def out_download_async(self, agent: Agent, filename: str, path: Path) -> Optional[Request]:
+        # await asyncio.wrap_future(request.future) for the file
+        request = RequestHandler.new(agent, b"P", filename, path)
+        if not await self._asend(agent, b"D", self._accepting(filename.encode("ascii", "replace"), agent), request=request.id):
+            RequestHandler.cancel(request)
+            return None
+        return request
+
+    async def out_payload_async(self, agent: Agent, filename: bytes, source: Source, codec: Optional[str] = None,
+                                request: int = 0,
+                                checked: Tuple[Optional[str], Optional[bytes]] = (None, None)) -> bool:
+        name, source = await asyncio.get_running_loop().run_in_executor(None, self._encoded, filename, source, codec)
+        return await self._asend(agent, b"P", self._hashed(name, *checked), source, request=request)
+
+    async def out_rename_async(self, agent: Agent, old_filename: str, new_filename: str) -> bool:
+        return await self._asend(agent, b"R", old_filename.encode("ascii", "replace"),
+                                 Source.of_bytes(new_filename.encode("ascii", "replace")))
+
+    async def out_delete_async(self, agent: Agent, filename: str) -> bool:
+        return await self._asend(agent, b"X", filename.encode("ascii", "replace"))
@@ -0,0 +1,73 @@
+import os
+import queue
+import socket
+import tempfile
+import unittest
+from pathlib import Path
+
+from aio import AsyncEngine
+from containers import Agent
+from protocol import CHUNK_SIZE, Source, file_source
+
+CLIENT, NODE = "127.0.0.2", "127.0.0.3"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind((NODE, 0))
+        return s.getsockname()[1]
+
+
+class RoundTrip(unittest.TestCase):
+    """
+    A client and a storage node on engines of their own over loopback, like two processes would be.
+    The node keeps files in memory and answers downloads with P, anything it can't do with F.
+    """
+    def setUp(self):
+        port = free_port()
+        self.stored = dict()
+        self.replies = queue.Queue()
+        self.node = AsyncEngine(NODE, port, self._node_recv, workers=2, bind=True)
+        self.client = AsyncEngine(CLIENT, port, lambda head, payload, ip: self.replies.put((head, payload.read_all())),
+                                  workers=2, bind=True)
+        self.node.start()
+        self.client.start()
+        self.agent = Agent(b"node", NODE)
+
+    def _node_recv(self, head, payload, ip):
+        agent = Agent(head.user, ip)
+        if head.command == b"U":
+            self.stored[head.name] = payload.read_all()
+        elif head.command == b"D" and head.name in self.stored:
+            self.node.send(agent, b"node", b"P", head.name, Source.of_bytes(self.stored[head.name]), head.request)
+        elif head.command == b"X" and head.name in self.stored:
+            del self.stored[head.name]
+        else:
+            self.node.send(agent, b"node", b"F", head.name, Source(0, ()), head.request)
+
+    def send(self, command: bytes, name: bytes, source: Source = Source(0, ()), request: int = 0) -> bool:
+        return self.client.send(self.agent, b"client", command, name, source, request)
+
+    def test_upload_download_delete(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = Path(d) / "big"
+            data = os.urandom(CHUNK_SIZE * 3 + 11)
+            path.write_bytes(data)
+            # a file goes out with the loop's sendfile, bytes as they are
+            self.assertTrue(self.send(b"U", b"big", file_source(path)))
+            self.assertTrue(self.send(b"U", b"small", Source.of_bytes(b"hello")))
+
+            self.assertTrue(self.send(b"D", b"big", request=7))
+            head, payload = self.replies.get(timeout=5)
+            self.assertEqual((head.command, head.name, head.request), (b"P", b"big", 7))
+            self.assertEqual(payload, data)
+
+            self.assertTrue(self.send(b"X", b"big"))
+            self.assertTrue(self.send(b"D", b"big", request=8))
+            head, _ = self.replies.get(timeout=5)
+            self.assertEqual((head.command, head.request), (b"F", 8))
+            self.assertEqual(list(self.stored), [b"small"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,38 +1,57 @@
+import atexit
+import io
+import mmap
+import os
+import random
 import socket
-from threading import Thread
+import time
+from concurrent import futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore, Thread
+from typing import Iterable
 import sys
 
-from filehandler import FileHandler
+from filehandler import FileHandler, path_storage
 from containers import *
+from compress import IDS, NAMES, available, compress_source, decompress_chunks, level_for
+from connections import ConnectionPool
+from batch import BATCH_COMMANDS, ITEM, MAX_BYTES, NO_REPLY, Item, batches, pack_items, unpack_items
+from delta import DeltaChunks, Signatures, compute_delta, delta_length, literal_bytes
+from dispatch import Dispatcher
+from hashcache import ALGORITHMS, DIGEST_SIZE, NAMES as HASH_NAMES
+from ledger import file_size
+from metrics import Metrics
+from scheduler import Scheduler
+from protocol import RANGE, Head, PayloadReader, Source, pack_head, read_head, split_codec, split_hash, split_range, \
+    with_codec, with_hash, with_range
+from replicate import Replication
+from swarm import Swarm, agree_on
+from sync import SyncPlan
 
 
 class ListenerTCP(Thread):
-    def __init__(self, address: Address, f_tcp_recv):
+    def __init__(self, address: Address, f_accept, backlog: int = 5, max_connections: int = 64):
         super(ListenerTCP, self).__init__()
         self.daemon = True
         try:
             self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.s.bind(address)
-            self.s.listen(5)
+            self.s.listen(backlog)
         except socket.error as e:
             print('Failed to create TCP socket', file=sys.stderr)
             print(e, file=sys.stderr)
             print(f"{address}", file=sys.stderr)
             sys.exit(1)
-        self.f_tcp_recv = f_tcp_recv
+        self.f_accept = f_accept
+        # At the cap, stop accepting and let the backlog hold new peers
+        self.slots = BoundedSemaphore(max_connections)
 
     def run(self):
         while True:
+            self.slots.acquire()
             conn, addr = self.s.accept()
-            with conn:
-                parts = list()
-                while True:
-                    part = conn.recv(500)
-                    if not part:
-                        break
-                    parts.append(part)
-                data = b"".join(parts)
-                self.f_tcp_recv(data, addr[0])
+            # connections are persistent, the pool serves each one in its own thread
+            self.f_accept(conn, addr[0], self.slots.release)
 
 
 class ListenerUDP(Thread):
@@ -51,27 +70,133 @@ class ListenerUDP(Thread):
 
     def run(self):
         while True:
-            data, addr = self.s.recvfrom(30)
-            self.f_udp_recv(data, addr[0])
+            data, addr = self.s.recvfrom(512)
+            recv = io.BytesIO(data).read
+            try:
+                head = read_head(recv)
+            except ConnectionError:
+                print(f"datagram from {addr[0]} is not whole", file=sys.stderr)
+                continue
+            if head is not None:
+                self.f_udp_recv(head, PayloadReader(recv, head.length), addr[0])
+
+
+class ThreadedEngine:
+    """
+    A listener thread per protocol, a reader thread per connection, handlers on a worker pool.
+    """
+    def __init__(self, ip: str, port_tcp: int, port_udp: int, f_recv,
+                 workers: int = 8, max_connections: int = 64, backlog: int = 5, scheduler: Optional[Scheduler] = None,
+                 bind: bool = False):
+        """
+        bind: UDP listens on ip only and connections go out from it, so several nodes can share a machine
+        """
+        self.port_udp = port_udp
+        self.dispatcher = Dispatcher(f_recv, workers)
+        self.pool = ConnectionPool(port_tcp, self.dispatcher, scheduler=scheduler, source_ip=ip if bind else None)
+        Metrics.gauge("handlers.queued", self.dispatcher.executor.depth)
+        Metrics.gauge("connections", self.pool.open)
+        self.listener_tcp = ListenerTCP(Address(ip, port_tcp), self.pool.adopt, backlog, max_connections)
+        self.listener_udp = ListenerUDP(Address(ip if bind else '', port_udp), self.dispatcher)
+
+    def start(self) -> None:
+        self.listener_tcp.start()
+        self.listener_udp.start()
+
+    def send(self, agent: Agent, user: bytes, command: bytes, name: bytes, source: Source, request: int = 0) -> bool:
+        return self.pool.send(agent, user, command, name, source, request)
+
+    def broadcast(self, packet: bytes) -> bool:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.bind(('', 0))
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            try:
+                s.sendto(packet, ("<broadcast>", self.port_udp))
+                return True
+            except:
+                return False
 
 
 class Backend:
-    # TODO same port
     PORT_TCP = 8888
     PORT_UDP = 9999
+    RESUME_ATTEMPTS = 5
+    # batches sent before the first one is answered
+    BATCH_IN_FLIGHT = 4
+    # files up to this size go in batches, larger ones alone
+    BATCH_FILE_SIZE = 256 * 1024
+    # seconds between heartbeats, give or take a fifth so thousands of agents don't send together
+    HEARTBEAT = 30.0
+    # agents seen recently, so a new run can reach them before anyone answers its broadcast
+    PEERS_CACHE = path_storage / ".peers.json"
 
-    def __init__(self, username: str, debug: bool):
+    def __init__(self, username: str, debug: bool, port: Optional[int] = None,
+                 workers: int = 8, max_connections: int = 64, backlog: int = 5,
+                 compression: Optional[str] = "zlib", compression_level: Optional[int] = None,
+                 rate_limit: float = 0, peer_rate_limit: float = 0, metrics: bool = False, ip: Optional[str] = None):
+        """
+        port: if given, TCP and UDP both use it, otherwise PORT_TCP and PORT_UDP
+        ip: the one address to listen on and connect from, otherwise get_ip() and any address.
+        Nodes on one machine each take a loopback address of their own, 127.0.0.2, 127.0.0.3 and so on.
+        compression: codec for payloads to agents that decode it, None sends everything raw
+        rate_limit, peer_rate_limit: bytes a second of file payloads in total and to each agent, 0 for no limit
+        metrics: collect them for `inwards stats`, debug also profiles handlers and traces allocations
+        """
         self.debug = debug
-        self.listener_tcp = ListenerTCP(Address(self.get_ip(), self.PORT_TCP), self._f_tcp_recv)
-        self.listener_tcp.start()
-        self.listener_udp = ListenerUDP(Address('', self.PORT_UDP), self._f_tcp_recv)
-        self.listener_udp.start()
-
+        self.ip = ip or self.get_ip()
+        self.bind = ip is not None
+        if metrics or debug:
+            Metrics.enable(profiling=debug)
         self.username = username.encode("ascii", "replace")[:10]
         self.username_str = username
+        self.overviews_since_request: List[Overview] = list()
+        self.compression = compression if compression in IDS else None
+        self.compression_level = level_for(compression, compression_level)
+        # codecs each agent listed in its overview
+        self._agent_codecs: Dict[Agent, List[str]] = dict()
+        self._agent_hashes: Dict[Agent, List[str]] = dict()
+        # last full overview of each agent, deltas apply to it
+        self._overviews: Dict[Agent, Overview] = dict()
+        FileHandler.rebuild_usage()
+        FileHandler.validate_index()
+        AgentHandler.load(self.PEERS_CACHE)
+        atexit.register(AgentHandler.save, self.PEERS_CACHE)
+        atexit.register(FileHandler.save_cache_stats)
+        atexit.register(FileHandler.save_usage, True)
+        atexit.register(Metrics.save, path_storage)
+        self.scheduler = Scheduler(rate_limit, peer_rate_limit)
+        Metrics.gauge("requests.in_flight", RequestHandler.in_flight)
+        Metrics.gauge("send.waiting", self.scheduler.waiting)
+        Metrics.gauge("agents", lambda: len(AgentHandler.agents()))
+
+        self.engine = self._make_engine(port, workers, max_connections, backlog)
+        self.engine.start()
         self.out_status_broadcast()
+        Thread(target=self._heartbeat_forever, name="heartbeat", daemon=True).start()
 
-        self.overviews_since_request: List[Overview] = list()
+    def _heartbeat_forever(self) -> None:
+        while True:
+            time.sleep(self.HEARTBEAT * random.uniform(0.8, 1.2))
+            self.engine.broadcast(pack_head(self.username, b"H", b"", 0))
+            for agent in AgentHandler.expire():
+                self._forget(agent)
+            AgentHandler.save(self.PEERS_CACHE)
+            FileHandler.save_usage()
+            FileHandler.save_cache_stats()
+            Metrics.save(path_storage)
+
+    def _forget(self, agent: Agent) -> None:
+        if self.debug:
+            print(f"{agent} went silent", file=sys.stderr)
+        self._agent_codecs.pop(agent, None)
+        self._agent_hashes.pop(agent, None)
+        self._overviews.pop(agent, None)
+
+    def _make_engine(self, port: Optional[int], workers: int, max_connections: int, backlog: int):
+        port_tcp = port or self.PORT_TCP
+        port_udp = port or self.PORT_UDP
+        return ThreadedEngine(self.ip, port_tcp, port_udp, self._f_tcp_recv, workers, max_connections, backlog,
+                              self.scheduler, self.bind)
 
     @staticmethod
     def get_ip() -> str:
@@ -88,171 +213,559 @@ class Backend:
     def _padded_name(self) -> bytes:
         return self.username.ljust(10, b"\0")
 
-    def _f_tcp_recv(self, data: bytes, ip: str):
+    def _f_tcp_recv(self, head: Head, payload: PayloadReader, ip: str):
         """
-        upload ex: bekir\0\0\0\0\0\x00\x00Ufilename.txt\0this is a file\n
+        upload ex: header(bekir, U, 12, 15) filename.txt this is a file\n
 
+        Every message is a frame, see protocol.py
         Bounded 10-byte \0 padded from right username at the beginning
-        Then one char command type
-
-        [S] Status    -
-        [U] Upload    filename\0bytestring
-        [D] Download  filename
-        [R] Rename    oldfilename\0newfilename
-        [X] Delete    filename
-        [O] Overview  json
-        [P] Payload   filename\0bytestring
-        [F] Failure   bjson
+        Then one char command type, name length and payload length
+
+        [S] Status    name: empty, OVERVIEW_ASK, VERSION_ASK or MANIFEST_ASK, see containers.py
+        [U] Upload    name: filename      payload: bytestring
+        [D] Download  name: filename
+        U, D and P names may carry a range, filename\0RANGE, see protocol.py
+        U and P names may end with CODEC for a compressed payload, D names with the codec accepted
+        then, like T names, with HASH of the whole file to agents listing the algorithm in their overview's hashes,
+        D names with the algorithm the answer is checked with
+        [R] Rename    name: oldfilename   payload: newfilename
+        [X] Delete    name: filename
+        [O] Overview                      payload: json, or binary to agents that asked with a version
+        [P] Payload   name: filename      payload: bytestring
+        [F] Failure                       payload: bjson
+        [G] Signatures name: filename                      asks block signatures for a delta upload
+        [K] Checksums name: filename      payload: signatures, empty if there is no such file
+        [T] Delta     name: filename      payload: delta against the stored version
+        [W] Where     name: filename                      asks how much of a resumable upload arrived
+        [V] Offset    name: filename\0RANGE(offset, total)
+        [H] Heartbeat                                      broadcast, any frame keeps its sender alive
+        [B] Batch     name: U, D, R or X  payload: items, see batch.py
+        [Y] Results   name: U, D, R or X  payload: an item per batch item with its status, D items with the file
+        B and Y names may end with CODEC like U and P
         [ ] Success
+        S, D, W, G and B may be tagged with a request id, their O, P, F, V, K and Y replies carry it back
+        so may U without a range, it is answered with V(length, length) once stored or with F
         """
-        if len(data) < 11:
-            print(f"header is not whole {data.decode()}", file=sys.stderr)
-            return
-
-        user = data[:10].rstrip(b"\0")
+        user = head.user
         if user == self.username:
             return
         agent = Agent(name=user, ip=ip)
-        agent_instead = AgentHandler.none_if_proper(agent)
-        """
-        if agent_instead is not None:
-            # TODO handle error
-            # call out_failure
-            print(f"There is an agent like this: {agent_instead}", file=sys.stderr)
-            return
-        """
-        command = data[10:11]
-        payload = data[11:]
-        if command == b'S':
-            self._inc_status(agent)
-            return
+        # registers agent, one clashing with a live agent is still served, the registry keeps the live one
+        AgentHandler.none_if_proper(agent)
+        Metrics.call("command." + head.command.decode("ascii", "replace"), self._handle, agent, head, payload)
+
+    def _handle(self, agent: Agent, head: Head, payload: PayloadReader) -> None:
+        command, request = head.command, head.request
+        if command == b"S":
+            self._inc_status(agent, head.name, request)
+        elif command == b"U":
+            self._inc_upload(agent, head.name, payload, request)
+        elif command == b"F":
+            self._inc_failure(agent, payload.read_all(), request)
+        elif command == b"O":
+            self._inc_overview(agent, payload.read_all(), request)
+        elif command == b"D":
+            self._inc_download(agent, head.name, request)
+        elif command == b"P":
+            self._inc_payload(agent, head.name, payload, request)
+        elif command == b"R":
+            self._inc_rename(agent, head.name, payload.read_all())
+        elif command == b"X":
+            self._inc_delete(agent, head.name)
+        elif command == b"G":
+            self._inc_signatures(agent, head.name, request)
+        elif command == b"K":
+            self._inc_checksums(agent, head.name, payload.read_all(), request)
+        elif command == b"T":
+            self._inc_delta(agent, head.name, payload)
+        elif command == b"W":
+            self._inc_where(agent, head.name, request)
+        elif command == b"V":
+            self._inc_offset(agent, head.name, request)
+        elif command == b"H":
+            pass
+        elif command == b"B":
+            self._inc_batch(agent, head.name, payload, request)
+        elif command == b"Y":
+            self._inc_results(agent, head.name, payload, request)
         else:
-            tokens = payload.split(b"\0", maxsplit=1)
-            if command == b"U":
-                if len(tokens) != 2:
-                    return
-                self._inc_upload(agent, *tokens)
-            elif command == b"F":
-                if len(tokens) != 1:
-                    return
-                self._inc_failure(agent, tokens[0])
-            elif command == b"O":
-                if len(tokens) != 1:
-                    return
-                self._inc_overview(agent, tokens[0])
-            elif command == b"D":
-                if len(tokens) != 1:
-                    return
-                self._inc_download(agent, tokens[0])
-            elif command == b"P":
-                if len(tokens) != 2:
-                    return
-                self._inc_payload(agent, *tokens)
-            elif command == b"R":
-                if len(tokens) != 2:
-                    return
-                self._inc_rename(agent, *tokens)
-            elif command == b"X":
-                if len(tokens) != 1:
-                    return
-                self._inc_delete(agent, tokens[0])
-            else:
-                print("Unknown command:", data)
+            print("Unknown command:", head, file=sys.stderr)
 
-    def _inc_status(self, agent: Agent) -> None:
+    def _inc_status(self, agent: Agent, ask: bytes = b"", request: int = 0) -> None:
         """
         Creates overview for the user, sends it.
+        An agent asking with a version gets a binary overview of what changed since, older agents full json.
         """
-        ov = FileHandler.server_overview_of(agent.name.decode("ascii", "replace"), self.username_str)
-        if ov is not None:
-            self._send_tcp(b"O" + ov.to_bjson(), agent.ip)
+        user = agent.name.decode("ascii", "replace")
+        if not ask:
+            ov = FileHandler.server_overview_of(user, self.username_str)
+            ov.codecs = available()
+            ov.hashes = list(ALGORITHMS)
+            with Metrics.timer("serialize.overview"):
+                data = ov.to_bjson()
+            self._send_tcp(agent, b"O", source=Source.of_bytes(data), request=request)
+            return
+        if ask == MANIFEST_ASK:
+            ov = FileHandler.server_manifest_of(user, self.username_str)
         else:
-            self.out_failure(agent, Fail(ErrorType.OVERVIEW))
+            if ask == VERSION_ASK:
+                epoch, since = ChangeHandler.epoch, ChangeHandler.version_of(user)
+            elif len(ask) == OVERVIEW_ASK.size:
+                epoch, since = OVERVIEW_ASK.unpack(ask)
+            else:
+                epoch, since = 0, 0
+            ov = FileHandler.server_overview_changes(user, self.username_str, epoch, since)
+        ov.codecs = available()
+        ov.hashes = list(ALGORITHMS)
+        with Metrics.timer("serialize.overview"):
+            data = ov.to_bin()
+        self._send_tcp(agent, b"O", source=Source.of_bytes(data), request=request)
+
+    def _overview_ask(self, agent: Agent) -> bytes:
+        cached = self._overviews.get(agent)
+        return OVERVIEW_ASK.pack(cached.epoch, cached.version) if cached is not None else OVERVIEW_ASK.pack(0, 0)
 
     def out_status(self, agent: Agent) -> bool:
         # Sends STATUS command to agent.
         self.overviews_since_request = list()
-        return self._send_tcp(b"S", agent.ip)
+        return self._ask_status(agent)
+
+    def _ask_status(self, agent: Agent) -> bool:
+        request = self._overview_request(agent)
+        if not self._send_tcp(agent, b"S", self._overview_ask(agent), request=request.id):
+            RequestHandler.cancel(request)
+            return False
+        return True
+
+    def _overview_request(self, agent: Agent) -> Request:
+        # one pending overview per agent, asking again waits for the same reply
+        return RequestHandler.get(0, agent, b"O") or RequestHandler.new(agent, b"O")
     
     def out_status_broadcast(self) -> bool:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.bind(('', 0))
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            try:
-                packet = self._padded_name + b"S"
-                s.sendto(packet, ("<broadcast>", self.PORT_UDP))
-                self.overviews_since_request = list()
-                return True
-            except:
-                return False
+        # everyone answers with its version only, agents whose overview changed are asked for the changes
+        self.overviews_since_request = list()
+        for agent in AgentHandler.agents():
+            self._overview_request(agent)
+        return self.engine.broadcast(pack_head(self.username, b"S", VERSION_ASK, 0))
+
+    def out_manifest(self, agent: Agent, timeout: float = 30) -> Optional[Overview]:
+        """
+        Full overview of agent with the sha256 of every file, blocks until it comes.
+        """
+        request = RequestHandler.new(agent, b"O")
+        if not self._send_tcp(agent, b"S", MANIFEST_ASK, request=request.id):
+            RequestHandler.cancel(request)
+            return None
+        return self._result(request, timeout)
 
-    def _inc_upload(self, agent: Agent, filename: bytes, data: bytes) -> None:
+    def fetch_overview(self, agent: Agent, full: bool = False, timeout: float = 30) -> Optional[Overview]:
+        """
+        Overview of agent, blocks until it comes. full: the whole listing, not the changes since the one we have
+        """
+        request = self._overview_request(agent)
+        ask = OVERVIEW_ASK.pack(0, 0) if full else self._overview_ask(agent)
+        if not self._send_tcp(agent, b"S", ask, request=request.id):
+            RequestHandler.cancel(request)
+            return None
+        return self._result(request, timeout)
+
+    def wait_overviews(self, timeout: float) -> List[Overview]:
+        """
+        Overviews since the last status request, returns once every known agent answered or at the deadline.
+        With no agent known yet there is nothing to expect, discovery takes the whole timeout.
+        """
+        expected = RequestHandler.pending(b"O")
+        if expected:
+            RequestHandler.wait(expected, timeout)
+        else:
+            time.sleep(timeout)
+        return self.get_overviews()
+
+    def _inc_upload(self, agent: Agent, name: bytes, payload: PayloadReader, request: int = 0) -> None:
+        name, expected = self._expected(name)
+        name, chunks, length = self._decoded(name, payload)
+        filename, ranged = split_range(name)
         s_name = filename.decode("ascii", "replace")
-        success = FileHandler.server_file_put(agent.name.decode("ascii", "replace"), s_name, data)
+        user = agent.name.decode("ascii", "replace")
+        if chunks is None:
+            success = False
+        elif ranged is None:
+            success = FileHandler.server_file_put(user, s_name, chunks, length, expected)
+        else:
+            success = FileHandler.server_file_put_range(user, s_name, chunks, *ranged, expected)
         if not success:
-            self.out_failure(agent, Fail(ErrorType.PUT, filename=s_name))
+            self.out_failure(agent, Fail(ErrorType.PUT, filename=s_name), request)
+        elif request and ranged is None:
+            # stored and checked, see out_replicate
+            self._send_tcp(agent, b"V", with_range(filename, length, length), request=request)
 
-    def out_upload(self, agent: Agent, filepath: Path, filename: Optional[bytes] = None) -> bool:
-        data = FileHandler.client_file_read(filepath)
-        if data is None:
+    def out_upload(self, agent: Agent, filepath: Path, filename: Optional[bytes] = None,
+                   resume: bool = False, retries: int = 3, timeout: float = 5) -> bool:
+        """
+        resume: send in a resumable way, continuing from what agent already has of an earlier try
+        and retrying from the last offset it confirms when the connection breaks.
+        """
+        source = FileHandler.client_file_read(filepath)
+        if source is None:
             return False
         if filename is None:
             filename = filepath.name.encode("ascii", "replace")
-        packet = b"U" + filename + b"\0" + data
-        return self._send_tcp(packet, agent.ip)
+        codec = self._codec_for(agent)
+        algo = self._hash_for(agent)
+        digest = FileHandler.hash_cache().digest(filepath, algo) if algo is not None else None
+        if not resume:
+            name, source = self._encoded(filename, source, codec)
+            return self._send_tcp(agent, b"U", self._hashed(name, algo, digest), source)
+        total = source.length
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(min(2 ** attempt, 30))
+            offset = self._upload_offset(agent, filename, total, timeout)
+            if offset is None:
+                continue
+            if offset > 0:
+                print(f"Resuming {filename.decode('ascii', 'replace')} at {offset} of {total} bytes")
+            source = FileHandler.client_file_read(filepath, offset)
+            if source is None:
+                return False
+            name, source = self._encoded(with_range(filename, offset, total), source, codec)
+            if self._send_tcp(agent, b"U", self._hashed(name, algo, digest), source):
+                return True
+        return False
+
+    def out_replicate(self, agents: List[Agent], filepath: Path, quorum: Optional[int] = None,
+                      filename: Optional[bytes] = None, retries: int = 2, timeout: float = 60) -> Optional[Replication]:
+        """
+        Uploads filepath to every agent at once, reading it once, see replicate.py.
+        Returns once quorum agents, a majority by default, acknowledged a checked write or too many failed,
+        the rest go on in the background. None if the file can't be read.
+        timeout: seconds to wait for an acknowledgement after the payload went out
+        """
+        source = FileHandler.client_file_map(filepath)
+        if source is None or not agents:
+            return None
+        if filename is None:
+            filename = filepath.name.encode("ascii", "replace")
+        # an overview tells the agent's codecs and hashes
+        asked = [agent for agent in agents if agent not in self._overviews and self._ask_status(agent)]
+        RequestHandler.wait([request for request in RequestHandler.pending(b"O") if request.agent in asked], 5)
+        quorum = len(agents) // 2 + 1 if quorum is None else min(max(quorum, 1), len(agents))
+        replication = Replication(filename.decode("ascii", "replace"), source.length, agents, quorum)
+        payloads = {codec: self._encoded(filename, source, codec) for codec in {self._codec_for(a) for a in agents}}
+        digests = {algo: FileHandler.hash_cache().digest(filepath, algo)
+                   for algo in {self._hash_for(a) for a in agents} if algo is not None}
+        for agent in agents:
+            name, payload = payloads[self._codec_for(agent)]
+            algo = self._hash_for(agent)
+            name = self._hashed(name, algo, digests.get(algo))
+            Thread(target=self._replicate_to, args=(replication, agent, name, payload, retries, timeout),
+                   name="replica", daemon=True).start()
+        replication.wait_quorum()
+        return replication
+
+    def _replicate_to(self, replication: Replication, agent: Agent, name: bytes, source: Source,
+                      retries: int, timeout: float) -> None:
+        status = NO_REPLY
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(min(2 ** attempt, 30))
+            request = RequestHandler.new(agent, b"V", replication.filename)
+            if not self._send_tcp(agent, b"U", name, source, request=request.id):
+                # the connection broke, the payload goes again
+                RequestHandler.cancel(request)
+                continue
+            try:
+                offset, total = request.future.result(timeout)
+                status = 0 if offset == total == replication.length else ErrorType.PUT.value
+            except futures.TimeoutError:
+                RequestHandler.cancel(request)
+            except RequestFailed as e:
+                status = e.fail.error.value
+            break
+        if status != 0:
+            print(f"Replica of {replication.filename} on {agent} failed", file=sys.stderr)
+        replication.finish(agent, status)
+
+    def _codec_for(self, agent: Agent) -> Optional[str]:
+        return self.compression if self.compression in self._agent_codecs.get(agent, ()) else None
+
+    def _hash_for(self, agent: Agent) -> Optional[str]:
+        # our most preferred algorithm agent checks transfers with, None for agents that don't check
+        offered = self._agent_hashes.get(agent, ())
+        return next((algo for algo in ALGORITHMS if algo in offered), None)
+
+    @staticmethod
+    def _hashed(name: bytes, algo: Optional[str], digest: Optional[bytes]) -> bytes:
+        return with_hash(name, ALGORITHMS[algo], digest) if algo is not None and digest is not None else name
+
+    @staticmethod
+    def _expected(name: bytes) -> Tuple[bytes, Optional[Tuple[str, bytes]]]:
+        """
+        (name without the hash, (algorithm, digest) the payload has to match or None)
+        """
+        name, hashed = split_hash(name)
+        if hashed is None or hashed[0] not in HASH_NAMES:
+            return name, None
+        return name, (HASH_NAMES[hashed[0]], hashed[1])
+
+    def _encoded(self, name: bytes, source: Source, codec: Optional[str]) -> Tuple[bytes, Source]:
+        """
+        Compresses source with codec unless its first chunk shows it is not worth it.
+        """
+        if codec is None:
+            return name, source
+        packed = compress_source(source, codec, self.compression_level)
+        if packed is None:
+            return name, source
+        if self.debug:
+            print(f"{codec}: {source.length} -> {packed.length} bytes", file=sys.stderr)
+        return with_codec(name, IDS[codec], source.length), packed
+
+    @staticmethod
+    def _decoded(name: bytes, payload: PayloadReader) -> Tuple[bytes, Optional[Iterable[bytes]], int]:
+        """
+        (name without codec, decoded chunks, decoded length), chunks are None for an unknown codec.
+        Chunks may be views into the receive buffer, each one has to be used before the next is taken.
+        """
+        name, codec = split_codec(name)
+        if codec is None:
+            return name, payload.views(), payload.length
+        if codec[0] not in NAMES:
+            print(f"Unknown codec {codec[0]!r}", file=sys.stderr)
+            return name, None, 0
+        return name, decompress_chunks(payload.views(), NAMES[codec[0]], codec[1]), codec[1]
+
+    def _upload_offset(self, agent: Agent, filename: bytes, total: int, timeout: float) -> Optional[int]:
+        request = RequestHandler.new(agent, b"V", filename.decode("ascii", "replace"))
+        if not self._send_tcp(agent, b"W", filename, request=request.id):
+            RequestHandler.cancel(request)
+            return None
+        reply = self._result(request, timeout)
+        if reply is None:
+            return None
+        offset, known_total = reply
+        return offset if known_total == total else 0
 
-    def _inc_overview(self, agent: Agent, bjson: bytes) -> None:
+    @staticmethod
+    def _result(request: Request, timeout: float):
+        """
+        The reply, None if it failed or did not come in time.
+        """
         try:
-            overview = Overview.from_bjson(bjson)
-            self.overviews_since_request.append(overview)
-        except:
-            self.out_failure(agent, Fail(error=ErrorType.PARSE, filename=None))
+            return request.future.result(timeout)
+        except futures.TimeoutError:
+            RequestHandler.cancel(request)
+        except RequestFailed as e:
+            print(f"{request} failed: {e.fail}", file=sys.stderr)
+        return None
+
+    def _inc_where(self, agent: Agent, filename: bytes, request: int = 0) -> None:
+        offset, total = FileHandler.server_upload_offset(agent.name.decode("ascii", "replace"),
+                                                         filename.decode("ascii", "replace"))
+        self._send_tcp(agent, b"V", with_range(filename, offset, total), request=request)
+
+    def _inc_offset(self, agent: Agent, name: bytes, request_id: int = 0) -> None:
+        filename, ranged = split_range(name)
+        request = RequestHandler.get(request_id, agent, b"V", filename.decode("ascii", "replace"))
+        if ranged is not None and request is not None:
+            RequestHandler.resolve(request, ranged)
+
+    def _inc_overview(self, agent: Agent, data: bytes, request_id: int = 0) -> None:
+        with Metrics.timer("deserialize.overview"):
+            overview = Overview.from_wire(data)
+        if overview is None:
+            self.out_failure(agent, Fail(error=ErrorType.PARSE, filename=None), request_id)
+            return
+        if overview.base:
+            cached = self._overviews.get(agent)
+            if cached is None or cached.epoch != overview.epoch or cached.version != overview.base:
+                # changes on a version we don't have, ask for the changes since ours or everything
+                request = self._overview_request(agent)
+                self._send_tcp(agent, b"S", self._overview_ask(agent), request=request.id)
+                return
+            overview = cached.applied(overview)
+        self._overviews[agent] = overview
+        self._agent_codecs[agent] = overview.codecs
+        self._agent_hashes[agent] = overview.hashes
+        self.overviews_since_request.append(overview)
+        request = RequestHandler.get(request_id, agent, b"O")
+        if request is not None:
+            RequestHandler.resolve(request, overview)
 
     def out_overview(self, agent: Agent, overview: Overview) -> bool:
-        return self._send_tcp(b"O" + overview.to_bjson(), agent.ip)
+        return self._send_tcp(agent, b"O", source=Source.of_bytes(overview.to_bjson()))
 
     def get_overviews(self) -> List[Overview]:
         return self.overviews_since_request
 
-    def _inc_failure(self, agent: Agent, bjson: bytes) -> None:
-        try:
-            fail_obj = Fail.from_bjson(bjson)
-            print(f"FAIL from {agent.name.decode('ascii', 'replace')}", file=sys.stderr)
-            print(fail_obj, file=sys.stderr)
-        except:
-            print(f"FAIL from {agent.name.decode('ascii', 'replace')}", file=sys.stderr)
+    def _inc_failure(self, agent: Agent, bjson: bytes, request_id: int = 0) -> None:
+        fail_obj = Fail.from_wire(bjson)
+        print(f"FAIL from {agent.name.decode('ascii', 'replace')}", file=sys.stderr)
+        if fail_obj is None:
             print(f"Could not parse fail obj", file=sys.stderr)
             print(bjson, file=sys.stderr)
             self.out_failure(agent, Fail(error=ErrorType.PARSE, filename=None))
             return
+        print(fail_obj, file=sys.stderr)
+        RequestHandler.fail(request_id, agent, fail_obj)
 
-    def out_failure(self, agent: Agent, fail: Fail) -> bool:
-        return self._send_tcp(b"F"+fail.to_bjson(), agent.ip)
+    def out_failure(self, agent: Agent, fail: Fail, request: int = 0) -> bool:
+        """
+        request: id of the request that failed, 0 if it was not tagged
+        """
+        return self._send_tcp(agent, b"F", source=Source.of_bytes(fail.to_bin()), request=request)
 
-    def _inc_download(self, agent: Agent, filename: bytes) -> None:
+    def _inc_download(self, agent: Agent, name: bytes, request: int = 0) -> None:
+        name, checked = split_hash(name)
+        name, accepted = split_codec(name)
+        codec = NAMES.get(accepted[0]) if accepted is not None and self.compression is not None else None
+        filename, ranged = split_range(name)
         s_name = filename.decode("ascii", "replace")
-        data = FileHandler.server_file_get(agent.name.decode("ascii", "replace"), s_name)
-        if data is not None:
-            self.out_payload(agent, filename, data)
+        user = agent.name.decode("ascii", "replace")
+        algo = HASH_NAMES.get(checked[0]) if checked is not None else None
+        if ranged is None:
+            source = FileHandler.server_file_get(user, s_name)
+            if source is not None:
+                digest = FileHandler.server_file_digest(user, s_name, algo) if algo is not None else None
+                self.out_payload(agent, filename, source, codec, request, (algo, digest))
+                return
         else:
-            self.out_failure(agent, Fail(ErrorType.GET, filename=s_name))
+            found = FileHandler.server_file_get_range(user, s_name, *ranged)
+            if found is not None:
+                total, source = found
+                digest = FileHandler.server_file_digest(user, s_name, algo) if algo is not None else None
+                self.out_payload(agent, with_range(filename, ranged[0], total), source, codec, request, (algo, digest))
+                return
+        self.out_failure(agent, Fail(ErrorType.GET, filename=s_name), request)
+
+    def out_download(self, agent: Agent, filename: str, path: Path, resume: bool = True,
+                     request: Optional[Request] = None) -> Optional[Request]:
+        """
+        resume: continue an interrupted download into path from its last verified offset
+        Its future gets path once the file is whole, None is returned if the request could not be sent.
+        """
+        if request is None:
+            request = RequestHandler.new(agent, b"P", filename, path)
+        known = self._overviews.get(agent)
+        size = next((info.length_Byte for info in known.files if info.name == filename), None) if known else None
+        offset = FileHandler.client_part_offset(path, size)[0] if resume else 0
+        if offset > 0:
+            print(f"Resuming {filename} at {offset} bytes")
+        name = self._accepting(with_range(filename.encode("ascii", "replace"), offset, 0), agent)
+        if not self._send_tcp(agent, b"D", name, request=request.id):
+            RequestHandler.cancel(request)
+            return None
+        return request
 
-    def out_download(self, agent: Agent, filename: str, path: Path) -> bool:
-        DownloadHandler.add_download(agent, filename, path)
-        return self._send_tcp(b"D" + filename.encode("ascii", "replace"), agent.ip)
+    def _accepting(self, name: bytes, agent: Optional[Agent] = None) -> bytes:
+        """
+        name of a download with the codec we take and the hash we check the payload with, if agent gives one
+        """
+        if self.compression is not None:
+            name = with_codec(name, IDS[self.compression], 0)
+        algo = self._hash_for(agent) if agent is not None else None
+        return self._hashed(name, algo, bytes(DIGEST_SIZE))
 
-    def _inc_payload(self, agent: Agent, filename: bytes, payload: bytes) -> None:
+    def _inc_payload(self, agent: Agent, name: bytes, payload: PayloadReader, request_id: int = 0) -> None:
+        name, expected = self._expected(name)
+        name, chunks, length = self._decoded(name, payload)
+        filename, ranged = split_range(name)
         s_name = filename.decode("ascii", "replace")
-        path = DownloadHandler.resolve_download(agent, s_name)
-        if path is None:
+        if chunks is None:
+            self.out_failure(agent, Fail(ErrorType.PARSE, s_name))
             return
-        success = FileHandler.client_file_write(path, payload)
-        if not success:
-            self.out_failure(agent, Fail(ErrorType.DOWNLOAD, s_name))
-            DownloadHandler.add_download(agent, s_name, path)
+        if ranged is not None and not request_id:
+            swarm = Swarm.active.get(s_name)
+            if swarm is not None and agent in swarm.peers:
+                swarm.receive(agent, ranged[0], chunks)
+                return
+        request = RequestHandler.get(request_id, agent, b"P", s_name)
+        if request is None:
+            return
+        if ranged is None:
+            if FileHandler.client_file_write(request.path, chunks, expected):
+                RequestHandler.resolve(request, request.path)
+            else:
+                RequestHandler.reject(request, Fail(ErrorType.DOWNLOAD, s_name))
+            return
+        try:
+            complete = FileHandler.client_part_write(request.path, chunks, *ranged, expected)
+        except (OSError, ConnectionError, ValueError) as e:
+            print(f"Download of {s_name} broke: {e}", file=sys.stderr)
+            self._resume_later(request)
+            return
+        if complete:
+            RequestHandler.resolve(request, request.path)
+
+    def _resume_later(self, request: Request) -> None:
+        request.attempts += 1
+        if request.attempts > self.RESUME_ATTEMPTS:
+            print(f"Giving up on {request.filename}, run download again to resume", file=sys.stderr)
+            RequestHandler.reject(request, Fail(ErrorType.DOWNLOAD, request.filename))
+            return
+
+        def resume():
+            time.sleep(min(2 ** request.attempts, 30))
+            # the pool reconnects, the request continues from the last verified offset
+            if self.out_download(request.agent, request.filename, request.path, request=request) is None:
+                self._resume_later(request)
+        Thread(target=resume, daemon=True).start()
+
+    def swarm_holders(self, filename: str) -> List[Agent]:
+        """
+        Agents whose last overview lists filename, those agreeing on the most common size.
+        """
+        by_size: Dict[int, List[Agent]] = dict()
+        for overview in self.overviews_since_request:
+            agent = AgentHandler.get_agent(overview.username.encode("ascii", "replace")[:10])
+            if agent is None:
+                continue
+            for info in overview.files:
+                if info.name == filename and agent not in by_size.get(info.length_Byte, ()):
+                    by_size.setdefault(info.length_Byte, list()).append(agent)
+        if not by_size:
+            return list()
+        return max(by_size.values(), key=len)
+
+    def out_swarm_download(self, filename: str, path: Path, agents: Optional[List[Agent]] = None,
+                           timeout: float = 600, range_size: int = 4 * 1024 * 1024) -> bool:
+        """
+        Downloads filename from all its holders at once, blocks until done.
+        agents: holders to use, by default the ones found in the overviews since the last status request
+        """
+        if agents is None:
+            agents = self.swarm_holders(filename)
+        if not agents:
+            print(f"Nobody holds {filename}", file=sys.stderr)
+            return False
+        b_name = filename.encode("ascii", "replace")
+        requests = [RequestHandler.new(agent, b"K", filename) for agent in agents]
+        for request in requests:
+            self._send_tcp(request.agent, b"G", b_name, request=request.id)
+        RequestHandler.wait(requests, 5)
+        signatures = {request.agent: self._result(request, 0) for request in requests}
+        sigs, agents = agree_on(signatures)
+        if sigs is None:
+            print(f"No holder of {filename} answered", file=sys.stderr)
+            return False
+
+        def fetch(agent: Agent, offset: int, length: int) -> bool:
+            return self._send_tcp(agent, b"D", self._accepting(with_range(b_name, offset, length)))
+        swarm = Swarm(filename, path, sigs, agents, fetch, range_size)
+        complete = swarm.run(timeout)
+        if self.debug or not complete:
+            print(swarm.report(), file=sys.stderr)
+        return complete
 
-    def out_payload(self, agent: Agent, filename: bytes, payload: bytes) -> bool:
-        return self._send_tcp(b"P"+filename+b"\0"+payload, agent.ip)
+    def out_payload(self, agent: Agent, filename: bytes, source: Source, codec: Optional[str] = None,
+                    request: int = 0, checked: Tuple[Optional[str], Optional[bytes]] = (None, None)) -> bool:
+        """
+        codec: one the requester accepts, the payload goes compressed if it shrinks
+        request: id of the download it answers
+        checked: (algorithm, digest of the whole file) the requester checks the payload with
+        """
+        name, source = self._encoded(filename, source, codec)
+        return self._send_tcp(agent, b"P", self._hashed(name, *checked), source, request=request)
 
     def _inc_rename(self, agent: Agent, old_filename: bytes, new_filename: bytes) -> bool:
         old_name = old_filename.decode("ascii", "replace")
@@ -262,7 +775,8 @@ class Backend:
             self.out_failure(agent, Fail(error=ErrorType.GET, filename=old_name))
 
     def out_rename(self, agent: Agent, old_filename: str, new_filename: str) -> bool:
-        return self._send_tcp(b"R" + old_filename.encode("ascii", "replace") + b"\0" + new_filename.encode("ascii", "replace"), agent.ip)
+        return self._send_tcp(agent, b"R", old_filename.encode("ascii", "replace"),
+                              Source.of_bytes(new_filename.encode("ascii", "replace")))
 
     def _inc_delete(self, agent: Agent, filename: bytes):
         s_name = filename.decode("ascii", "replace")
@@ -271,25 +785,234 @@ class Backend:
             self.out_failure(agent, Fail(error=ErrorType.GET, filename=s_name))  
 
     def out_delete(self, agent: Agent, filename: str) -> bool:
-        return self._send_tcp(b"X" + filename.encode("ascii", "replace"), agent.ip)
+        return self._send_tcp(agent, b"X", filename.encode("ascii", "replace"))
 
-    def _send_tcp(self, data: bytes, ip: str) -> bool:
-        socket_timeout = 2
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(socket_timeout)  # seconds
-            try:
-                s.connect((ip, self.PORT_TCP))
-            except Exception as e:
-                print(e, file=sys.stderr)
-                return False
+    def _inc_signatures(self, agent: Agent, filename: bytes, request: int = 0) -> None:
+        s_name = filename.decode("ascii", "replace")
+        signatures = FileHandler.server_file_signatures(agent.name.decode("ascii", "replace"), s_name)
+        self._send_tcp(agent, b"K", filename, Source.of_bytes(signatures or b""), request=request)
+
+    def _inc_checksums(self, agent: Agent, filename: bytes, signatures: bytes, request_id: int = 0) -> None:
+        request = RequestHandler.get(request_id, agent, b"K", filename.decode("ascii", "replace"))
+        if request is not None:
+            RequestHandler.resolve(request, signatures)
+
+    def _inc_delta(self, agent: Agent, name: bytes, payload: PayloadReader) -> None:
+        filename, expected = self._expected(name)
+        s_name = filename.decode("ascii", "replace")
+        success = FileHandler.server_file_patch(agent.name.decode("ascii", "replace"), s_name, payload, expected)
+        if not success:
+            self.out_failure(agent, Fail(ErrorType.PUT, filename=s_name))
+
+    def out_delta_upload(self, agent: Agent, filepath: Path, filename: Optional[bytes] = None,
+                         timeout: float = 5) -> bool:
+        """
+        Sends only what changed against the version agent already stores, a plain upload if it has none.
+        """
+        if filename is None:
+            filename = filepath.name.encode("ascii", "replace")
+        request = RequestHandler.new(agent, b"K", filename.decode("ascii", "replace"))
+        if not self._send_tcp(agent, b"G", filename, request=request.id):
+            RequestHandler.cancel(request)
+            return False
+        signatures = self._result(request, timeout)
+        if not signatures:
+            return self.out_upload(agent, filepath, filename)
+        sigs = Signatures.from_bytes(signatures)
+        try:
+            with filepath.open("rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return self.out_upload(agent, filepath, filename)
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    ops = compute_delta(data, sigs)
+                    if literal_bytes(ops) == len(data):
+                        return self.out_upload(agent, filepath, filename)
+                    source = Source(delta_length(ops), DeltaChunks(data, ops, sigs.block_size))
+                    # the whole new version is checked, the stored one may have changed since its signatures
+                    algo = self._hash_for(agent)
+                    digest = FileHandler.hash_cache().digest(filepath, algo) if algo is not None else None
+                    return self._send_tcp(agent, b"T", self._hashed(filename, algo, digest), source)
+        except OSError as e:
+            print(e, file=sys.stderr)
+            return False
+
+    def _batch_items(self, name: bytes, payload: PayloadReader) -> Tuple[bytes, Optional[List[Item]]]:
+        name, chunks, length = self._decoded(name, payload)
+        if chunks is None:
+            return name, None
+        try:
+            data = b"".join(bytes(chunk) for chunk in chunks)
+        except (ConnectionError, ValueError):
+            return name, None
+        with Metrics.timer("deserialize.batch"):
+            return name, unpack_items(data)
+
+    def _inc_batch(self, agent: Agent, name: bytes, payload: PayloadReader, request: int = 0) -> None:
+        command, items = self._batch_items(name, payload)
+        if items is None or command not in BATCH_COMMANDS:
+            self.out_failure(agent, Fail(ErrorType.PARSE, filename=None), request)
+            return
+        user = agent.name.decode("ascii", "replace")
+        if command == b"D":
+            results = FileHandler.server_batch_get(user, [item.name for item in items], MAX_BYTES)
+        else:
+            if command == b"U":
+                statuses = FileHandler.server_batch_put(user, items)
+            elif command == b"R":
+                statuses = FileHandler.server_batch_rename(user, [(item.name, item.other) for item in items])
             else:
+                statuses = FileHandler.server_batch_delete(user, [item.name for item in items])
+            results = [Item(item.name, item.other, status=status) for item, status in zip(items, statuses)]
+        codec = self._codec_for(agent) if command == b"D" else None
+        with Metrics.timer("serialize.batch"):
+            data = pack_items(results)
+        self._send_tcp(agent, b"Y", *self._encoded(command, Source.of_bytes(data), codec), request=request)
+
+    def _inc_results(self, agent: Agent, name: bytes, payload: PayloadReader, request_id: int = 0) -> None:
+        command, results = self._batch_items(name, payload)
+        request = RequestHandler.get(request_id, agent, b"Y")
+        if request is None:
+            return
+        if results is None:
+            RequestHandler.reject(request, Fail(ErrorType.PARSE, filename=None))
+        else:
+            RequestHandler.resolve(request, results)
+
+    def out_batch(self, agent: Agent, command: bytes, items: Iterable[Item], in_flight: Optional[int] = None,
+                  timeout: float = 30, size_of=None) -> List[Item]:
+        """
+        Sends items in batches of command, keeping up to in_flight batches unanswered at a time.
+        A result per item in order, status 0 or the ErrorType value, NO_REPLY for batches that got no answer.
+        """
+        in_flight = max(in_flight or self.BATCH_IN_FLIGHT, 1)
+        codec = self._codec_for(agent) if command == b"U" else None
+        groups = batches(items, size_of=size_of or (lambda item: item.size))
+        sent: List[Tuple[List[Item], Optional[Request]]] = list()
+        pending: Dict[Future, Request] = dict()
+        for group in groups:
+            while len(pending) >= in_flight:
+                done, _ = futures.wait(pending, timeout, return_when=futures.FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    del pending[future]
+            if len(pending) >= in_flight:
+                # the oldest ones timed out, the agent is gone
+                sent.append((group, None))
+                continue
+            request = RequestHandler.new(agent, b"Y")
+            with Metrics.timer("serialize.batch"):
+                source = Source.of_bytes(pack_items(group))
+            if self._send_tcp(agent, b"B", *self._encoded(command, source, codec), request=request.id):
+                pending[request.future] = request
+                sent.append((group, request))
+            else:
+                RequestHandler.cancel(request)
+                sent.append((group, None))
+        futures.wait(pending, timeout)
+        results = list()
+        for group, request in sent:
+            got = self._result(request, 0) if request is not None else None
+            if got is None or len(got) != len(group):
+                got = [Item(item.name, item.other, status=NO_REPLY) for item in group]
+            results.extend(got)
+        return results
+
+    def out_upload_many(self, agent: Agent, paths: List[Path], in_flight: Optional[int] = None) -> Dict[str, int]:
+        """
+        Small files go in batches, larger ones alone and resumable. filename -> status
+        """
+        statuses, small = dict(), list()
+        for path in paths:
+            size = file_size(path)
+            if size is None:
+                statuses[path.name] = ErrorType.GET.value
+            elif size <= self.BATCH_FILE_SIZE:
+                small.append(path)
+            else:
+                statuses[path.name] = 0 if self.out_upload(agent, path, resume=True) else ErrorType.PUT.value
+
+        def items() -> Iterable[Item]:
+            for path in small:
                 try:
-                    packet = self._padded_name + data
-                    s.sendall(packet)
-                    return True
-                except Exception as e:
-                    print(e, file=sys.stderr)
-                    return False
+                    yield Item(path.name, data=path.read_bytes())
+                except OSError:
+                    statuses[path.name] = ErrorType.GET.value
+        for result in self.out_batch(agent, b"U", items(), in_flight):
+            statuses[result.name] = result.status
+        return statuses
+
+    def out_download_many(self, agent: Agent, filenames: List[str], directory: Path,
+                          in_flight: Optional[int] = None, timeout: float = 60) -> Dict[str, int]:
+        """
+        Downloads filenames into directory. Sizes known from the agent's overview keep replies within a batch,
+        files the agent would not put in one come alone. filename -> status
+        """
+        known = self._overviews.get(agent)
+        sizes = {info.name: info.length_Byte for info in known.files} if known is not None else dict()
+        statuses = dict()
+        small = [Item(name) for name in filenames if sizes.get(name, 0) <= self.BATCH_FILE_SIZE]
+        alone = [name for name in filenames if sizes.get(name, 0) > self.BATCH_FILE_SIZE]
+        results = self.out_batch(agent, b"D", small, in_flight,
+                                 size_of=lambda item: ITEM.size + len(item.name) + sizes.get(item.name, 0))
+        for result in results:
+            if result.status == ErrorType.LARGE.value:
+                alone.append(result.name)
+            elif result.status == 0 and not FileHandler.client_file_write(directory / result.name, (result.data,)):
+                statuses[result.name] = ErrorType.DOWNLOAD.value
+            else:
+                statuses[result.name] = result.status
+        requests = [self.out_download(agent, name, directory / name) for name in alone]
+        RequestHandler.wait([request for request in requests if request is not None], timeout)
+        for name, request in zip(alone, requests):
+            result = self._result(request, 0) if request is not None else None
+            statuses[name] = 0 if result is not None else ErrorType.DOWNLOAD.value
+        return statuses
+
+    def out_rename_many(self, agent: Agent, pairs: List[Tuple[str, str]],
+                        in_flight: Optional[int] = None) -> Dict[str, int]:
+        """
+        old filename -> status
+        """
+        results = self.out_batch(agent, b"R", [Item(old, new) for old, new in pairs], in_flight)
+        return {result.name: result.status for result in results}
+
+    def out_delete_many(self, agent: Agent, filenames: List[str], in_flight: Optional[int] = None) -> Dict[str, int]:
+        results = self.out_batch(agent, b"X", [Item(name) for name in filenames], in_flight)
+        return {result.name: result.status for result in results}
+
+    def out_sync(self, agent: Agent, directory: Path, plan: SyncPlan, parallel: int = 4) -> Dict[str, int]:
+        """
+        Carries out plan, see sync.py. Small files go in batches, larger ones alone on parallel threads,
+        an update as a delta against the stored version. filename -> status
+        """
+        small, large = list(), list()
+        for name in plan.add + plan.update:
+            size = file_size(directory / name)
+            (small if size is not None and size <= self.BATCH_FILE_SIZE else large).append(name)
+        updated = set(plan.update)
+
+        def send_large(name: str) -> int:
+            path = directory / name
+            if name in updated:
+                sent = self.out_delta_upload(agent, path)
+            else:
+                sent = self.out_upload(agent, path, resume=True)
+            return 0 if sent else ErrorType.PUT.value
+        with ThreadPoolExecutor(max(parallel, 1), thread_name_prefix="sync") as pool:
+            large_statuses = pool.map(send_large, large)
+            statuses = self.out_upload_many(agent, [directory / name for name in small], parallel)
+            statuses.update(zip(large, large_statuses))
+        if plan.delete:
+            statuses.update(self.out_delete_many(agent, plan.delete, parallel))
+        return statuses
+
+    def _send_tcp(self, agent: Agent, command: bytes, name: bytes = b"", source: Source = Source(0, ()),
+                  request: int = 0) -> bool:
+        """
+        request: id to tag the frame with, 0 for none
+        """
+        return self.engine.send(agent, self.username, command, name, source, request)
 
 
 """
@@ -0,0 +1,120 @@
+import asyncio
+import io
+import tempfile
+import unittest
+from pathlib import Path
+
+from aio import AsyncBackend
+from backend import Backend
+from containers import Agent
+from filehandler import FileHandler
+from filehandler_test import use_storage
+from hashcache import ALGORITHMS
+from protocol import Head, PayloadReader
+
+CLIENT, NODE = Agent(b"client", "127.0.0.2"), Agent(b"node", "127.0.0.3")
+
+
+class Loopback:
+    """
+    An engine handing every frame straight to the other node's handlers, corrupt(command, payload) on the way.
+    """
+    def __init__(self, me: Agent):
+        self.me = me
+        self.peer: Backend = None
+        self.sent = list()
+        self.tags = list()
+        self.corrupt = lambda command, data: data
+
+    def send(self, agent: Agent, user: bytes, command: bytes, name: bytes, source, request: int = 0) -> bool:
+        data = self.corrupt(command, b"".join(bytes(chunk) for chunk in source.chunks))
+        self.sent.append(command)
+        self.tags.append(request)
+        self.peer._handle(self.me, Head(user, command, name, len(data), request),
+                          PayloadReader(io.BytesIO(data).read, len(data)))
+        return True
+
+    async def asend(self, *args, **kwargs) -> bool:
+        return self.send(*args, **kwargs)
+
+
+def node(cls, me: Agent):
+    # the state a Backend's handlers use, without its listeners and heartbeat
+    backend = cls.__new__(cls)
+    backend.debug, backend.ip, backend.bind = False, me.ip, True
+    backend.username, backend.username_str = me.name, me.name.decode()
+    backend.overviews_since_request = list()
+    backend.compression, backend.compression_level = None, None
+    backend._agent_codecs, backend._agent_hashes, backend._overviews = dict(), dict(), dict()
+    backend.engine = Loopback(me)
+    return backend
+
+
+def flip_last(command: bytes, data: bytes) -> bytes:
+    return data[:-1] + bytes([data[-1] ^ 1]) if command in (b"T", b"U") else data
+
+
+class Verified(unittest.TestCase):
+    """
+    Uploads checked against the digest of the whole file, by a node whose handlers get the frames directly.
+    """
+    def setUp(self):
+        use_storage(self, {"size": 1000 * 1000, "layout": "plain", "read_cache": 0})
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        self.path = Path(d.name) / "f.bin"
+        self.node = node(Backend, NODE)
+
+    def client(self, cls=Backend) -> Backend:
+        client = node(cls, CLIENT)
+        client._agent_hashes[NODE] = list(ALGORITHMS)
+        client.engine.peer, self.node.engine.peer = self.node, client
+        return client
+
+    def stored(self) -> bytes:
+        source = FileHandler.server_file_get("client", "f.bin")
+        return None if source is None else b"".join(bytes(chunk) for chunk in source.chunks)
+
+    def test_corrupted_delta_is_rejected(self):
+        old = bytes(range(256)) * 100
+        FileHandler.server_file_put("client", "f.bin", [old], len(old))
+        new = old + b"appended"
+        self.path.write_bytes(new)
+        client = self.client()
+        client.engine.corrupt = flip_last
+        self.assertTrue(client.out_delta_upload(NODE, self.path))
+        self.assertIn(b"T", client.engine.sent)
+        self.assertIn(b"F", self.node.engine.sent)
+        self.assertEqual(self.stored(), old)
+
+        client.engine.corrupt = lambda command, data: data
+        self.assertTrue(client.out_delta_upload(NODE, self.path))
+        self.assertEqual(self.stored(), new)
+
+    def test_corrupted_async_upload_is_rejected(self):
+        data = bytes(range(256)) * 10
+        self.path.write_bytes(data)
+        client = self.client(AsyncBackend)
+        client.engine.corrupt = flip_last
+        self.assertTrue(asyncio.run(client.out_upload_async(NODE, self.path)))
+        self.assertEqual(self.node.engine.sent, [b"F"])
+        self.assertIsNone(self.stored())
+
+        client.engine.corrupt = lambda command, data: data
+        self.assertTrue(asyncio.run(client.out_upload_async(NODE, self.path)))
+        self.assertEqual(self.stored(), data)
+
+    def test_request_tagged_before_any_overview(self):
+        FileHandler.server_file_put("client", "f.bin", [b"hello"], 5)
+        client = self.client()
+        client._agent_hashes.clear()
+        request = client.out_download(NODE, "f.bin", self.path)
+        self.assertEqual(request.future.result(0), self.path)
+        self.assertEqual(self.path.read_bytes(), b"hello")
+        self.assertEqual((client.engine.sent, client.engine.tags), ([b"D"], [request.id]))
+        self.assertEqual((self.node.engine.sent, self.node.engine.tags), ([b"P"], [request.id]))
+        self.assertNotEqual(request.id, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
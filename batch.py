@@ -0,0 +1,84 @@
+"""
+Many small operations of one kind in a single frame.
+
+A batch request is B with the command of its items as name, U, D, R or X.
+The reply is Y with the same name and an item per requested item, in order,
+status 0 for success or the ErrorType value of the failure. D results carry the file.
+
+    items   ITEM(status, name length, second name length, data length) name second_name data, repeated
+
+    U   name, data          R   old name, new name
+    D   name                X   name
+"""
+import struct
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional
+
+ITEM = struct.Struct("!BHHQ")
+# status of the items of a batch that got no reply
+NO_REPLY = 0xFF
+
+BATCH_COMMANDS = (b"U", b"D", b"R", b"X")
+# a batch stays small enough to be held in memory on both sides
+MAX_ITEMS = 512
+MAX_BYTES = 4 * 1024 * 1024
+
+
+class Item(NamedTuple):
+    name: str
+    other: str = ""
+    data: bytes = b""
+    status: int = 0
+
+    @property
+    def size(self) -> int:
+        return ITEM.size + len(self.name) + len(self.other) + len(self.data)
+
+
+def pack_items(items: Iterable[Item]) -> bytes:
+    out = bytearray()
+    for item in items:
+        name, other = item.name.encode("utf-8"), item.other.encode("utf-8")
+        out += ITEM.pack(item.status, len(name), len(other), len(item.data))
+        out += name
+        out += other
+        out += item.data
+    return bytes(out)
+
+
+def unpack_items(data: bytes) -> Optional[List[Item]]:
+    """
+    None if data is not a whole list of items.
+    """
+    items, pos, view = list(), 0, memoryview(data)
+    try:
+        while pos < len(data):
+            status, name_len, other_len, data_len = ITEM.unpack_from(data, pos)
+            pos += ITEM.size
+            end = pos + name_len + other_len + data_len
+            if end > len(data):
+                return None
+            name = bytes(view[pos:pos + name_len]).decode("utf-8")
+            other = bytes(view[pos + name_len:pos + name_len + other_len]).decode("utf-8")
+            items.append(Item(name, other, bytes(view[pos + name_len + other_len:end]), status))
+            pos = end
+    except (struct.error, UnicodeDecodeError):
+        return None
+    return items
+
+
+def batches(items: Iterable[Item], max_items: int = MAX_ITEMS, max_bytes: int = MAX_BYTES,
+            size_of: Callable[[Item], int] = lambda item: item.size) -> Iterator[List[Item]]:
+    """
+    Consecutive groups of items, each within max_items and max_bytes unless a single item is larger.
+    size_of: bytes an item adds, for downloads the size of the reply
+    """
+    group, size = list(), 0
+    for item in items:
+        item_size = size_of(item)
+        if group and (len(group) >= max_items or size + item_size > max_bytes):
+            yield group
+            group, size = list(), 0
+        group.append(item)
+        size += item_size
+    if group:
+        yield group
@@ -0,0 +1,32 @@
+import unittest
+
+from batch import ITEM, Item, batches, pack_items, unpack_items
+
+
+class BatchTest(unittest.TestCase):
+    def test_round_trip(self):
+        items = [Item("a.txt", data=b"hello"), Item("old.csv", "new.csv"), Item("ğ.bin", status=4), Item("empty")]
+        self.assertEqual(unpack_items(pack_items(items)), items)
+        self.assertEqual(unpack_items(b""), [])
+
+    def test_truncated(self):
+        data = pack_items([Item("a.txt", data=b"hello")])
+        self.assertIsNone(unpack_items(data[:-1]))
+        self.assertIsNone(unpack_items(data[:ITEM.size - 1]))
+
+    def test_batches_bounded(self):
+        items = [Item(f"{i}", data=b"x" * 100) for i in range(10)]
+        groups = list(batches(items, max_items=4, max_bytes=10000))
+        self.assertEqual([len(g) for g in groups], [4, 4, 2])
+        groups = list(batches(items, max_items=100, max_bytes=250))
+        self.assertEqual([len(g) for g in groups], [2, 2, 2, 2, 2])
+        # one item larger than a batch still goes, alone
+        groups = list(batches([Item("big", data=b"x" * 500)] + items[:1], max_bytes=250))
+        self.assertEqual([len(g) for g in groups], [1, 1])
+        # downloads are sized by what comes back
+        groups = list(batches([Item("a"), Item("b")], max_bytes=1000, size_of=lambda item: 600))
+        self.assertEqual(len(groups), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Throughput, p50/p99 latency and peak RSS of whole nodes over loopback.
+--nodes storage nodes run in processes of their own, each on a loopback address of its own
+(127.0.0.3, 127.0.0.4, ...) and in a directory of its own. A client node in this process, on 127.0.0.2,
+drives upload, overview, download, rename and delete workloads at every file size distribution and
+concurrency level, then replicate, which sends every file to all nodes at once and times it up to a majority.
+Results are written as json, --compare prints them against those of an earlier run and exits with 1
+if anything got slower by more than --tolerance percent.
+
+Needs the whole 127.0.0.0/8 routed to loopback, as Linux does.
+
+    python benchmarks/backend_bench.py --nodes 3 --sizes small,large --concurrency 1,8 --out bench.json
+    python benchmarks/backend_bench.py --compare bench-main.json --out bench.json
+"""
+import argparse
+import json
+import os
+import pickle
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# smallest and largest file, sizes are spread evenly on a log scale between them
+DISTRIBUTIONS = {
+    "small": (1 << 10, 64 << 10),
+    "medium": (256 << 10, 2 << 20),
+    "large": (4 << 20, 16 << 20),
+    "mixed": (1 << 10, 16 << 20),
+}
+WORKLOADS = ("upload", "overview", "download", "rename", "delete", "replicate")
+CLIENT_IP = "127.0.0.2"
+
+
+def serve(args) -> None:
+    # storage, store.txt and the caches are all relative to the working directory, set before the import
+    os.chdir(args.serve)
+    from aio import AsyncBackend
+    from backend import Backend
+    (AsyncBackend if args.engine == "asyncio" else Backend)(args.name, False, port=args.port, ip=args.ip, compression=None if args.compress == "none" else args.compress)
+    print("ready", flush=True)
+    sys.stdout = open(os.devnull, "w")
+    # until the benchmark closes our stdin, or goes away
+    sys.stdin.read()
+    os._exit(0)
+
+
+def prepare(directory: Path, quota: int, args) -> Path:
+    directory.mkdir(parents=True)
+    store = {"size": quota, "durability": args.durability, "layout": args.layout}
+    if args.commit_window is not None:
+        store["commit_window"] = args.commit_window / 1000
+    with (directory / "store.txt").open("wb") as f:
+        pickle.dump(store, f)
+    return directory
+
+
+def start_node(directory: Path, name: str, ip: str, args) -> subprocess.Popen:
+    node = subprocess.Popen([sys.executable, __file__, "--serve", str(directory), "--name", name, "--ip", ip,
+                             "--port", str(args.port), "--compress", args.compress, "--engine", args.engine],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    if node.stdout.readline().strip() != b"ready":
+        node.kill()
+        sys.exit(f"{name} on {ip}:{args.port} did not start")
+    return node
+
+
+def rss_reset(pid: int) -> None:
+    # peak RSS starts over from the current one, Linux only
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def rss_peak(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if pid == os.getpid():
+        # since the start, KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+def file_sizes(distribution: str, files: int, budget: int, rng: random.Random) -> List[int]:
+    low, high = DISTRIBUTIONS[distribution]
+    sizes, total = list(), 0
+    while len(sizes) < files and total < budget:
+        size = int(low * (high / low) ** rng.random())
+        sizes.append(size)
+        total += size
+    return sizes
+
+
+def percentile(latencies: List[float], q: float) -> float:
+    if not latencies:
+        return 0.0
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def timed(ops: List[Callable[[], bool]], concurrency: int) -> Tuple[float, List[float], int]:
+    """
+    Runs ops on concurrency threads. Wall seconds, the latency of each op and how many failed.
+    """
+    def run(op: Callable[[], bool]) -> Tuple[float, bool]:
+        start = time.perf_counter()
+        try:
+            ok = op()
+        except Exception as e:
+            print(e, file=sys.stderr)
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(run, ops))
+    return time.perf_counter() - start, [latency for latency, _ in results], sum(not ok for _, ok in results)
+
+
+def listed(client, agent, expected: Dict[str, int], timeout: float) -> bool:
+    # uploads return once sent, a node has them when its overview lists them whole
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        overview = client.fetch_overview(agent, full=True, timeout=max(deadline - time.monotonic(), 0.1))
+        if overview is not None:
+            have = {info.name: info.length_Byte for info in overview.files}
+            if all(have.get(name) == size for name, size in expected.items()):
+                return True
+        time.sleep(0.05)
+    return False
+
+
+def run_round(client, agents, pids: List[int], distribution: str, concurrency: int, work: Path,
+              args, rng: random.Random) -> List[Dict]:
+    """
+    Every workload once over a fresh set of files spread across agents, which leaves the nodes empty again.
+    """
+    sizes = file_sizes(distribution, args.files, args.mb << 20, rng)
+    data, downloads = work / "data", work / "downloads"
+    for directory in (data, downloads):
+        shutil.rmtree(directory, ignore_errors=True)
+        directory.mkdir(parents=True)
+    placed: List[Tuple[object, str, Path]] = list()
+    for i, size in enumerate(sizes):
+        path = data / f"f{i:05}.bin"
+        path.write_bytes(rng.randbytes(size))
+        placed.append((agents[i % len(agents)], path.name, path))
+    total = sum(sizes)
+
+    def ok(statuses: Dict[str, int]) -> bool:
+        return bool(statuses) and all(status == 0 for status in statuses.values())
+
+    replications = list()
+
+    def replicate(path: Path) -> bool:
+        replication = client.out_replicate(agents, path, filename=path.name.encode() + b".replica")
+        replications.append(replication)
+        return replication is not None and replication.quorum_seconds is not None
+
+    ops = {
+        "upload": [lambda a=a, p=p: ok(client.out_upload_many(a, [p])) for a, _, p in placed],
+        "overview": [lambda a=agents[i % len(agents)]: client.fetch_overview(a, full=True) is not None
+                     for i in range(len(placed))],
+        "download": [lambda a=a, n=n: ok(client.out_download_many(a, [n], downloads)) for a, n, _ in placed],
+        "rename": [lambda a=a, n=n: ok(client.out_rename_many(a, [(n, n + ".renamed")])) for a, n, _ in placed],
+        "delete": [lambda a=a, n=n: ok(client.out_delete_many(a, [n + ".renamed"])) for a, n, _ in placed],
+        "replicate": [lambda p=p: replicate(p) for _, _, p in placed],
+    }
+    moved = {"upload": total, "download": total, "replicate": total * len(agents)}
+    results = list()
+    for workload in WORKLOADS:
+        for pid in pids:
+            rss_reset(pid)
+        seconds, latencies, errors = timed(ops[workload], concurrency)
+        if workload == "upload":
+            start = time.perf_counter()
+            for agent in agents:
+                expected = {name: path.stat().st_size for a, name, path in placed if a == agent}
+                if not listed(client, agent, expected, args.timeout):
+                    print(f"{agent} does not list all uploads after {args.timeout} s", file=sys.stderr)
+                    errors += 1
+            seconds += time.perf_counter() - start
+        elif workload == "replicate":
+            # the replicas past the quorum are not timed, the nodes are left empty for the next round
+            for replication in replications:
+                if replication is not None:
+                    replication.wait()
+            for agent in agents:
+                client.out_delete_many(agent, [name + ".replica" for _, name, _ in placed])
+        elif workload == "download":
+            errors += sum(not (downloads / name).is_file() or (downloads / name).stat().st_size != path.stat().st_size
+                          for _, name, path in placed)
+        rss = [rss_peak(pid) for pid in pids]
+        results.append({
+            "workload": workload, "sizes": distribution, "concurrency": concurrency,
+            "ops": len(latencies), "errors": errors, "bytes": moved.get(workload, 0),
+            "seconds": round(seconds, 4),
+            "ops_per_s": round(len(latencies) / seconds, 1) if seconds else 0.0,
+            "mb_per_s": round(moved.get(workload, 0) / 1e6 / seconds, 2) if seconds else 0.0,
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+            "rss_mb_client": round(rss[0] / 1e6, 1) if rss[0] is not None else None,
+            "rss_mb_nodes": round(max(rss[1:]) / 1e6, 1) if None not in rss[1:] else None,
+        })
+    return results
+
+
+def print_header() -> None:
+    print(f"{'workload':<10}{'sizes':<8}{'conc':>5}{'ops':>7}{'err':>5}{'ops/s':>10}{'MB/s':>9}"
+          f"{'p50 ms':>9}{'p99 ms':>9}{'RSS MB':>8}{'nodes':>7}")
+
+
+def print_results(results: List[Dict]) -> None:
+    for r in results:
+        print(f"{r['workload']:<10}{r['sizes']:<8}{r['concurrency']:>5}{r['ops']:>7}{r['errors']:>5}"
+              f"{r['ops_per_s']:>10.1f}{r['mb_per_s']:>9.1f}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+              f"{r['rss_mb_client'] or 0:>8.0f}{r['rss_mb_nodes'] or 0:>7.0f}")
+
+
+def compare(old: Dict, new: Dict, tolerance: float) -> bool:
+    """
+    Prints the change of each result found in both runs, False if any got worse by more than tolerance percent.
+    """
+    def key(r: Dict) -> Tuple[str, str, int]:
+        return r["workload"], r["sizes"], r["concurrency"]
+
+    def change(before: float, after: float) -> float:
+        return (after - before) / before * 100 if before else 0.0
+
+    before = {key(r): r for r in old["results"]}
+    print(f"\nagainst {old.get('commit') or 'an earlier run'} of {old.get('date', '?')}")
+    print(f"{'workload':<10}{'sizes':<8}{'conc':>5}{'ops/s':>10}{'p99 ms':>10}")
+    good = True
+    for r in new["results"]:
+        b = before.get(key(r))
+        if b is None:
+            continue
+        speed, tail = change(b["ops_per_s"], r["ops_per_s"]), change(b["p99_ms"], r["p99_ms"])
+        worse = speed < -tolerance or tail > tolerance
+        good = good and not worse
+        print(f"{r['workload']:<10}{r['sizes']:<8}{r['concurrency']:>5}{speed:>+9.1f}%{tail:>+9.1f}%"
+              f"{'  slower' if worse else ''}")
+    return good
+
+
+def commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=2, help="storage nodes besides the client")
+    parser.add_argument("--port", type=int, default=18888, help="every node listens on it, at its own address")
+    parser.add_argument("--sizes", default="small,medium,large", help=f"of {', '.join(DISTRIBUTIONS)}")
+    parser.add_argument("--concurrency", default="1,8", help="operations in flight, one run per level")
+    parser.add_argument("--files", type=int, default=200, help="files per run, fewer if --mb is reached first")
+    parser.add_argument("--mb", type=int, default=256, help="MB of files per run at most")
+    parser.add_argument("--compress", choices=("zlib", "lzma", "bz2", "none"), default="zlib")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded", help="of every node")
+    parser.add_argument("--layout", choices=("plain", "chunked", "packed"), default="plain", help="of the nodes")
+    parser.add_argument("--durability", choices=("none", "group", "always"), default="group")
+    parser.add_argument("--commit-window", type=float, help="milliseconds, the nodes' default if not given")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds for the nodes to list an upload")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=Path, help="json results, to --compare a later run against")
+    parser.add_argument("--compare", type=Path, help="json results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=10, help="percent slower that counts as a regression")
+    parser.add_argument("--dir", type=Path, help="for the nodes' storage, a temporary one is removed afterwards")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    parser.add_argument("--name", help=argparse.SUPPRESS)
+    parser.add_argument("--ip", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    # this process moves into the client's directory
+    for path in ("out", "compare", "dir"):
+        if getattr(args, path) is not None:
+            setattr(args, path, getattr(args, path).resolve())
+    if args.serve:
+        serve(args)
+
+    distributions = args.sizes.split(",")
+    for distribution in distributions:
+        if distribution not in DISTRIBUTIONS:
+            parser.error(f"no size distribution {distribution}, there are {', '.join(DISTRIBUTIONS)}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+    base = Path(tempfile.mkdtemp(prefix="backend-bench-")) if args.dir is None else args.dir
+    quota = (args.mb << 20) * 4
+    names = [f"node{i + 1}" for i in range(args.nodes)]
+    ips = [f"127.0.0.{i + 3}" for i in range(args.nodes)]
+    nodes = [start_node(prepare(base / name, quota, args), name, ip, args) for name, ip in zip(names, ips)]
+    results = list()
+    try:
+        os.chdir(prepare(base / "client", quota, args))
+        from aio import AsyncBackend
+        from backend import Backend
+        from containers import Agent
+        with open(os.devnull, "w") as quiet, redirect_stdout(quiet):
+            client = (AsyncBackend if args.engine == "asyncio" else Backend)("bench", False, port=args.port, ip=CLIENT_IP,
+                             compression=None if args.compress == "none" else args.compress)
+            agents = [Agent(name.encode("ascii"), ip) for name, ip in zip(names, ips)]
+            missing = [agent for agent in agents if client.fetch_overview(agent, full=True, timeout=10) is None]
+        if missing:
+            print(f"{', '.join(map(str, missing))} do not answer", file=sys.stderr)
+            return 1
+        rng = random.Random(args.seed)
+        pids = [os.getpid()] + [node.pid for node in nodes]
+        print_header()
+        for distribution in distributions:
+            for level in levels:
+                with open(os.devnull, "w") as quiet, redirect_stdout(quiet):
+                    round_results = run_round(client, agents, pids, distribution, level, base / "client", args, rng)
+                print_results(round_results)
+                results.extend(round_results)
+    finally:
+        for node in nodes:
+            node.stdin.close()
+        for node in nodes:
+            try:
+                node.wait(5)
+            except subprocess.TimeoutExpired:
+                node.kill()
+        if args.dir is None:
+            shutil.rmtree(base, ignore_errors=True)
+
+    run = {"commit": commit(), "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+           "python": platform.python_version(), "platform": platform.platform(),
+           "args": {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()
+                    if k not in ("serve", "name", "ip")},
+           "results": results}
+    if args.out is not None:
+        args.out.write_text(json.dumps(run, indent=1))
+    if args.compare is not None and not compare(json.loads(args.compare.read_text()), run, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    status = main()
+    sys.stdout.flush()
+    # the client node's exit hooks would write into its directory, gone by now
+    os._exit(status)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Bytes on the wire and CPU time of delta uploads for synthetic edits of one file,
+against sending the whole file.
+
+    python benchmarks/delta_bench.py --size-mb 64
+"""
+import argparse
+import io
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from delta import DELTA_HEAD, DeltaChunks, Signatures, apply_delta, compute_delta, delta_length, signatures_of
+
+
+def edits(old: bytes, rng: random.Random):
+    n = len(old)
+    mid = n // 2
+    yield "unchanged", old
+    yield "overwrite 16 B", old[:mid] + b"x" * 16 + old[mid + 16:]
+    yield "insert 100 B", old[:mid] + rng.randbytes(100) + old[mid:]
+    yield "delete 4 KiB", old[:mid] + old[mid + 4096:]
+    yield "append 1 MiB", old + rng.randbytes(1 << 20)
+    scattered = bytearray(old)
+    for _ in range(100):
+        at = rng.randrange(n - 8)
+        scattered[at:at + 8] = rng.randbytes(8)
+    yield "100 scattered edits", bytes(scattered)
+    yield "1% rewritten", old[:mid] + rng.randbytes(n // 100) + old[mid + n // 100:]
+    yield "all rewritten", rng.randbytes(n)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    old = rng.randbytes(args.size_mb << 20)
+    start = time.perf_counter()
+    sigs = Signatures.from_bytes(signatures_of([old], len(old)).to_bytes())
+    sig_time = time.perf_counter() - start
+    sig_bytes = len(sigs.to_bytes())
+    print(f"{len(old) >> 20} MiB, block {sigs.block_size} B, signatures {sig_bytes} B in {sig_time:.2f} s\n")
+    print(f"{'edit':<22}{'full B':>12}{'delta B':>12}{'wire %':>9}{'delta s':>9}{'apply s':>9}")
+    for label, new in edits(old, rng):
+        start = time.perf_counter()
+        ops = compute_delta(new, sigs)
+        delta_time = time.perf_counter() - start
+        encoded = b"".join(DeltaChunks(new, ops, sigs.block_size))
+        assert len(encoded) == delta_length(ops)
+
+        start = time.perf_counter()
+        reader = io.BytesIO(encoded)
+        size, block_size = DELTA_HEAD.unpack(reader.read(DELTA_HEAD.size))
+        rebuilt = b"".join(apply_delta(reader.read, lambda offset, length: old[offset:offset + length],
+                                       size, block_size))
+        apply_time = time.perf_counter() - start
+        assert rebuilt == new, label
+
+        wire = sig_bytes + len(encoded)
+        print(f"{label:<22}{len(new):>12}{wire:>12}{100 * wire / len(new):>8.2f}%{delta_time:>9.2f}{apply_time:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Encode and decode time and size of an Overview: the json/cattrs path against the binary one,
+and the size of a delta after a few changes.
+
+    python benchmarks/overview_bench.py --files 50000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from containers import FileInfo, Overview
+
+
+def timed(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    files = [FileInfo(f"logs/2020-01-{i % 31:02}/node-{i}.csv", i * 37) for i in range(args.files)]
+    overview = Overview("egemen", 10 ** 12, 10 ** 11, files, ["zlib"], 1, 2, 0, [])
+    bjson, binary = overview.to_bjson(), overview.to_bin()
+    assert Overview.from_wire(binary) == overview
+
+    print(f"{args.files} files")
+    print(f"{'':8} {'bytes':>10} {'encode ms':>10} {'decode ms':>10}")
+    print(f"{'json':8} {len(bjson):10} {timed(overview.to_bjson, args.repeat) * 1e3:10.1f} "
+          f"{timed(lambda: Overview.from_bjson(bjson), args.repeat) * 1e3:10.1f}")
+    print(f"{'binary':8} {len(binary):10} {timed(overview.to_bin, args.repeat) * 1e3:10.1f} "
+          f"{timed(lambda: Overview.from_wire(binary), args.repeat) * 1e3:10.1f}")
+    delta = Overview("egemen", 10 ** 12, 10 ** 11, files[:10], ["zlib"], 1, 3, 2, ["logs/old.csv"])
+    print(f"{'delta':8} {len(delta.to_bin()):10}   10 changed, 1 removed")
+
+
+if __name__ == '__main__':
+    main()
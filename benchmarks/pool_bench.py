@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Messages/sec of small control messages over loopback:
+connect-per-message (the old Backend._send_tcp) against the persistent ConnectionPool.
+
+    python benchmarks/pool_bench.py --messages 5000
+"""
+import argparse
+import socket
+import sys
+import time
+from pathlib import Path
+from threading import Condition, Thread
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from connections import ConnectionPool
+from containers import Agent
+from protocol import Source, send_frame
+
+
+class Counter:
+    def __init__(self):
+        self.n = 0
+        self.cond = Condition()
+
+    def on_frame(self, head, payload, ip):
+        payload.drain()
+        with self.cond:
+            self.n += 1
+            self.cond.notify_all()
+
+    def wait_for(self, n: int):
+        with self.cond:
+            self.cond.wait_for(lambda: self.n >= n)
+
+
+def serve(port: int, counter: Counter) -> None:
+    pool = ConnectionPool(port, counter.on_frame)
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(("127.0.0.1", port))
+    s.listen(128)
+
+    def accept():
+        while True:
+            conn, addr = s.accept()
+            pool.adopt(conn, addr[0])
+    Thread(target=accept, daemon=True).start()
+
+
+def send_connect_per_message(port: int, command: bytes, name: bytes, source: Source) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(2)
+        s.connect(("127.0.0.1", port))
+        send_frame(s.sendall, b"bench", command, name, source)
+    return True
+
+
+def run(label: str, send, counter: Counter, messages: int) -> None:
+    start_count = counter.n
+    start = time.perf_counter()
+    for i in range(messages):
+        send(b"R", b"old_%d.txt" % i, Source.of_bytes(b"new_%d.txt" % i))
+    counter.wait_for(start_count + messages)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {messages / elapsed:>10.0f} msg/s   ({elapsed:.2f} s)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=3000)
+    parser.add_argument("--port", type=int, default=18888)
+    args = parser.parse_args()
+
+    counter = Counter()
+    serve(args.port, counter)
+    run("connect per message", lambda *m: send_connect_per_message(args.port, *m), counter, args.messages)
+
+    client = ConnectionPool(args.port, lambda head, payload, ip: None)
+    agent = Agent(name=b"bench", ip="127.0.0.1")
+    run("connection pool", lambda *m: client.send(agent, b"bench", *m), counter, args.messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+CPU seconds per GB moved over loopback TCP, sender and receiver both in this process:
+chunks read into bytes and sent with sendall, received as new bytes per recv,
+against socket.sendfile and recv_into a reused buffer.
+
+    python benchmarks/sendfile_bench.py --size-mb 512
+"""
+import argparse
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+from threading import Thread
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from connections import RECV_BUFFER
+from protocol import PayloadReader, file_source, read_head, send_frame
+
+
+def cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(label: str, path: Path, zero_copy: bool, sink: str) -> None:
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    sender = socket.create_connection(listener.getsockname())
+    receiver, _ = listener.accept()
+    listener.close()
+    source = file_source(path)
+
+    def send():
+        send_frame(sender.sendall, b"bench", b"P", b"file", source, sender.sendfile if zero_copy else None)
+    start_cpu, start = cpu(), time.perf_counter()
+    t = Thread(target=send)
+    t.start()
+    with open(sink, "wb") as out:
+        head = read_head(receiver.recv)
+        if zero_copy:
+            chunks = PayloadReader(receiver.recv, head.length, receiver.recv_into, bytearray(RECV_BUFFER)).views()
+        else:
+            chunks = PayloadReader(receiver.recv, head.length)
+        for chunk in chunks:
+            out.write(chunk)
+    t.join()
+    seconds, cpu_seconds = time.perf_counter() - start, cpu() - start_cpu
+    sender.close()
+    receiver.close()
+    gb = source.length / 1e9
+    print(f"{label:10} {source.length / 1e6 / seconds:8.0f} MB/s   {cpu_seconds / gb:6.2f} CPU s/GB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--sink", default=os.devnull, help="Where the receiver writes, a file to include disk writes.")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as d:
+        path = Path(d) / "payload"
+        with path.open("wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        run("chunks", path, zero_copy=False, sink=args.sink)
+        run("zero-copy", path, zero_copy=True, sink=args.sink)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+"""
+Optional storage layout: files are cut into content-defined chunks and every chunk is stored once.
+
+    storage/.chunks/ab/abcdef...    chunk, named by its sha256
+    storage/.manifests/<user>/<filename>.json
+                                    {"size": 123, "chunks": [["abcdef...", 100], ["012345...", 23]]}
+
+Reference counts are not stored, they are rebuilt from the manifests when the store is opened.
+A put's new chunks and its manifest are synced before the manifest takes the filename, see durable.py.
+"""
+import bisect
+import hashlib
+import json
+import os
+import random
+import threading
+from pathlib import Path
+from threading import RLock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from containers import FileInfo
+from durable import GroupCommit
+from protocol import Source
+
+
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+# cut when the low 16 bits of the gear hash are zero, about every 64 KiB past MIN_CHUNK
+CUT_MASK = (1 << 16) - 1
+MASK64 = (1 << 64) - 1
+
+_rng = random.Random(0x5eed)
+GEAR = [_rng.getrandbits(64) for _ in range(256)]
+
+Manifest = List[Tuple[str, int]]
+
+
+def split_chunks(pieces: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Content-defined chunking with a gear rolling hash.
+    Equal runs of data give equal chunks wherever they are in a file, so an insert only changes nearby chunks.
+    """
+    buf = bytearray()
+    h = 0
+    for piece in pieces:
+        i = 0
+        n = len(piece)
+        while i < n:
+            if len(buf) < MIN_CHUNK:
+                take = min(MIN_CHUNK - len(buf), n - i)
+                buf += piece[i:i + take]
+                i += take
+                continue
+            limit = min(n, i + MAX_CHUNK - len(buf))
+            j = i
+            cut = False
+            while j < limit:
+                h = ((h << 1) + GEAR[piece[j]]) & MASK64
+                j += 1
+                if not h & CUT_MASK:
+                    cut = True
+                    break
+            buf += piece[i:j]
+            i = j
+            if cut or len(buf) >= MAX_CHUNK:
+                yield bytes(buf)
+                buf = bytearray()
+                h = 0
+    if buf:
+        yield bytes(buf)
+
+
+class ManifestChunks:
+    def __init__(self, store: "ChunkStore", manifest: Manifest, offset: int = 0, length: Optional[int] = None):
+        self.store = store
+        self.manifest = manifest
+        self.offset = offset
+        self.end = offset + length if length is not None else None
+
+    def __iter__(self) -> Iterator[bytes]:
+        position = 0
+        for digest, size in self.manifest:
+            start, position = position, position + size
+            if position <= self.offset:
+                continue
+            if self.end is not None and start >= self.end:
+                break
+            with self.store.chunk_path(digest).open("rb") as f:
+                data = f.read()
+            end = size if self.end is None else min(size, self.end - start)
+            yield data[max(self.offset - start, 0):end]
+
+
+class ChunkRanges:
+    """
+    Random access into a chunked file, keeps the last chunk read since reads are mostly sequential.
+    """
+    def __init__(self, store: "ChunkStore", manifest: Manifest):
+        self.store = store
+        self.manifest = manifest
+        self.starts: List[int] = list()
+        offset = 0
+        for digest, size in manifest:
+            self.starts.append(offset)
+            offset += size
+        self.size = offset
+        self._cached: Tuple[int, bytes] = (-1, b"")
+
+    def _chunk(self, index: int) -> bytes:
+        if self._cached[0] != index:
+            with self.store.chunk_path(self.manifest[index][0]).open("rb") as f:
+                self._cached = (index, f.read())
+        return self._cached[1]
+
+    def read_range(self, offset: int, length: int) -> bytes:
+        parts = list()
+        end = min(offset + length, self.size)
+        index = bisect.bisect_right(self.starts, offset) - 1
+        while offset < end and index < len(self.manifest):
+            chunk = self._chunk(index)
+            start = self.starts[index]
+            part = chunk[offset - start:end - start]
+            parts.append(part)
+            offset += len(part)
+            index += 1
+        return b"".join(parts)
+
+    def close(self) -> None:
+        self._cached = (-1, b"")
+
+
+class ChunkStore:
+    def __init__(self, root: Path, committer: Optional[GroupCommit] = None):
+        self.root = root
+        self.committer = committer if committer is not None else GroupCommit("none")
+        self.chunk_dir = root / ".chunks"
+        self.manifest_dir = root / ".manifests"
+        self.chunk_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = RLock()
+        self._refs: Dict[str, int] = dict()
+        self._chunk_sizes: Dict[str, int] = dict()
+        self._logical: Dict[str, int] = dict()
+        self._load()
+
+    def _load(self) -> None:
+        for user_dir in self.manifest_dir.iterdir():
+            if not user_dir.is_dir():
+                continue
+            used = 0
+            # manifests of puts that never completed
+            for path in user_dir.glob("*.tmp"):
+                path.unlink()
+            for path in user_dir.glob("*.json"):
+                manifest, size = self._read_manifest(path)
+                used += size
+                for digest, chunk_size in manifest:
+                    self._incref(digest, chunk_size)
+            self._logical[user_dir.name] = used
+        # chunks nobody refers to are left overs of an interrupted put
+        for sub in self.chunk_dir.iterdir():
+            for path in sub.iterdir():
+                if path.name not in self._refs:
+                    path.unlink()
+
+    def chunk_path(self, digest: str) -> Path:
+        return self.chunk_dir / digest[:2] / digest
+
+    def _manifest_path(self, user: str, filename: str) -> Path:
+        return self.manifest_dir / user / (filename + ".json")
+
+    @staticmethod
+    def _read_manifest(path: Path) -> Tuple[Manifest, int]:
+        with path.open("r") as f:
+            d = json.load(f)
+        return [(digest, size) for digest, size in d["chunks"]], d["size"]
+
+    @staticmethod
+    def _write_manifest(path: Path, manifest: Manifest, size: int) -> Path:
+        # under a temporary name, the caller moves it into place
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        with tmp.open("w") as f:
+            json.dump({"size": size, "chunks": manifest}, f)
+        return tmp
+
+    def _incref(self, digest: str, size: int) -> None:
+        self._refs[digest] = self._refs.get(digest, 0) + 1
+        self._chunk_sizes[digest] = size
+
+    def _decref(self, manifest: Manifest) -> None:
+        for digest, size in manifest:
+            self._refs[digest] -= 1
+            if self._refs[digest] == 0:
+                del self._refs[digest]
+                del self._chunk_sizes[digest]
+                try:
+                    self.chunk_path(digest).unlink()
+                except OSError:
+                    pass
+
+    def _store_chunk(self, data: bytes, written: List[Path]) -> Tuple[str, int]:
+        # written: gets the path of the chunk if it was not stored yet
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            # referenced right away, so a concurrent delete can't remove it under us
+            known = digest in self._refs
+            self._incref(digest, len(data))
+        path = self.chunk_path(digest)
+        if not known or not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            tmp = path.with_name(f"{digest}.{threading.get_ident()}.tmp")
+            with tmp.open("wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            written.append(path)
+        return digest, len(data)
+
+    def size(self, user: str, filename: str) -> Optional[int]:
+        try:
+            return self._read_manifest(self._manifest_path(user, filename))[1]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, user: str, filename: str, pieces: Iterable[bytes]) -> int:
+        manifest: Manifest = list()
+        size = 0
+        written: List[Path] = list()
+        path = self._manifest_path(user, filename)
+        tmp = None
+        try:
+            for chunk in split_chunks(pieces):
+                manifest.append(self._store_chunk(chunk, written))
+                size += len(chunk)
+            tmp = self._write_manifest(path, manifest, size)
+            self.committer.sync(written + [tmp], {chunk.parent for chunk in written})
+        except BaseException:
+            with self._lock:
+                self._decref(manifest)
+            if tmp is not None and tmp.exists():
+                tmp.unlink()
+            raise
+        with self._lock:
+            try:
+                old, old_size = self._read_manifest(path)
+            except (OSError, ValueError, KeyError):
+                old, old_size = list(), 0
+            os.replace(tmp, path)
+            self._decref(old)
+            self._logical[user] = self._logical.get(user, 0) + size - old_size
+        self.committer.sync(dirs=(path.parent,))
+        return size
+
+    def get(self, user: str, filename: str) -> Optional[Source]:
+        try:
+            manifest, size = self._read_manifest(self._manifest_path(user, filename))
+        except (OSError, ValueError, KeyError):
+            return None
+        return Source(size, ManifestChunks(self, manifest))
+
+    def get_range(self, user: str, filename: str, offset: int, length: int) -> Optional[Tuple[int, Source]]:
+        """
+        (file size, source of the range), length 0 means up to the end
+        """
+        try:
+            manifest, size = self._read_manifest(self._manifest_path(user, filename))
+        except (OSError, ValueError, KeyError):
+            return None
+        offset = min(offset, size)
+        length = size - offset if length == 0 else min(length, size - offset)
+        return size, Source(length, ManifestChunks(self, manifest, offset, length))
+
+    def open_ranges(self, user: str, filename: str) -> Optional["ChunkRanges"]:
+        try:
+            manifest, size = self._read_manifest(self._manifest_path(user, filename))
+        except (OSError, ValueError, KeyError):
+            return None
+        return ChunkRanges(self, manifest)
+
+    def delete(self, user: str, filename: str) -> bool:
+        path = self._manifest_path(user, filename)
+        with self._lock:
+            try:
+                manifest, size = self._read_manifest(path)
+            except (OSError, ValueError, KeyError):
+                return False
+            path.unlink()
+            self._decref(manifest)
+            self._logical[user] = self._logical.get(user, 0) - size
+        return True
+
+    def rename(self, user: str, filename_old: str, filename_new: str) -> bool:
+        path_old = self._manifest_path(user, filename_old)
+        path_new = self._manifest_path(user, filename_new)
+        with self._lock:
+            if not path_old.is_file():
+                return False
+            if path_old == path_new:
+                return True
+            try:
+                replaced, replaced_size = self._read_manifest(path_new)
+            except (OSError, ValueError, KeyError):
+                replaced, replaced_size = list(), 0
+            os.replace(path_old, path_new)
+            self._decref(replaced)
+            self._logical[user] = self._logical.get(user, 0) - replaced_size
+        self.committer.sync(dirs=(path_new.parent,))
+        return True
+
+    def mtime(self, user: str, filename: str) -> Optional[float]:
+        try:
+            return self._manifest_path(user, filename).stat().st_mtime
+        except OSError:
+            return None
+
+    def users(self) -> List[str]:
+        return [path.name for path in self.manifest_dir.iterdir() if path.is_dir()] if self.manifest_dir.is_dir() else []
+
+    def files(self, user: str) -> List[FileInfo]:
+        user_dir = self.manifest_dir / user
+        if not user_dir.is_dir():
+            return list()
+        return [FileInfo(path.name[:-len(".json")], self._read_manifest(path)[1])
+                for path in user_dir.glob("*.json")]
+
+    def usage(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._logical)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            logical = sum(self._logical.values())
+            physical = sum(self._chunk_sizes.values())
+            return {
+                "logical_bytes": logical,
+                "physical_bytes": physical,
+                "chunks": len(self._chunk_sizes),
+                "dedup_ratio": round(logical / physical, 3) if physical else 1.0,
+            }
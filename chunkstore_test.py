@@ -0,0 +1,40 @@
+import random
+import tempfile
+import unittest
+from pathlib import Path
+
+from chunkstore import *
+
+
+class Chunking(unittest.TestCase):
+    def test_insert_keeps_most_chunks(self):
+        data = random.Random(1).randbytes(1_000_000)
+        edited = data[:500_000] + b"inserted" + data[500_000:]
+        a = set(split_chunks([data]))
+        b = list(split_chunks([edited[i:i + 4096] for i in range(0, len(edited), 4096)]))
+        self.assertEqual(b"".join(b), edited)
+        self.assertGreater(len(a.intersection(b)), len(a) - 3)
+
+
+class Store(unittest.TestCase):
+    def test_dedup_and_refcount(self):
+        data = random.Random(2).randbytes(300_000)
+        with tempfile.TemporaryDirectory() as d:
+            store = ChunkStore(Path(d))
+            store.put("bekir", "a", [data])
+            store.put("egemen", "b", [data])
+            self.assertAlmostEqual(store.stats()["dedup_ratio"], 2.0)
+            self.assertTrue(store.rename("egemen", "b", "c"))
+            self.assertTrue(store.delete("bekir", "a"))
+            self.assertEqual(b"".join(store.get("egemen", "c").chunks), data)
+            self.assertTrue(store.delete("egemen", "c"))
+            self.assertEqual(store.stats()["physical_bytes"], 0)
+            self.assertEqual(list(store.chunk_dir.glob("*/*")), [])
+
+            store.put("bekir", "a", [data])
+            reopened = ChunkStore(Path(d))
+            self.assertEqual(reopened.usage(), {"bekir": len(data), "egemen": 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
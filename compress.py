@@ -0,0 +1,148 @@
+"""
+Payload compression for U and P frames.
+
+A compressed payload is marked in the frame name after the filename and its range, see protocol.py:
+    name\0[RANGE]CODEC(codec id, decoded length)
+Uploads are compressed for agents whose overview lists the codec, downloads when the D request
+names a codec the requester accepts. Whatever is stored or written is the decoded payload.
+"""
+import bz2
+import tempfile
+import zlib
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from protocol import CHUNK_SIZE, Source
+
+try:
+    import lzma
+except ImportError:  # Python built without liblzma
+    lzma = None
+
+# codec name -> id on the wire
+IDS: Dict[str, bytes] = {"zlib": b"z", "bz2": b"b"}
+if lzma is not None:
+    IDS["lzma"] = b"x"
+NAMES: Dict[bytes, str] = {v: k for k, v in IDS.items()}
+
+# smaller payloads are not worth a compressor
+MIN_LENGTH = 4 * 1024
+# a first chunk compressing worse than this is media or an archive, it is sent as it is
+MAX_RATIO = 0.9
+# compressed payloads up to this size stay in memory, bigger ones go to a temporary file
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def available() -> List[str]:
+    return sorted(IDS)
+
+
+def _compressor(codec: str, level: int):
+    if codec == "zlib":
+        return zlib.compressobj(level)
+    if codec == "bz2":
+        return bz2.BZ2Compressor(max(1, level))
+    return lzma.LZMACompressor(preset=level)
+
+
+def _decompressor(codec: str):
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "bz2":
+        return bz2.BZ2Decompressor()
+    return lzma.LZMADecompressor()
+
+
+def worth_it(sample: bytes, codec: str, level: int) -> bool:
+    if not sample:
+        return False
+    c = _compressor(codec, level)
+    return len(c.compress(sample) + c.flush()) < len(sample) * MAX_RATIO
+
+
+class SpooledChunks:
+    """
+    Re-iterable chunks of a spooled temporary file, so a compressed send can be retried
+    or go to several agents at the same time.
+    """
+    def __init__(self, spool):
+        self.spool = spool
+        self._lock = Lock()
+
+    def __iter__(self) -> Iterator[bytes]:
+        position = 0
+        while True:
+            with self._lock:
+                self.spool.seek(position)
+                chunk = self.spool.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            position += len(chunk)
+            yield chunk
+
+
+def compress_source(source: Source, codec: str, level: int) -> Optional[Source]:
+    """
+    The compressed source, None when the first chunk shows it won't shrink.
+    The frame length has to be known up front, so the whole payload is compressed before sending.
+    """
+    if source.length < MIN_LENGTH:
+        return None
+    chunks = iter(source.chunks)
+    first = next(chunks, b"")
+    if not worth_it(first, codec, level):
+        return None
+    c = _compressor(codec, level)
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    spool.write(c.compress(first))
+    for chunk in chunks:
+        spool.write(c.compress(chunk))
+    spool.write(c.flush())
+    length = spool.tell()
+    if length >= source.length * MAX_RATIO:
+        spool.close()
+        return None
+    return Source(length, SpooledChunks(spool))
+
+
+def _drain(d, codec: str, chunk: bytes) -> Iterator[bytes]:
+    # bounded output per call, a small payload can't expand into something huge in memory
+    data = d.decompress(chunk, CHUNK_SIZE)
+    while data:
+        yield data
+        if codec == "zlib":
+            data = d.decompress(d.unconsumed_tail, CHUNK_SIZE)
+        else:
+            data = d.decompress(b"", CHUNK_SIZE) if not d.needs_input and not d.eof else b""
+
+
+def decompress_chunks(chunks: Iterable[bytes], codec: str, length: int) -> Iterator[bytes]:
+    """
+    Decodes while the payload streams in, output is bounded by the announced decoded length.
+    """
+    d = _decompressor(codec)
+    produced = 0
+    try:
+        for chunk in chunks:
+            for data in _drain(d, codec, chunk):
+                produced += len(data)
+                if produced > length:
+                    raise ValueError(f"compressed payload decodes past {length} bytes")
+                yield data
+        tail = d.flush() if codec == "zlib" else b""
+    except ConnectionError:
+        raise
+    except (zlib.error, EOFError, OSError) + ((lzma.LZMAError,) if lzma is not None else ()) as e:
+        raise ValueError(f"broken {codec} payload: {e}")
+    produced += len(tail)
+    if tail:
+        yield tail
+    if produced != length:
+        raise ValueError(f"compressed payload decoded to {produced} bytes, expected {length}")
+
+
+def level_for(codec: str, level: Optional[int]) -> int:
+    if level is not None:
+        return level
+    # lzma above 1 costs several times the CPU for a few percent on logs and CSVs
+    return {"zlib": 6, "bz2": 9, "lzma": 1}.get(codec, 6)
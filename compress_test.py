@@ -0,0 +1,47 @@
+import os
+import unittest
+
+from compress import available, compress_source, decompress_chunks
+from protocol import CODEC, RANGE, Source, split_codec, split_range, with_codec, with_range
+
+
+class CompressTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = b"".join(b"%d,row,%d\n" % (i, i * i) for i in range(50000))
+        source = Source(len(data), [data[i:i + 65536] for i in range(0, len(data), 65536)])
+        for codec in available():
+            packed = compress_source(source, codec, 6)
+            self.assertIsNotNone(packed, codec)
+            self.assertLess(packed.length, len(data) // 2)
+            # re-iterable, a failed send can be replayed
+            self.assertEqual(b"".join(packed.chunks), b"".join(packed.chunks))
+            out = b"".join(decompress_chunks(packed.chunks, codec, len(data)))
+            self.assertEqual(out, data)
+
+    def test_incompressible_is_skipped(self):
+        data = os.urandom(200 * 1024)
+        self.assertIsNone(compress_source(Source.of_bytes(data), "zlib", 6))
+
+    def test_announced_length_is_enforced(self):
+        data = b"a" * 1000000
+        packed = compress_source(Source.of_bytes(data), "zlib", 6)
+        with self.assertRaises(ValueError):
+            for _ in decompress_chunks(packed.chunks, "zlib", 1000):
+                pass
+        with self.assertRaises(ValueError):
+            for _ in decompress_chunks([b"not zlib at all"], "zlib", 10):
+                pass
+
+    def test_name(self):
+        plain = with_codec(b"f.txt", b"z", 42)
+        self.assertEqual(split_codec(plain), (b"f.txt", (b"z", 42)))
+        ranged = with_codec(with_range(b"f.txt", 5, 10), b"x", 7)
+        self.assertEqual(len(ranged), len(b"f.txt") + 1 + RANGE.size + CODEC.size)
+        name, codec = split_codec(ranged)
+        self.assertEqual(codec, (b"x", 7))
+        self.assertEqual(split_range(name), (b"f.txt", (5, 10)))
+        self.assertEqual(split_codec(with_range(b"f.txt", 5, 10)), (with_range(b"f.txt", 5, 10), None))
+
+
+if __name__ == '__main__':
+    unittest.main()
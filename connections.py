@@ -0,0 +1,229 @@
+import socket
+import sys
+import time
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional
+
+from containers import Agent
+from metrics import Metrics
+from protocol import HEADER, Head, PayloadReader, Source, is_replayable, read_head, send_frame
+from scheduler import Scheduler, asks_bulk, is_bulk
+
+# f(head, payload, ip), same as Backend._f_tcp_recv
+OnFrame = Callable[[Head, PayloadReader, str], None]
+
+# payloads are received into one buffer per connection, reused for every frame
+RECV_BUFFER = 256 * 1024
+
+
+class Connection:
+    """
+    One long-lived framed TCP connection to a peer.
+    Requests and responses of both sides travel over it, a reader thread dispatches incoming frames.
+    """
+    def __init__(self, sock: socket.socket, ip: str, on_close: Optional[Callable[[], None]] = None):
+        self.sock = sock
+        self.ip = ip
+        self.on_close = on_close
+        self.agent: Optional[Agent] = None
+        self.send_lock = Lock()
+        self.last_used = time.monotonic()
+        self.receiving = False
+        self.closed = False
+        # we opened it, so the peer can be reached
+        self.dialed = False
+        self.buffer = bytearray(RECV_BUFFER)
+
+    def send(self, user: bytes, command: bytes, name: bytes, source: Source, request: int = 0) -> None:
+        with self.send_lock:
+            if self.closed:
+                raise ConnectionError(f"connection to {self.ip} is closed")
+            send_frame(self.sock.sendall, user, command, name, source, self.sock.sendfile, request)
+            self.last_used = time.monotonic()
+        if Metrics.enabled:
+            Metrics.transferred("out", self.peer, HEADER.size + len(name) + source.length)
+
+    def serve(self, on_frame: Callable[["Connection", Head, PayloadReader], None]) -> None:
+        try:
+            while True:
+                head = read_head(self.sock.recv)
+                if head is None:
+                    break
+                self.receiving = True
+                if Metrics.enabled:
+                    Metrics.transferred("in", head.user.decode("ascii", "replace"),
+                                        HEADER.size + len(head.name) + head.length)
+                payload = PayloadReader(self.sock.recv, head.length, self.sock.recv_into, self.buffer)
+                on_frame(self, head, payload)
+                payload.drain()
+                self.receiving = False
+                self.last_used = time.monotonic()
+        except (ConnectionError, OSError) as e:
+            if not self.closed:
+                print(f"Connection with {self.ip} broken: {e}", file=sys.stderr)
+        finally:
+            self.close()
+            if self.on_close is not None:
+                self.on_close()
+
+    @property
+    def peer(self) -> str:
+        return self.agent.name.decode("ascii", "replace") if self.agent is not None else self.ip
+
+    @property
+    def healthy(self) -> bool:
+        return not self.closed and self.sock.fileno() != -1
+
+    @property
+    def busy(self) -> bool:
+        return self.receiving or self.send_lock.locked()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class ConnectionPool:
+    """
+    Keeps at most one registered connection per Agent and reuses it for every message.
+    Connections accepted by the listener are adopted, so replies go back over the same socket.
+    Bulk frames go over a second connection of their own, paced by the scheduler, see scheduler.py.
+    Idle connections are evicted, broken ones are dropped and reconnected on the next send.
+    """
+    def __init__(self, port: int, on_frame: OnFrame, idle_timeout: float = 60, connect_timeout: float = 2,
+                 scheduler: Optional[Scheduler] = None, source_ip: Optional[str] = None):
+        """
+        source_ip: connect from this address, any if None
+        """
+        self.port = port
+        self.source_ip = source_ip
+        self.on_frame = on_frame
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self._lock = Lock()
+        self._conns: Dict[Agent, Connection] = dict()
+        # second connection to each agent, for bulk frames, see scheduler.py
+        self._bulk: Dict[Agent, Connection] = dict()
+        self._all: List[Connection] = list()
+        reaper = Thread(target=self._reap_forever, daemon=True)
+        reaper.start()
+
+    def adopt(self, sock: socket.socket, ip: str, on_close: Optional[Callable[[], None]] = None) -> Connection:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(None)
+        conn = Connection(sock, ip, on_close)
+        with self._lock:
+            self._all.append(conn)
+        Thread(target=conn.serve, args=(self._on_frame,), daemon=True).start()
+        return conn
+
+    def _on_frame(self, conn: Connection, head: Head, payload: PayloadReader) -> None:
+        if conn.agent is None:
+            conn.agent = Agent(name=head.user, ip=conn.ip)
+            with self._lock:
+                current = self._conns.get(conn.agent)
+                if current is None or not current.healthy:
+                    self._conns[conn.agent] = conn
+                elif current is not conn:
+                    # the peer opened its bulk lane, our bulk frames go back over it as well
+                    lane = self._bulk.get(conn.agent)
+                    if lane is None or not lane.healthy:
+                        self._bulk[conn.agent] = conn
+        self.on_frame(head, payload, conn.ip)
+
+    def get(self, agent: Agent, bulk: bool = False, user: bytes = b"") -> Connection:
+        """
+        bulk: the bulk lane to agent. We only open one if we can reach agent, an agent that reached us
+        and opened none gets bulk frames over its one connection.
+        user: introduces a new bulk lane, so the peer knows whose it is before anything else comes over it
+        """
+        conns = self._bulk if bulk else self._conns
+        with self._lock:
+            conn = conns.get(agent)
+            if conn is not None and conn.healthy:
+                return conn
+            if bulk:
+                main = self._conns.get(agent)
+                if main is not None and main.healthy and not main.dialed:
+                    return main
+        source = (self.source_ip, 0) if self.source_ip is not None else None
+        sock = socket.create_connection((agent.ip, self.port), timeout=self.connect_timeout, source_address=source)
+        conn = self.adopt(sock, agent.ip)
+        conn.agent = agent
+        conn.dialed = True
+        if bulk:
+            conn.send(user, b"H", b"", Source(0, ()))
+        with self._lock:
+            current = conns.get(agent)
+            if current is not None and current.healthy:
+                # lost a race with another sender, the new one just idles out
+                return current
+            conns[agent] = conn
+        return conn
+
+    def discard(self, conn: Connection) -> None:
+        conn.close()
+        with self._lock:
+            for conns in (self._conns, self._bulk):
+                if conn.agent is not None and conns.get(conn.agent) is conn:
+                    del conns[conn.agent]
+
+    def send(self, agent: Agent, user: bytes, command: bytes, name: bytes, source: Source, request: int = 0) -> bool:
+        attempts = 2 if is_replayable(source) else 1
+        bulk = is_bulk(command)
+        if asks_bulk(command):
+            # the answer comes over our bulk lane, it has to be there first
+            try:
+                self.get(agent, True, user)
+            except OSError:
+                pass
+        for attempt in range(attempts):
+            try:
+                conn = self.get(agent, bulk, user)
+            except OSError as e:
+                print(e, file=sys.stderr)
+                return False
+            try:
+                conn.send(user, command, name, self.scheduler.paced(agent, source) if bulk else source, request)
+                return True
+            except (ConnectionError, OSError) as e:
+                # most likely the peer dropped an idle connection, reconnect once
+                self.discard(conn)
+                if attempt == attempts - 1:
+                    print(e, file=sys.stderr)
+        return False
+
+    def open(self) -> int:
+        with self._lock:
+            return len(self._all)
+
+    def reap(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            conns = list(self._all)
+        for conn in conns:
+            if not conn.healthy:
+                self.discard(conn)
+            elif not conn.busy and now - conn.last_used > self.idle_timeout:
+                self.discard(conn)
+        with self._lock:
+            self._all = [conn for conn in self._all if not conn.closed]
+
+    def _reap_forever(self) -> None:
+        while True:
+            time.sleep(max(self.idle_timeout / 4, 0.1))
+            self.reap()
+
+    def close_all(self) -> None:
+        with self._lock:
+            conns = list(self._all)
+        for conn in conns:
+            self.discard(conn)
@@ -0,0 +1,89 @@
+import socket
+import time
+import unittest
+from threading import Thread
+
+from connections import ConnectionPool
+from containers import Agent
+from protocol import Source
+
+
+def wait_until(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Pool(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(8)
+        self.frames = list()
+        self.accepted = 0
+        self.server = ConnectionPool(0, lambda head, payload, ip: self.frames.append((head, payload.read_all())))
+        Thread(target=self._accept_forever, daemon=True).start()
+        self.agent = Agent(b"server", "127.0.0.1")
+
+    def _accept_forever(self):
+        while True:
+            try:
+                sock, (ip, _) = self.listener.accept()
+            except OSError:
+                return
+            self.accepted += 1
+            self.server.adopt(sock, ip)
+
+    def tearDown(self):
+        self.listener.close()
+        self.server.close_all()
+
+    def client(self, idle_timeout: float = 60) -> ConnectionPool:
+        pool = ConnectionPool(self.listener.getsockname()[1], lambda head, payload, ip: None, idle_timeout)
+        self.addCleanup(pool.close_all)
+        return pool
+
+    def test_one_connection_for_many_requests(self):
+        pool = self.client()
+        for i in range(5):
+            self.assertTrue(pool.send(self.agent, b"client", b"S", f"ask{i}".encode(), Source(0, ())))
+        self.assertTrue(wait_until(lambda: len(self.frames) == 5))
+        self.assertEqual([head.name for head, _ in self.frames], [f"ask{i}".encode() for i in range(5)])
+        self.assertEqual(self.accepted, 1)
+        self.assertEqual(pool.open(), 1)
+
+    def test_reconnect_after_peer_closed(self):
+        pool = self.client()
+        self.assertTrue(pool.send(self.agent, b"client", b"S", b"a", Source(0, ())))
+        self.assertTrue(wait_until(lambda: len(self.frames) == 1))
+        conn = pool.get(self.agent)
+        self.server.close_all()
+        self.assertTrue(wait_until(lambda: not conn.healthy))
+        self.assertTrue(pool.send(self.agent, b"client", b"S", b"b", Source(0, ())))
+        self.assertTrue(wait_until(lambda: len(self.frames) == 2))
+        self.assertEqual(self.accepted, 2)
+        self.assertIsNot(pool.get(self.agent), conn)
+
+    def test_idle_and_broken_are_evicted(self):
+        pool = self.client(idle_timeout=0.2)
+        self.assertTrue(pool.send(self.agent, b"client", b"S", b"a", Source(0, ())))
+        self.assertEqual(pool.open(), 1)
+        time.sleep(0.3)
+        pool.reap()
+        self.assertEqual(pool.open(), 0)
+
+        pool = self.client()
+        self.assertTrue(pool.send(self.agent, b"client", b"S", b"b", Source(0, ())))
+        conn = pool.get(self.agent)
+        conn.sock.close()
+        pool.reap()
+        self.assertEqual(pool.open(), 0)
+        self.assertTrue(pool.send(self.agent, b"client", b"S", b"c", Source(0, ())))
+        self.assertTrue(wait_until(lambda: len(self.frames) == 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
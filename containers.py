@@ -1,7 +1,16 @@
 import json
+import os
+import random
+import struct
+import sys
+import time
+from collections import deque
+from concurrent import futures
+from concurrent.futures import Future
 from enum import Enum, auto
 from pathlib import Path
-from typing import NamedTuple, Optional, Set, List, Dict, Tuple
+from threading import Lock
+from typing import NamedTuple, Optional, Set, List, Dict, Tuple, Deque
 
 import attr
 import cattr
@@ -25,35 +34,121 @@ class Agent(NamedTuple):
 
 
 class AgentHandler:
-    _agents: Set[Agent] = set()
+    """
+    Known agents by name and by ip, with when each was last heard from.
+    Every frame refreshes its sender, heartbeats keep quiet agents fresh and expire drops the ones gone silent.
+    """
+    # seconds an agent stays alive without being heard from, a few heartbeats
+    TTL = 100.0
+    _lock = Lock()
+    _by_name: Dict[bytes, Agent] = dict()
+    _by_ip: Dict[str, Agent] = dict()
+    _seen: Dict[Agent, float] = dict()
 
     @classmethod
-    def none_if_proper(cls, agent: Agent) -> Optional[Agent]:
-        if agent in cls._agents:
-            return None
-
-        for ag in cls._agents:
-            if ag.name == agent.name:
-                # address has changed
-                return ag
-            elif ag.ip == agent.ip:
-                # different user from same ip
-                return ag
-        # User not found, add
-        cls._agents.add(agent)
+    def none_if_proper(cls, agent: Agent, now: Optional[float] = None) -> Optional[Agent]:
+        """
+        None if agent is known or was added, otherwise the live agent it clashes with.
+        """
+        now = time.time() if now is None else now
+        with cls._lock:
+            if agent in cls._seen:
+                cls._seen[agent] = now
+                return None
+            # address has changed, or a different user from the same ip
+            clashes = {a for a in (cls._by_name.get(agent.name), cls._by_ip.get(agent.ip)) if a is not None}
+            for clash in clashes:
+                if now - cls._seen[clash] <= cls.TTL:
+                    return clash
+            for clash in clashes:
+                cls._remove(clash)
+            cls._add(agent, now)
         return None
 
+    @classmethod
+    def _add(cls, agent: Agent, seen: float) -> None:
+        cls._by_name[agent.name] = agent
+        cls._by_ip[agent.ip] = agent
+        cls._seen[agent] = seen
+
+    @classmethod
+    def _remove(cls, agent: Agent) -> None:
+        cls._seen.pop(agent, None)
+        if cls._by_name.get(agent.name) == agent:
+            del cls._by_name[agent.name]
+        if cls._by_ip.get(agent.ip) == agent:
+            del cls._by_ip[agent.ip]
+
     @classmethod
     def replace(cls, old_agent: Agent, new_agent: Agent) -> None:
-        cls._agents.discard(old_agent)
-        cls._agents.add(new_agent)
+        with cls._lock:
+            cls._remove(old_agent)
+            cls._add(new_agent, time.time())
+
+    @classmethod
+    def agents(cls) -> List[Agent]:
+        with cls._lock:
+            return list(cls._seen)
 
     @classmethod
     def get_agent(cls, name: bytes) -> Optional[Agent]:
-        for ag in cls._agents:
-            if ag.name == name:
-                return ag
-        return None
+        with cls._lock:
+            return cls._by_name.get(name)
+
+    @classmethod
+    def get_by_ip(cls, ip: str) -> Optional[Agent]:
+        with cls._lock:
+            return cls._by_ip.get(ip)
+
+    @classmethod
+    def alive(cls, agent: Agent, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        with cls._lock:
+            seen = cls._seen.get(agent)
+        return seen is not None and now - seen <= cls.TTL
+
+    @classmethod
+    def expire(cls, now: Optional[float] = None) -> List[Agent]:
+        """
+        Forgets agents not heard from in TTL, returns them.
+        """
+        now = time.time() if now is None else now
+        with cls._lock:
+            gone = [agent for agent, seen in cls._seen.items() if now - seen > cls.TTL]
+            for agent in gone:
+                cls._remove(agent)
+        return gone
+
+    @classmethod
+    def load(cls, path: Path, max_age: float = 7 * 24 * 3600) -> int:
+        """
+        Adds the agents cached in path seen in the last max_age seconds, with when they were seen.
+        They can be contacted right away, the first frame from them makes them alive again.
+        """
+        try:
+            cached = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return 0
+        now, loaded = time.time(), 0
+        with cls._lock:
+            for name, ip, seen in cached:
+                agent = Agent(name.encode("latin-1"), ip)
+                if now - seen > max_age or agent.name in cls._by_name or ip in cls._by_ip:
+                    continue
+                cls._add(agent, seen)
+                loaded += 1
+        return loaded
+
+    @classmethod
+    def save(cls, path: Path) -> None:
+        with cls._lock:
+            cached = [(agent.name.decode("latin-1"), agent.ip, seen) for agent, seen in cls._seen.items()]
+        tmp = path.with_name(path.name + ".tmp")
+        try:
+            tmp.write_text(json.dumps(cached))
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Could not save known agents: {e}", file=sys.stderr)
 
 
 @attr.s(auto_attribs=True)
@@ -74,27 +169,171 @@ class BytesDataclass:
             return None
 
 
-class DownloadHandler:
-    _paths: Dict[Tuple[Agent, str], Path] = dict()
+class RequestFailed(Exception):
+    def __init__(self, fail: "Fail"):
+        super().__init__(fail)
+        self.fail = fail
+
+
+class Request:
+    """
+    A request waiting for its reply, the future gets the reply or RequestFailed.
+    kind: reply command, filename: None for overviews, path: where a download goes
+    """
+    def __init__(self, id: int, agent: Agent, kind: bytes, filename: Optional[str] = None,
+                 path: Optional[Path] = None):
+        self.id = id
+        self.agent = agent
+        self.kind = kind
+        self.filename = filename
+        self.path = path
+        self.attempts = 0
+        self.future: Future = Future()
+
+    def __repr__(self) -> str:
+        return f"Request({self.id}, {self.agent}, {self.kind!r}, {self.filename!r})"
+
+
+class RequestHandler:
+    """
+    Pending requests by id, the id goes out with the request and comes back with its reply.
+    Replies without an id, from agents that don't tag, match the oldest request of (agent, kind, filename).
+    """
+    _lock = Lock()
+    _last_id = 0
+    _pending: Dict[int, Request] = dict()
 
     @classmethod
-    def add_download(cls, agent: Agent, filename: str, path: Path) -> bool:
-        if (agent, filename) in cls._paths:
+    def new(cls, agent: Agent, kind: bytes, filename: Optional[str] = None, path: Optional[Path] = None) -> Request:
+        with cls._lock:
+            while True:
+                cls._last_id = cls._last_id % 0xFFFFFFFF + 1
+                if cls._last_id not in cls._pending:
+                    break
+            request = Request(cls._last_id, agent, kind, filename, path)
+            cls._pending[request.id] = request
+        return request
+
+    @classmethod
+    def get(cls, request_id: int, agent: Agent, kind: bytes, filename: Optional[str] = None) -> Optional[Request]:
+        with cls._lock:
+            if request_id:
+                request = cls._pending.get(request_id)
+                if request is not None and request.agent == agent and request.kind == kind:
+                    return request
+                return None
+            for request in cls._pending.values():
+                if request.agent == agent and request.kind == kind and request.filename == filename:
+                    return request
+        return None
+
+    @classmethod
+    def in_flight(cls) -> int:
+        return len(cls._pending)
+
+    @classmethod
+    def pending(cls, kind: bytes) -> List[Request]:
+        with cls._lock:
+            return [request for request in cls._pending.values() if request.kind == kind]
+
+    @classmethod
+    def _pop(cls, request: Request) -> bool:
+        with cls._lock:
+            return cls._pending.pop(request.id, None) is request and not request.future.done()
+
+    @classmethod
+    def resolve(cls, request: Request, reply) -> bool:
+        if not cls._pop(request):
             return False
-        cls._paths[(agent, filename)] = path
+        request.future.set_result(reply)
         return True
 
     @classmethod
-    def get_path(cls, agent: Agent, filename: str) -> Optional[Path]:
-        return cls._paths.get((agent, filename))
+    def reject(cls, request: Request, fail: "Fail") -> bool:
+        if not cls._pop(request):
+            return False
+        request.future.set_exception(RequestFailed(fail))
+        return True
 
     @classmethod
-    def resolve_download(cls, agent: Agent, filename: str) -> Optional[Path]:
-        return cls._paths.pop((agent, filename), None)
+    def cancel(cls, request: Request) -> None:
+        if cls._pop(request):
+            request.future.cancel()
 
     @classmethod
-    def is_pending(cls, agent: Agent, filename: str) -> bool:
-        return (agent, filename) in cls._paths
+    def fail(cls, request_id: int, agent: Agent, fail: "Fail") -> Optional[Request]:
+        """
+        Rejects the request a failure answers, an untagged one by its filename.
+        """
+        with cls._lock:
+            if request_id:
+                request = cls._pending.get(request_id)
+                if request is not None and request.agent != agent:
+                    request = None
+            elif fail.filename is not None:
+                request = next((r for r in cls._pending.values()
+                                if r.agent == agent and r.filename == fail.filename), None)
+            else:
+                request = None
+        if request is not None and cls.reject(request, fail):
+            return request
+        return None
+
+    @staticmethod
+    def wait(requests: List[Request], timeout: Optional[float]) -> bool:
+        """
+        Returns as soon as every request has its reply, False if the deadline came first.
+        """
+        done, not_done = futures.wait([request.future for request in requests], timeout)
+        return not not_done
+
+
+class ChangeHandler:
+    """
+    Recent file changes per user, so an overview can be sent as the changes since a version.
+    Versions restart with the process, epoch tells a peer its cached version is from an earlier run.
+    """
+    MAX_CHANGES = 100000
+    epoch: int = random.getrandbits(32) or 1
+    _lock = Lock()
+    _counter = 1
+    # user -> (version, filename, size, None if removed, sha256)
+    _changes: Dict[str, Deque[Tuple[int, str, Optional[int], Optional[str]]]] = dict()
+    # user -> versions after it are all in _changes
+    _floor: Dict[str, int] = dict()
+
+    @classmethod
+    def record(cls, user: str, filename: str, size: Optional[int], sha256: Optional[str] = None) -> None:
+        with cls._lock:
+            cls._counter += 1
+            changes = cls._changes.setdefault(user, deque())
+            changes.append((cls._counter, filename, size, sha256))
+            if len(changes) > cls.MAX_CHANGES:
+                cls._floor[user] = changes.popleft()[0]
+
+    @classmethod
+    def version_of(cls, user: str) -> int:
+        with cls._lock:
+            changes = cls._changes.get(user)
+            return changes[-1][0] if changes else 1
+
+    @classmethod
+    def since(cls, user: str, version: int) -> Optional[Tuple[int, List["FileInfo"], List[str]]]:
+        """
+        (current version, added or resized, removed) after version, None if the log doesn't reach back.
+        """
+        with cls._lock:
+            if version < cls._floor.get(user, 1):
+                return None
+            changes = cls._changes.get(user, ())
+            latest: Dict[str, Tuple[Optional[int], Optional[str]]] = dict()
+            for v, filename, size, sha256 in changes:
+                if v > version:
+                    latest[filename] = size, sha256
+            current = changes[-1][0] if changes else 1
+        files = [FileInfo(name, size, sha256) for name, (size, sha256) in latest.items() if size is not None]
+        removed = [name for name, (size, _) in latest.items() if size is None]
+        return max(current, version), files, removed
 
 
 class ErrorType(Enum):
@@ -103,6 +342,38 @@ class ErrorType(Enum):
     OVERVIEW = auto()
     GET = auto()
     DOWNLOAD = auto()
+    # too large to go in a batch
+    LARGE = auto()
+
+
+# Binary forms of Overview and Fail, told from JSON by the first byte
+OVERVIEW_MAGIC = b"\x01"
+FAIL_MAGIC = b"\x02"
+# an overview whose files carry their sha256, a digest column "32s" * n after the names, zeros if unknown
+MANIFEST_MAGIC = b"\x03"
+#   magic, epoch, version, base version, space total, space free, files, removed
+OVERVIEW_HEAD = struct.Struct("!cIQQQQII")
+# then username, codecs, hash algorithms, and the files column by column: sizes "!Q" * n, name lengths "!H" * n, names
+NAME = struct.Struct("!H")
+#   magic, error, has filename
+FAIL_HEAD = struct.Struct("!cB?")
+# S name asking for the changes since a cached overview: epoch, version
+OVERVIEW_ASK = struct.Struct("!IQ")
+# S name asking only for the current version, when every peer is asked at once
+VERSION_ASK = b"?"
+# S name asking for a full overview with file hashes, for sync
+MANIFEST_ASK = b"#"
+
+
+def _pack_name(name: str) -> bytes:
+    b = name.encode("utf-8")
+    return NAME.pack(len(b)) + b
+
+
+def _unpack_name(data: bytes, offset: int) -> Tuple[str, int]:
+    (n,) = NAME.unpack_from(data, offset)
+    offset += NAME.size
+    return data[offset:offset + n].decode("utf-8"), offset + n
 
 
 @attr.s(auto_attribs=True)
@@ -110,11 +381,31 @@ class Fail(BytesDataclass):
     error: ErrorType
     filename: Optional[str]
 
+    def to_bin(self) -> bytes:
+        head = FAIL_HEAD.pack(FAIL_MAGIC, self.error.value, self.filename is not None)
+        return head + (_pack_name(self.filename) if self.filename is not None else b"")
+
+    @classmethod
+    def from_wire(cls, data: bytes) -> Optional["Fail"]:
+        """
+        Binary or JSON, None if it is neither.
+        """
+        if data[:1] != FAIL_MAGIC:
+            return cls.from_bjson(data)
+        try:
+            _, error, has_name = FAIL_HEAD.unpack_from(data)
+            filename = _unpack_name(data, FAIL_HEAD.size)[0] if has_name else None
+            return cls(ErrorType(error), filename)
+        except (struct.error, ValueError):
+            return None
+
 
 @attr.s(auto_attribs=True)
 class FileInfo(BytesDataclass):
     name: str
     length_Byte: int
+    # hex, only in overviews asked with MANIFEST_ASK
+    sha256: Optional[str] = None
 
 
 @attr.s(auto_attribs=True)
@@ -123,3 +414,90 @@ class Overview(BytesDataclass):
     space_Byte_total: int
     space_Byte_free: int
     files: List[FileInfo]
+    # payload codecs the agent decodes, older agents send none
+    codecs: List[str] = attr.Factory(list)
+    # see ChangeHandler, an overview with a base version only lists what changed since it
+    epoch: int = 0
+    version: int = 0
+    base: int = 0
+    removed: List[str] = attr.Factory(list)
+    # hash algorithms the agent checks transfers with, see hashcache.py
+    hashes: List[str] = attr.Factory(list)
+
+    def to_bin(self) -> bytes:
+        hashed = any(f.sha256 is not None for f in self.files)
+        magic = MANIFEST_MAGIC if hashed else OVERVIEW_MAGIC
+        parts = [OVERVIEW_HEAD.pack(magic, self.epoch, self.version, self.base, self.space_Byte_total,
+                                    self.space_Byte_free, len(self.files), len(self.removed)),
+                 _pack_name(self.username), bytes([len(self.codecs)])]
+        parts.extend(_pack_name(codec) for codec in self.codecs)
+        parts.append(bytes([len(self.hashes)]))
+        parts.extend(_pack_name(algo) for algo in self.hashes)
+        names = [f.name.encode("utf-8") for f in self.files]
+        n = len(names)
+        parts.append(struct.pack(f"!{n}Q", *(f.length_Byte for f in self.files)))
+        parts.append(struct.pack(f"!{n}H", *map(len, names)))
+        parts.extend(names)
+        if hashed:
+            parts.extend(bytes.fromhex(f.sha256) if f.sha256 is not None else bytes(32) for f in self.files)
+        parts.extend(_pack_name(name) for name in self.removed)
+        return b"".join(parts)
+
+    @classmethod
+    def from_wire(cls, data: bytes) -> Optional["Overview"]:
+        """
+        Binary or JSON, None if it is neither.
+        """
+        if data[:1] not in (OVERVIEW_MAGIC, MANIFEST_MAGIC):
+            return cls.from_bjson(data)
+        try:
+            _, epoch, version, base, total, free, n_files, n_removed = OVERVIEW_HEAD.unpack_from(data)
+            username, offset = _unpack_name(data, OVERVIEW_HEAD.size)
+            n_codecs = data[offset]
+            offset += 1
+            codecs = list()
+            for _ in range(n_codecs):
+                codec, offset = _unpack_name(data, offset)
+                codecs.append(codec)
+            n_hashes = data[offset]
+            offset += 1
+            hashes = list()
+            for _ in range(n_hashes):
+                algo, offset = _unpack_name(data, offset)
+                hashes.append(algo)
+            sizes = struct.unpack_from(f"!{n_files}Q", data, offset)
+            offset += 8 * n_files
+            lengths = struct.unpack_from(f"!{n_files}H", data, offset)
+            offset += 2 * n_files
+            files = list()
+            for size, n in zip(sizes, lengths):
+                files.append(FileInfo(data[offset:offset + n].decode("utf-8"), size))
+                offset += n
+            if data[:1] == MANIFEST_MAGIC:
+                for f in files:
+                    digest = data[offset:offset + 32]
+                    if len(digest) != 32:
+                        return None
+                    f.sha256 = digest.hex() if any(digest) else None
+                    offset += 32
+            removed = list()
+            for _ in range(n_removed):
+                name, offset = _unpack_name(data, offset)
+                removed.append(name)
+        except (struct.error, IndexError, UnicodeDecodeError):
+            return None
+        if offset != len(data):
+            return None
+        return cls(username, total, free, files, codecs, epoch, version, base, removed, hashes)
+
+    def applied(self, delta: "Overview") -> "Overview":
+        """
+        This overview with the changes in delta, which must be based on this version.
+        """
+        files = {f.name: f for f in self.files}
+        for name in delta.removed:
+            files.pop(name, None)
+        for f in delta.files:
+            files[f.name] = f
+        return Overview(delta.username, delta.space_Byte_total, delta.space_Byte_free, list(files.values()),
+                        delta.codecs, delta.epoch, delta.version, 0, list(), delta.hashes)
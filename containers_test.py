@@ -1,3 +1,4 @@
+import tempfile
 import unittest
 
 from containers import *
@@ -5,11 +6,17 @@ from containers import *
 
 class Serial(unittest.TestCase):
     def test_deser_overview(self):
-        o = Overview("a","b",1,2,[])
+        o = Overview("a", 1, 2, [FileInfo("x", 3)])
         b = o.to_bjson()
-        self.assertEqual(b, b'{"server_username": "a", "client_username": "b", "space_KB_total": 1, "space_KB_free": 2, "files": []}')
+        self.assertEqual(b, b'{"username": "a", "space_Byte_total": 1, "space_Byte_free": 2, '
+                            b'"files": [{"name": "x", "length_Byte": 3, "sha256": null}], "codecs": [], '
+                            b'"epoch": 0, "version": 0, "base": 0, "removed": [], "hashes": []}')
         o2 = Overview.from_bjson(b)
         self.assertEqual(o, o2)
+        # what older agents send, without the fields added since
+        o3 = Overview.from_bjson(b'{"username": "a", "space_Byte_total": 1, "space_Byte_free": 2, '
+                                 b'"files": [{"name": "x", "length_Byte": 3}]}')
+        self.assertEqual(o3, o)
 
     def test_deser_fileinfo(self):
         f = FileInfo("h", 12)
@@ -23,5 +30,96 @@ class Serial(unittest.TestCase):
         self.assertIsNone(f)
 
 
+class Binary(unittest.TestCase):
+    def test_overview(self):
+        o = Overview("a", 10, 5, [FileInfo("x.txt", 3), FileInfo("ğ.csv", 0)], ["zlib"], 7, 9, 0, [])
+        b = o.to_bin()
+        self.assertLess(len(b), len(o.to_bjson()))
+        self.assertEqual(Overview.from_wire(b), o)
+        self.assertEqual(Overview.from_wire(o.to_bjson()), o)
+        self.assertIsNone(Overview.from_wire(b[:-1]))
+
+    def test_fail(self):
+        for f in (Fail(ErrorType.GET, "x"), Fail(ErrorType.PARSE, None)):
+            self.assertEqual(Fail.from_wire(f.to_bin()), f)
+            self.assertEqual(Fail.from_wire(f.to_bjson()), f)
+
+    def test_changes_since(self):
+        ChangeHandler.record("u", "a", 1)
+        version = ChangeHandler.version_of("u")
+        ChangeHandler.record("u", "b", 2)
+        ChangeHandler.record("u", "a", None)
+        ChangeHandler.record("u", "b", 5)
+        current, files, removed = ChangeHandler.since("u", version)
+        self.assertEqual(current, ChangeHandler.version_of("u"))
+        self.assertEqual(files, [FileInfo("b", 5)])
+        self.assertEqual(removed, ["a"])
+
+        full = Overview("s", 1, 1, [FileInfo("a", 1), FileInfo("c", 3)], version=version)
+        delta = Overview("s", 1, 1, files, version=current, base=version, removed=removed)
+        applied = full.applied(delta)
+        self.assertEqual(sorted(applied.files, key=lambda f: f.name), [FileInfo("b", 5), FileInfo("c", 3)])
+        self.assertEqual(applied.version, current)
+
+
+class Manifest(unittest.TestCase):
+    def test_hashes_round_trip(self):
+        files = [FileInfo("a", 3, "ab" * 32), FileInfo("b", 0)]
+        o = Overview("a", 10, 5, files, [], 7, 9, 0, [])
+        self.assertEqual(o.to_bin()[:1], MANIFEST_MAGIC)
+        self.assertEqual(Overview.from_wire(o.to_bin()), o)
+        self.assertIsNone(Overview.from_wire(o.to_bin()[:-1]))
+
+    def test_algorithms_round_trip(self):
+        o = Overview("a", 10, 5, [FileInfo("a", 3)], ["zlib"], 7, 9, 0, [], ["blake2b", "sha256"])
+        self.assertEqual(Overview.from_wire(o.to_bin()), o)
+        self.assertEqual(Overview.from_wire(o.to_bjson()), o)
+
+
+class Requests(unittest.TestCase):
+    def test_reply_by_id_or_by_name(self):
+        a, b = Agent(b"bekir", "10.0.0.1"), Agent(b"egemen", "10.0.0.2")
+        first = RequestHandler.new(a, b"P", "x.txt", Path("x"))
+        second = RequestHandler.new(a, b"P", "x.txt", Path("y"))
+        self.assertIsNone(RequestHandler.get(second.id, b, b"P"))
+        self.assertIs(RequestHandler.get(second.id, a, b"P"), second)
+        # untagged replies go to the oldest
+        self.assertIs(RequestHandler.get(0, a, b"P", "x.txt"), first)
+        self.assertTrue(RequestHandler.resolve(second, Path("y")))
+        self.assertFalse(RequestHandler.resolve(second, Path("y")))
+        self.assertTrue(RequestHandler.wait([second], 0))
+        self.assertFalse(RequestHandler.wait([first, second], 0.01))
+
+        self.assertIs(RequestHandler.fail(0, a, Fail(ErrorType.GET, "x.txt")), first)
+        with self.assertRaises(RequestFailed):
+            first.future.result(0)
+        self.assertIsNone(RequestHandler.get(0, a, b"P", "x.txt"))
+
+
+class Registry(unittest.TestCase):
+    def test_clash_expiry_and_cache(self):
+        a = Agent(b"reg-a", "10.1.0.1")
+        self.assertIsNone(AgentHandler.none_if_proper(a, now=1000))
+        self.assertIs(AgentHandler.get_agent(b"reg-a"), a)
+        self.assertIs(AgentHandler.get_by_ip("10.1.0.1"), a)
+        # a live agent keeps its name, one gone silent gives it up
+        moved = Agent(b"reg-a", "10.1.0.2")
+        self.assertEqual(AgentHandler.none_if_proper(moved, now=1000 + AgentHandler.TTL / 2), a)
+        self.assertIsNone(AgentHandler.none_if_proper(moved, now=1000 + AgentHandler.TTL * 2))
+        self.assertEqual(AgentHandler.get_agent(b"reg-a"), moved)
+        self.assertIsNone(AgentHandler.get_by_ip("10.1.0.1"))
+
+        self.assertIn(moved, AgentHandler.expire(now=1000 + AgentHandler.TTL * 4))
+        self.assertIsNone(AgentHandler.get_agent(b"reg-a"))
+
+        with tempfile.TemporaryDirectory() as d:
+            path = Path(d) / "peers.json"
+            AgentHandler.none_if_proper(a)
+            AgentHandler.save(path)
+            AgentHandler.expire(now=time.time() + AgentHandler.TTL * 2)
+            self.assertGreaterEqual(AgentHandler.load(path), 1)
+            self.assertEqual(AgentHandler.get_agent(b"reg-a"), a)
+
+
 if __name__ == '__main__':
     unittest.main()
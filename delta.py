@@ -0,0 +1,219 @@
+"""
+rsync style delta transfer.
+
+The peer holding the old version sends signatures of its blocks, a weak rolling checksum
+and a strong hash each. The sender slides a window over the new version, a window whose weak
+checksum and then strong hash match is sent as a block reference, everything else as literal bytes.
+
+    signatures   SIG_HEAD(file size, block size) SIG_ENTRY(weak, strong) * blocks
+    delta        DELTA_HEAD(new size, block size) ops
+    op           b"B" BLOCK_OP(first block, count) | b"L" LITERAL_OP(length) bytes
+"""
+import hashlib
+import math
+import struct
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from protocol import CHUNK_SIZE
+
+SIG_HEAD = struct.Struct("!QI")
+SIG_ENTRY = struct.Struct("!I16s")
+DELTA_HEAD = struct.Struct("!QI")
+BLOCK_OP = struct.Struct("!QI")
+LITERAL_OP = struct.Struct("!I")
+
+MOD_ADLER = 65521
+MIN_BLOCK = 2 * 1024
+MAX_BLOCK = 64 * 1024
+# a miss run this many blocks long is changed data rather than a shift, past it the scan skips
+SKIP_AFTER = 2
+
+
+def block_size_for(size: int) -> int:
+    # about sqrt(size) like rsync, rounded to KiB
+    return max(MIN_BLOCK, min(MAX_BLOCK, (math.isqrt(size) // 1024) * 1024))
+
+
+def strong_hash(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def reblock(chunks: Iterable[bytes], block_size: int) -> Iterator[bytes]:
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= block_size:
+            yield bytes(buf[:block_size])
+            del buf[:block_size]
+    if buf:
+        yield bytes(buf)
+
+
+class Signatures(NamedTuple):
+    size: int
+    block_size: int
+    blocks: List[Tuple[int, bytes]]
+
+    def to_bytes(self) -> bytes:
+        return SIG_HEAD.pack(self.size, self.block_size) + b"".join(SIG_ENTRY.pack(*b) for b in self.blocks)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Signatures":
+        size, block_size = SIG_HEAD.unpack_from(data)
+        blocks = [SIG_ENTRY.unpack_from(data, off) for off in range(SIG_HEAD.size, len(data), SIG_ENTRY.size)]
+        return cls(size, block_size, blocks)
+
+
+def signatures_of(chunks: Iterable[bytes], size: int, block_size: Optional[int] = None) -> Signatures:
+    block_size = block_size or block_size_for(size)
+    blocks = [(zlib.adler32(block), strong_hash(block)) for block in reblock(chunks, block_size)]
+    return Signatures(size, block_size, blocks)
+
+
+# ("B", first block, count) or ("L", offset, length) into the new data
+Op = Tuple[str, int, int]
+
+
+def compute_delta(data, sigs: Signatures) -> List[Op]:
+    """
+    data: bytes-like with slicing, an mmap of the new version is fine.
+    Matches are checked at every byte offset with a rolling adler32, so inserts and deletes re-align.
+    After SKIP_AFTER blocks without a match only offsets in step with the last match are checked,
+    a block apart, with one block rolled through again at doubling distances to find a new shift.
+    """
+    bs = sigs.block_size
+    n = len(data)
+    table: Dict[int, Dict[bytes, int]] = dict()
+    last_len = sigs.size - (len(sigs.blocks) - 1) * bs if sigs.blocks else 0
+    for index, (weak, strong) in enumerate(sigs.blocks):
+        if index == len(sigs.blocks) - 1 and last_len != bs:
+            continue  # the short tail block is matched separately
+        table.setdefault(weak, dict()).setdefault(strong, index)
+
+    ops: List[Op] = list()
+
+    def literal(start: int, end: int) -> None:
+        if end > start:
+            ops.append(("L", start, end - start))
+
+    def block(index: int) -> None:
+        if ops and ops[-1][0] == "B" and ops[-1][1] + ops[-1][2] == index:
+            ops[-1] = ("B", ops[-1][1], ops[-1][2] + 1)
+        else:
+            ops.append(("B", index, 1))
+
+    i = 0
+    lit_start = 0
+    rolling = False
+    a = b = 0
+    scan_end, gap = SKIP_AFTER * bs, bs
+    next_scan = scan_end + gap
+    while table and i + bs <= n:
+        if not rolling:
+            weak = zlib.adler32(data[i:i + bs])
+            a, b = weak & 0xffff, weak >> 16
+            rolling = True
+        else:
+            weak = (b << 16) | a
+        candidates = table.get(weak)
+        if candidates is not None:
+            index = candidates.get(strong_hash(data[i:i + bs]))
+            if index is not None:
+                literal(lit_start, i)
+                block(index)
+                i += bs
+                lit_start = i
+                rolling = False
+                scan_end, gap = i + SKIP_AFTER * bs, bs
+                next_scan = scan_end + gap
+                continue
+        if i + 1 >= scan_end:
+            aligned = i + bs - (i - lit_start) % bs
+            if aligned < next_scan:
+                i = aligned
+            else:
+                i = next_scan
+                scan_end = i + bs
+                gap *= 2
+                next_scan = scan_end + gap
+            rolling = False
+            continue
+        if i + bs < n:
+            out_byte = data[i]
+            in_byte = data[i + bs]
+            a = (a - out_byte + in_byte) % MOD_ADLER
+            b = (b - bs * out_byte + a - 1) % MOD_ADLER
+        i += 1
+
+    if sigs.blocks and last_len != bs and n - lit_start >= last_len > 0:
+        tail = n - last_len
+        weak, strong = sigs.blocks[-1]
+        if zlib.adler32(data[tail:]) == weak and strong_hash(data[tail:]) == strong:
+            literal(lit_start, tail)
+            block(len(sigs.blocks) - 1)
+            lit_start = n
+    literal(lit_start, n)
+    return ops
+
+
+def delta_length(ops: List[Op]) -> int:
+    length = DELTA_HEAD.size
+    for kind, x, y in ops:
+        length += 1 + (BLOCK_OP.size if kind == "B" else LITERAL_OP.size + y)
+    return length
+
+
+def literal_bytes(ops: List[Op]) -> int:
+    return sum(y for kind, x, y in ops if kind == "L")
+
+
+class DeltaChunks:
+    """
+    The encoded delta, re-iterable. Literals are sliced out of data lazily.
+    """
+    def __init__(self, data, ops: List[Op], block_size: int):
+        self.data = data
+        self.ops = ops
+        self.block_size = block_size
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield DELTA_HEAD.pack(len(self.data), self.block_size)
+        for kind, x, y in self.ops:
+            if kind == "B":
+                yield b"B" + BLOCK_OP.pack(x, y)
+            else:
+                yield b"L" + LITERAL_OP.pack(y)
+                for off in range(x, x + y, CHUNK_SIZE):
+                    yield bytes(self.data[off:min(off + CHUNK_SIZE, x + y)])
+
+
+def apply_delta(read: Callable[[int], bytes], read_range: Callable[[int, int], bytes],
+                size: int, block_size: int) -> Iterator[bytes]:
+    """
+    read: exact reads from the delta after DELTA_HEAD, read_range(offset, length): the old version.
+    Yields the new version and checks that it adds up to size.
+    """
+    produced = 0
+    while produced < size:
+        kind = read(1)
+        if kind == b"B":
+            first, count = BLOCK_OP.unpack(read(BLOCK_OP.size))
+            for index in range(first, first + count):
+                data = read_range(index * block_size, block_size)
+                if not data:
+                    raise ValueError(f"delta refers to missing block {index}")
+                produced += len(data)
+                yield data
+        elif kind == b"L":
+            (length,) = LITERAL_OP.unpack(read(LITERAL_OP.size))
+            remaining = length
+            while remaining > 0:
+                data = read(min(CHUNK_SIZE, remaining))
+                remaining -= len(data)
+                produced += len(data)
+                yield data
+        else:
+            raise ValueError(f"unknown delta op {kind!r}")
+    if produced != size:
+        raise ValueError(f"delta produced {produced} bytes, expected {size}")
@@ -0,0 +1,77 @@
+import io
+import math
+import random
+import unittest
+
+from delta import *
+
+
+def roundtrip(old: bytes, new: bytes):
+    sigs = Signatures.from_bytes(signatures_of([old], len(old), block_size=2048).to_bytes())
+    ops = compute_delta(new, sigs)
+    encoded = b"".join(DeltaChunks(new, ops, sigs.block_size))
+    reader = io.BytesIO(encoded)
+    size, block_size = DELTA_HEAD.unpack(reader.read(DELTA_HEAD.size))
+    rebuilt = b"".join(apply_delta(reader.read, lambda offset, length: old[offset:offset + length], size, block_size))
+    return rebuilt, ops, encoded
+
+
+class Counted(bytes):
+    """
+    New data counting the single bytes and the slices compute_delta reads from it.
+    """
+    bytes_read = 0
+    slices = 0
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            self.slices += 1
+        else:
+            self.bytes_read += 1
+        return super().__getitem__(key)
+
+
+class Delta(unittest.TestCase):
+    old = random.Random(7).randbytes(200_001)
+
+    def test_edits_rebuild_and_stay_small(self):
+        old = self.old
+        for new in (old, old[:5000] + b"new" + old[5000:], old[:9000] + old[9100:], old + b"tail", b"x" + old):
+            rebuilt, ops, encoded = roundtrip(old, new)
+            self.assertEqual(rebuilt, new)
+            self.assertLess(literal_bytes(ops), 4100)
+            self.assertEqual(len(encoded), delta_length(ops))
+
+    def test_unrelated_data_is_all_literal(self):
+        new = random.Random(8).randbytes(10_000)
+        rebuilt, ops, encoded = roundtrip(self.old, new)
+        self.assertEqual(rebuilt, new)
+        self.assertEqual(literal_bytes(ops), len(new))
+
+    def test_changed_region_skipped_and_realigned(self):
+        old, rng = self.old, random.Random(9)
+        for changed in (20_000, 23_000, 17_000):
+            new = old[:50_000] + rng.randbytes(changed) + old[70_000:]
+            rebuilt, ops, encoded = roundtrip(old, new)
+            self.assertEqual(rebuilt, new)
+            # the shifted rest is found again, at worst after as much again as was changed
+            self.assertLess(literal_bytes(ops), 2 * changed + 4 * 2048)
+
+    def test_changed_data_is_not_rolled_per_byte(self):
+        old = random.Random(10).randbytes(4_000_000)
+        sigs = signatures_of([old], len(old))
+        new = Counted(random.Random(11).randbytes(4_000_000))
+        ops = compute_delta(new, sigs)
+        self.assertEqual(literal_bytes(ops), len(new))
+        # a byte read is half of a rolled window, a slice is a window checked from scratch
+        windows = new.bytes_read // 2 + new.slices
+        blocks = len(new) // sigs.block_size
+        self.assertLess(windows, (blocks + sigs.block_size) * math.ceil(math.log2(blocks)))
+
+    def test_empty_basis(self):
+        rebuilt, ops, encoded = roundtrip(b"", b"abc")
+        self.assertEqual(rebuilt, b"abc")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import io
+import sys
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Deque, Dict, Hashable, Tuple
+
+from metrics import Metrics
+from protocol import Head, PayloadReader
+
+# Payload is read from the socket by the handler itself, the connection waits for it
+STREAMING = (b"U", b"P", b"T")
+# Touch storage/<user>, run one at a time per user and in arrival order
+SERIAL = (b"U", b"R", b"X", b"D", b"G", b"T", b"W", b"B")
+
+
+class SerialExecutor:
+    """
+    Runs tasks on a shared bounded thread pool.
+    Tasks submitted with the same key run one at a time, in submission order.
+    """
+    def __init__(self, workers: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="handler")
+        self._lock = Lock()
+        self._queues: Dict[Hashable, Deque[Tuple[Future, Callable, tuple]]] = dict()
+
+    def submit(self, key: Hashable, fn: Callable, *args) -> Future:
+        if key is None:
+            return self.executor.submit(fn, *args)
+        future = Future()
+        with self._lock:
+            queue = self._queues.get(key)
+            start = queue is None
+            if start:
+                queue = deque()
+                self._queues[key] = queue
+            queue.append((future, fn, args))
+        if start:
+            self.executor.submit(self._drain, key)
+        return future
+
+    def _drain(self, key: Hashable) -> None:
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                future, fn, args = queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def depth(self) -> int:
+        # tasks waiting for a worker or behind another one of their key
+        with self._lock:
+            behind = sum(len(queue) for queue in self._queues.values())
+        return behind + self.executor._work_queue.qsize()
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
+class Dispatcher:
+    """
+    Sits between the connections and Backend._f_tcp_recv.
+    Small messages are read whole and handed to the worker pool, so the connection moves on.
+    Uploads and payloads stream from the socket, so the connection waits until they are handled.
+    """
+    def __init__(self, f_recv: Callable[[Head, PayloadReader, str], None], workers: int = 8):
+        self.f_recv = f_recv
+        self.executor = SerialExecutor(workers)
+
+    def __call__(self, head: Head, payload: PayloadReader, ip: str) -> None:
+        streaming = head.command in STREAMING
+        if not streaming:
+            data = payload.read_all()
+            payload = PayloadReader(io.BytesIO(data).read, len(data))
+        key = head.user if head.command in SERIAL else None
+        future = self.executor.submit(key, self.f_recv, head, payload, ip)
+        if streaming:
+            future.result()
+        else:
+            future.add_done_callback(self._report)
+
+    @staticmethod
+    def _report(future: Future) -> None:
+        e = future.exception()
+        if e is not None:
+            Metrics.count("handler.failed")
+            print(f"Handler failed: {e!r}", file=sys.stderr)
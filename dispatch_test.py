@@ -0,0 +1,32 @@
+import threading
+import time
+import unittest
+
+from dispatch import SerialExecutor
+
+
+class Serial(unittest.TestCase):
+    def test_same_key_keeps_order(self):
+        ex = SerialExecutor(workers=4)
+        seen = list()
+
+        def work(i):
+            time.sleep(0.001 * (5 - i % 5))
+            seen.append(i)
+
+        futures = [ex.submit(b"bekir", work, i) for i in range(20)]
+        for f in futures:
+            f.result()
+        self.assertEqual(seen, list(range(20)))
+
+    def test_different_keys_run_concurrently(self):
+        ex = SerialExecutor(workers=2)
+        barrier = threading.Barrier(2, timeout=2)
+        a = ex.submit(b"bekir", barrier.wait)
+        b = ex.submit(b"egemen", barrier.wait)
+        a.result()
+        b.result()
+
+
+if __name__ == '__main__':
+    unittest.main()
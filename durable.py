@@ -0,0 +1,226 @@
+"""
+Files are written under a temporary name and renamed into place, so a failed transfer or a crash never
+leaves a truncated file under the real name. How much of that survives a power cut is the durability level:
+
+    none    renamed only, the page cache decides when it reaches the disk
+    group   data and directory entries are synced before the put returns, in rounds shared by every put
+            that completed while the round before was syncing. A round of SYNCFS_MIN files or more flushes
+            each filesystem they are on once with syncfs, a smaller round fdatasyncs each of its files,
+            then every directory gets one fsync per round.
+            A put that finds no round syncing starts one at once, after waiting COMMIT_WINDOW for others
+    always  every put syncs its own files and directories and waits for nobody
+
+syncfs writes back every dirty page of the filesystem, not only the round's: the tmp files of other uploads
+still arriving too, so a round can wait on gigabytes it did not write. It pays off once a round has enough
+files that one flush beats a sync each, "syncfs_min" in store.txt sets where, 0 never uses syncfs.
+"""
+import ctypes
+import os
+import sys
+import time
+from pathlib import Path
+from threading import Condition
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from metrics import Metrics
+
+LEVELS = ("none", "group", "always")
+COMMIT_WINDOW = 0.0
+SYNCFS_MIN = 16
+
+Move = Tuple[Path, Path]
+
+try:
+    _syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+except (OSError, AttributeError):
+    # not Linux, os.sync flushes every filesystem instead where there is one
+    _syncfs = None
+CAN_SYNC_FS = _syncfs is not None or hasattr(os, "sync")
+
+
+def fsync_file(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        # the data and the size, enough to read the file back
+        (os.fdatasync if hasattr(os, "fdatasync") else os.fsync)(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_filesystem(path: Path) -> None:
+    """
+    Flushes everything written to the filesystem path is on.
+    """
+    if _syncfs is None:
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _syncfs(fd) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(path: Path) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # directories can't be opened on some platforms, their entries are as safe as they get there
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Commit:
+    # files to sync, moves to do once they are and directories to sync after, with what went wrong
+    def __init__(self, files: List[Path], moves: List[Move], dirs: Iterable[Path]):
+        self.files = files
+        self.moves = moves
+        self.dirs = set(dirs) | {dest.parent for _, dest in moves}
+        self.errors: List[Optional[OSError]] = [None] * len(moves)
+        self.failed: Optional[OSError] = None
+        self.done = False
+
+
+class GroupCommit:
+    """
+    level: one of LEVELS, window: seconds a group round waits for more files after the first,
+    syncfs_min: files in a group round from which it flushes whole filesystems, 0 never
+    """
+    def __init__(self, level: str = "group", window: float = COMMIT_WINDOW, syncfs_min: int = SYNCFS_MIN):
+        if level not in LEVELS:
+            print(f"Unknown durability {level}, using group", file=sys.stderr)
+            level = "group"
+        self.level = level
+        self.window = window
+        self.syncfs_min = syncfs_min
+        self._cond = Condition()
+        self._pending: List[Commit] = list()
+        self._flushing = False
+        self.rounds = 0
+        self.synced = 0
+
+    def replace(self, src: Path, dest: Path) -> None:
+        """
+        os.replace(src, dest) once src is on disk, raises OSError if either failed.
+        """
+        error = self.replace_many([(src, dest)])[0]
+        if error is not None:
+            raise error
+
+    def replace_many(self, moves: List[Move]) -> List[Optional[OSError]]:
+        """
+        Every move of one batch in the same round. What went wrong with each, None if it is in place.
+        A file that could not be synced is not moved.
+        """
+        if self.level == "none":
+            return [self._move(src, dest) for src, dest in moves]
+        return self._commit(Commit(list(), moves, ())).errors
+
+    def sync(self, files: Iterable[Path] = (), dirs: Iterable[Path] = ()) -> None:
+        """
+        Blocks until files and the entries in dirs are on disk, for writes that rename on their own.
+        """
+        if self.level == "none":
+            return
+        commit = self._commit(Commit(list(files), list(), dirs))
+        if commit.failed is not None:
+            raise commit.failed
+
+    def _commit(self, commit: Commit) -> Commit:
+        if self.level == "always":
+            self._flush([commit])
+            return commit
+        with self._cond:
+            self._pending.append(commit)
+            while not commit.done:
+                if not self._flushing:
+                    # nobody is syncing, this thread syncs everything pending
+                    self._flushing = True
+                    break
+                self._cond.wait()
+            else:
+                return commit
+        commits: List[Commit] = list()
+        try:
+            if self.window > 0:
+                time.sleep(self.window)
+            with self._cond:
+                commits, self._pending = self._pending, list()
+            self._flush(commits)
+        finally:
+            with self._cond:
+                for done in commits:
+                    done.done = True
+                self._flushing = False
+                self._cond.notify_all()
+        return commit
+
+    def _flush(self, commits: List[Commit]) -> None:
+        with Metrics.timer("commit"):
+            count = sum(len(commit.files) + len(commit.moves) for commit in commits)
+            if self.level == "group" and 0 < self.syncfs_min <= count and CAN_SYNC_FS:
+                self._flush_filesystems(commits)
+            else:
+                for commit in commits:
+                    for path in commit.files:
+                        try:
+                            fsync_file(path)
+                        except OSError as e:
+                            commit.failed = e
+                    for i, (src, _) in enumerate(commit.moves):
+                        try:
+                            fsync_file(src)
+                        except OSError as e:
+                            commit.errors[i] = e
+            for commit in commits:
+                for i, (src, dest) in enumerate(commit.moves):
+                    if commit.errors[i] is None:
+                        commit.errors[i] = self._move(src, dest)
+            dirs: Set[Path] = set()
+            for commit in commits:
+                dirs |= commit.dirs
+            for path in dirs:
+                fsync_dir(path)
+        synced = sum(len(commit.files) + len(commit.moves) for commit in commits)
+        self.rounds += 1
+        self.synced += synced
+        Metrics.count("commit.rounds")
+        Metrics.count("commit.files", synced)
+
+    @staticmethod
+    def _flush_filesystems(commits: List[Commit]) -> None:
+        # one syncfs per filesystem for the whole round, files that are gone fail on their own
+        devices: Dict[int, Path] = dict()
+        for commit in commits:
+            for path in commit.files:
+                try:
+                    devices.setdefault(os.stat(path).st_dev, path)
+                except OSError as e:
+                    commit.failed = e
+            for i, (src, _) in enumerate(commit.moves):
+                try:
+                    devices.setdefault(os.stat(src).st_dev, src)
+                except OSError as e:
+                    commit.errors[i] = e
+        for path in devices.values():
+            try:
+                sync_filesystem(path)
+            except OSError as e:
+                for commit in commits:
+                    commit.failed = commit.failed or e
+                    commit.errors = [error or e for error in commit.errors]
+
+    @staticmethod
+    def _move(src: Path, dest: Path) -> Optional[OSError]:
+        try:
+            os.replace(src, dest)
+        except OSError as e:
+            return e
+        return None
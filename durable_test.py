@@ -0,0 +1,78 @@
+import tempfile
+import unittest
+from pathlib import Path
+from threading import Thread
+from unittest import mock
+
+from durable import *
+
+
+class Replace(unittest.TestCase):
+    def test_levels_move_in_place(self):
+        for level in LEVELS:
+            with tempfile.TemporaryDirectory() as d:
+                root = Path(d)
+                (root / "a.tmp").write_bytes(b"new")
+                (root / "a").write_bytes(b"old")
+                errors = GroupCommit(level).replace_many([(root / "a.tmp", root / "a"), (root / "gone", root / "b")])
+                self.assertIsNone(errors[0])
+                self.assertIsInstance(errors[1], OSError)
+                self.assertEqual((root / "a").read_bytes(), b"new")
+                self.assertFalse((root / "b").exists())
+
+    def test_group_shares_rounds(self):
+        committer = GroupCommit("group", window=0.05)
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d)
+            for i in range(8):
+                (root / f"{i}.tmp").write_bytes(bytes(i))
+            threads = [Thread(target=committer.replace, args=(root / f"{i}.tmp", root / str(i))) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(sorted(p.name for p in root.iterdir()), [str(i) for i in range(8)])
+        self.assertEqual(committer.synced, 8)
+        self.assertLessEqual(committer.rounds, 2)
+
+    def test_one_flush_per_round(self):
+        import durable
+        committer = GroupCommit("group", window=0.05, syncfs_min=2)
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(durable, "fsync_file", wraps=durable.fsync_file) as per_file, \
+                mock.patch.object(durable, "sync_filesystem", wraps=durable.sync_filesystem) as per_fs:
+            root = Path(d)
+            for i in range(8):
+                (root / f"{i}.tmp").write_bytes(bytes(i))
+            threads = [Thread(target=committer.replace, args=(root / f"{i}.tmp", root / str(i))) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(committer.synced, 8)
+        # a round of several files flushes the filesystem once, a round of one syncs its file
+        self.assertEqual(per_file.call_count + per_fs.call_count, committer.rounds)
+        self.assertLessEqual(committer.rounds, 2)
+        self.assertGreaterEqual(per_fs.call_count, 1)
+
+    def test_small_round_syncs_each_file(self):
+        import durable
+        for syncfs_min, flushes in ((3, 1), (4, 0), (0, 0)):
+            with tempfile.TemporaryDirectory() as d, \
+                    mock.patch.object(durable, "fsync_file", wraps=durable.fsync_file) as per_file, \
+                    mock.patch.object(durable, "sync_filesystem", wraps=durable.sync_filesystem) as per_fs:
+                files = [Path(d) / str(i) for i in range(3)]
+                for path in files:
+                    path.write_bytes(b"x")
+                # one round of three files, syncfs only from syncfs_min files up and never with 0
+                GroupCommit("group", syncfs_min=syncfs_min).sync(files)
+                self.assertEqual((per_fs.call_count, per_file.call_count), (flushes, 3 * (1 - flushes)))
+
+    def test_sync_raises(self):
+        with tempfile.TemporaryDirectory() as d:
+            with self.assertRaises(OSError):
+                GroupCommit("always").sync([Path(d) / "missing"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import sys
 import os
@@ -5,17 +6,49 @@ import os.path
 from pathlib import Path
 import stat
 import pickle
+import time
+from typing import Iterable, Union
+
+import threading
+from threading import RLock
 
 from containers import *
+from chunkstore import ChunkStore
+from packstore import PackStore
+from batch import Item
+from delta import DELTA_HEAD, apply_delta, signatures_of
+from durable import COMMIT_WINDOW, SYNCFS_MIN, GroupCommit
+from hashcache import HashCache, hash_file, new_hash, tap
+from index import MetaIndex, scan_user
+from ledger import UsageLedger, file_size
+from metrics import Metrics
+from partial import PartFile
+from protocol import Source, file_source, mapped_source
+from readcache import ReadCache, load_stats, save_stats
 
 # import front_arg
 
 path_storage: Path = Path("./storage")
 if not path_storage.is_dir():
     path_storage.mkdir()
+# files being written, moved into place when complete
+path_tmp: Path = path_storage / ".tmp"
+# bytes of small files kept in memory to be served again, "read_cache" in store.txt overrides it, 0 turns it off
+READ_CACHE = 64 * 1024 * 1024
+
 
-# TODO BIG! handle file open exceptions! None handled right now!
-# TODO tests!
+def write_all(f, chunks: Iterable[bytes]) -> None:
+    # only the writes count as disk time, not waiting for the chunks to arrive
+    if not Metrics.enabled:
+        for chunk in chunks:
+            f.write(chunk)
+        return
+    spent = 0.0
+    for chunk in chunks:
+        start = time.perf_counter()
+        f.write(chunk)
+        spent += time.perf_counter() - start
+    Metrics.observe("disk.write", spent)
 
 
 class FileHandler:
@@ -24,6 +57,15 @@ class FileHandler:
 
     # can use mypy backend.py for static type checking. These types are for this purpose.
 
+    _ledger: Optional[UsageLedger] = None
+    _store: Optional[Union[ChunkStore, PackStore]] = None
+    _store_loaded = False
+    _index: Optional[MetaIndex] = None
+    _hash_cache: Optional[HashCache] = None
+    _read_cache: Optional[ReadCache] = None
+    _committer: Optional[GroupCommit] = None
+    _lock = RLock()
+
     @staticmethod
     def __unpickling__():
         if os.path.isfile("store.txt") :
@@ -59,18 +101,163 @@ class FileHandler:
         """
         return sum(f.stat().st_size for f in path.glob('**/*') if f.is_file() )
 
+    @staticmethod
+    def store() -> Optional[Union[ChunkStore, PackStore]]:
+        # None is the plain layout, storage/<user>/<filename>. Chosen by "layout" in store.txt
+        with FileHandler._lock:
+            if not FileHandler._store_loaded:
+                layout = FileHandler.__unpickling__().get("layout", "plain")
+                if layout == "chunked":
+                    FileHandler._store = ChunkStore(path_storage, FileHandler.committer())
+                elif layout == "packed":
+                    FileHandler._store = PackStore(path_storage, FileHandler.committer())
+                FileHandler._store_loaded = True
+            return FileHandler._store
+
+    @staticmethod
+    def usage() -> UsageLedger:
+        with FileHandler._lock:
+            if FileHandler._ledger is None:
+                if FileHandler.store() is not None:
+                    # the chunk store read all manifests when it opened, no scan needed
+                    FileHandler.rebuild_usage()
+                else:
+                    FileHandler._ledger = UsageLedger.load(path_storage, FileHandler.__unpickling__()["size"])
+            return FileHandler._ledger
+
+    @staticmethod
+    def rebuild_usage() -> None:
+        # once, when a node starts. Every change after that is applied incrementally.
+        with FileHandler._lock:
+            store = FileHandler.store()
+            FileHandler._ledger = UsageLedger(path_storage, FileHandler.__unpickling__()["size"])
+            FileHandler._ledger.rebuild(store.usage() if store is not None else None)
+
+    @staticmethod
+    def index() -> MetaIndex:
+        with FileHandler._lock:
+            if FileHandler._index is None:
+                FileHandler._index = MetaIndex(path_storage)
+            return FileHandler._index
+
+    @staticmethod
+    def hash_cache() -> HashCache:
+        with FileHandler._lock:
+            if FileHandler._hash_cache is None:
+                FileHandler._hash_cache = HashCache(path_storage)
+            return FileHandler._hash_cache
+
+    @staticmethod
+    def read_cache() -> ReadCache:
+        with FileHandler._lock:
+            if FileHandler._read_cache is None:
+                FileHandler._read_cache = ReadCache(FileHandler.__unpickling__().get("read_cache", READ_CACHE))
+            return FileHandler._read_cache
+
+    @staticmethod
+    def committer() -> GroupCommit:
+        # every write goes in place through it, "durability", "commit_window" and "syncfs_min" in store.txt,
+        # see durable.py
+        with FileHandler._lock:
+            if FileHandler._committer is None:
+                store = FileHandler.__unpickling__()
+                FileHandler._committer = GroupCommit(store.get("durability", "group"),
+                                                     store.get("commit_window", COMMIT_WINDOW),
+                                                     store.get("syncfs_min", SYNCFS_MIN))
+            return FileHandler._committer
+
+    @staticmethod
+    def save_usage(clean: bool = False) -> None:
+        # by a running node now and then, clean when it exits, see UsageLedger
+        if FileHandler._ledger is not None:
+            FileHandler._ledger.save(clean)
+
+    @staticmethod
+    def save_cache_stats() -> None:
+        # for `inwards`, by a running node now and then
+        save_stats(path_storage, {"read": FileHandler.read_cache().stats(), "hash": FileHandler.hash_cache().stats()})
+
+    @staticmethod
+    def _cached(user: str, filename: str) -> Optional[bytes]:
+        """
+        A small stored file from the read cache, read and kept on a miss. None for a file the cache doesn't take.
+        """
+        entry = FileHandler.index().get(user, filename)
+        if entry is None:
+            return None
+        cache = FileHandler.read_cache()
+        data = cache.get(user, filename, entry[0])
+        if data is not None or not cache.fits(entry[0]):
+            return data
+        generation = cache.generation()
+        store = FileHandler.store()
+        try:
+            with Metrics.timer("disk.read"):
+                if store is not None:
+                    source = store.get(user, filename)
+                    data = b"".join(source.chunks) if source is not None else None
+                else:
+                    data = (path_storage / user / filename).read_bytes()
+        except OSError:
+            return None
+        if data is not None:
+            cache.put(user, filename, data, generation)
+        return data
+
+    @staticmethod
+    def validate_index() -> None:
+        # once, when a node starts, like rebuild_usage. Files in subdirectories are named by their relative path
+        store = FileHandler.store()
+        disk = dict()
+        for user in path_storage.iterdir():
+            if user.is_dir() and not user.name.startswith("."):
+                disk[user.name] = scan_user(user)
+        if store is not None:
+            for user in store.users():
+                files = disk.setdefault(user, dict())
+                for info in store.files(user):
+                    files[info.name] = (info.length_Byte, store.mtime(user, info.name) or 0.0)
+        fixed = FileHandler.index().validate(disk)
+        if fixed:
+            print(f"Index: {fixed} entries did not match the disk, fixed", file=sys.stderr)
+
+    @staticmethod
+    def _changed(user: str, filename: str, size: Optional[int], hash: Optional[str] = None) -> None:
+        """
+        Puts and deletes go to the index and the change log, size None is a delete.
+        """
+        FileHandler._changed_many(user, {filename: size}, {filename: hash} if hash is not None else None)
+
+    @staticmethod
+    def _changed_many(user: str, sizes: Dict[str, Optional[int]], hashes: Optional[Dict[str, str]] = None) -> None:
+        # filename -> size of many puts and deletes, one index transaction
+        store = FileHandler.store()
+        puts, deletes = list(), list()
+        for filename, size in sizes.items():
+            if size is None:
+                deletes.append(filename)
+                continue
+            mtime = store.mtime(user, filename) if store is not None else None
+            if mtime is None:
+                try:
+                    mtime = (path_storage / user / filename).stat().st_mtime
+                except OSError:
+                    mtime = None
+            puts.append((filename, size, mtime, (hashes or {}).get(filename)))
+        FileHandler.index().apply(user, puts, deletes)
+        FileHandler.read_cache().invalidate(user, *sizes)
+        for filename, size in sizes.items():
+            ChangeHandler.record(user, filename, size, (hashes or {}).get(filename))
+
     @staticmethod
     def server_overview_of(user: str, myname: str = None)-> Overview:
         # JSON encoding, so every key must be a string
         # noinspection PyTypeChecker
-        space_total = FileHandler.__unpickling__()["size"]
-        space_free = space_total-FileHandler.get_size(path_storage) 
-        all_files_user = []
-        path: Path = path_storage / user
-        for (dirpath, dirnames, filenames) in os.walk(path):
-            for f in filenames:
-                all_files_user.append(FileInfo(f, os.path.getsize(path / f)))
-        
+        ledger = FileHandler.usage()
+        space_total = ledger.capacity
+        space_free = ledger.free
+        all_files_user = FileHandler.index().files(user, hashes=True)
+
         overview = Overview(
             username=myname,
             space_Byte_total=space_total,
@@ -81,67 +268,500 @@ class FileHandler:
         # return None
 
     @staticmethod
-    def server_file_get(user: str, filename: str) -> Optional[bytes]:
+    def server_manifest_of(user: str, myname: str) -> Overview:
+        """
+        Full overview with the sha256 of every file. Hashes the index doesn't have yet, of files that came
+        in pieces or changed behind our back, are computed once and kept.
+        """
+        version = ChangeHandler.version_of(user)
+        overview = FileHandler.server_overview_of(user, myname)
+        overview.epoch, overview.version = ChangeHandler.epoch, version
+        for info in overview.files:
+            if info.sha256 is None:
+                digest = FileHandler.server_file_digest(user, info.name)
+                info.sha256 = digest.hex() if digest is not None else None
+        return overview
+
+    @staticmethod
+    def server_file_digest(user: str, filename: str, algo: str = "sha256") -> Optional[bytes]:
+        """
+        Digest of a stored file. sha256 comes from the index, what it lacks is computed once and kept,
+        other algorithms come from the hash cache.
+        """
+        index = FileHandler.index()
+        entry = index.get(user, filename)
+        if algo == "sha256" and entry is not None and entry[2] is not None:
+            return bytes.fromhex(entry[2])
+        store = FileHandler.store()
+        if store is None:
+            digest = FileHandler.hash_cache().digest(path_storage / user / filename, algo)
+        else:
+            source = store.get(user, filename)
+            if source is None:
+                return None
+            h = new_hash(algo)
+            try:
+                for chunk in source.chunks:
+                    h.update(chunk)
+            except OSError:
+                return None
+            digest = h.digest()
+        if digest is not None and algo == "sha256" and entry is not None:
+            index.put(user, filename, entry[0], entry[1], digest.hex())
+        return digest
+
+    @staticmethod
+    def server_overview_changes(user: str, myname: str, epoch: int, since: int) -> Overview:
+        """
+        What changed since version of an earlier overview, the full overview if that is not known anymore.
+        """
+        if epoch == ChangeHandler.epoch and since > 0:
+            changes = ChangeHandler.since(user, since)
+            if changes is not None:
+                version, files, removed = changes
+                ledger = FileHandler.usage()
+                return Overview(myname, ledger.capacity, ledger.free, files,
+                                epoch=epoch, version=version, base=since, removed=removed)
+        # taken before the scan, a change racing with it is sent again next time
+        version = ChangeHandler.version_of(user)
+        overview = FileHandler.server_overview_of(user, myname)
+        overview.epoch, overview.version = ChangeHandler.epoch, version
+        return overview
+
+    @staticmethod
+    def server_file_get(user: str, filename: str) -> Optional[Source]:
+        data = FileHandler._cached(user, filename)
+        if data is not None:
+            Metrics.count("get.memory")
+            return Source.of_bytes(data)
+        store = FileHandler.store()
+        if store is not None:
+            source = store.get(user, filename)
+            Metrics.count("get.missing" if source is None else "get.store")
+            return source
         path: Path = path_storage / user
-        if not path.is_dir():
-            print(f"NOT FOUND file {filename} for user {user}", file=sys.stderr)
-            return None
         filepath = path / filename
-        with filepath.open("rb") as f:
-            data = f.read()
-        print(f"SERVED file {filename} for user {user}, contents:")
-        print(f"{data[:40].decode('ascii', 'replace')}")
-        return data
+        if not filepath.is_file():
+            Metrics.count("get.missing")
+            return None
+        Metrics.count("get.disk")
+        return file_source(filepath)
 
     @staticmethod
-    def server_file_put(user: str, filename: str, data: bytes) -> bool:
-        if FileHandler.__unpickling__()["size"] - FileHandler.get_size(path_storage) < sys.getsizeof(data):
+    def server_file_get_range(user: str, filename: str, offset: int, length: int) -> Optional[Tuple[int, Source]]:
+        """
+        (file size, source of the range), length 0 means up to the end
+        """
+        data = FileHandler._cached(user, filename)
+        if data is not None:
+            offset = min(offset, len(data))
+            end = len(data) if length == 0 else min(offset + length, len(data))
+            Metrics.count("get.memory")
+            return len(data), Source.of_bytes(data if (offset, end) == (0, len(data)) else memoryview(data)[offset:end])
+        store = FileHandler.store()
+        if store is not None:
+            ranged = store.get_range(user, filename, offset, length)
+        else:
+            filepath = path_storage / user / filename
+            try:
+                ranged = filepath.stat().st_size, file_source(filepath, offset, length)
+            except OSError:
+                ranged = None
+        Metrics.count("get.missing" if ranged is None else "get.range")
+        return ranged
+
+    @staticmethod
+    def _upload_part(user: str, filename: str) -> PartFile:
+        return PartFile(path_tmp / f"{user}.{filename}")
+
+    @staticmethod
+    def server_upload_offset(user: str, filename: str) -> Tuple[int, int]:
+        # (bytes already received, total) of a resumable upload
+        return FileHandler._upload_part(user, filename).load()
+
+    @staticmethod
+    def server_file_put_range(user: str, filename: str, chunks: Iterable[bytes], offset: int, total: int,
+                              expected: Optional[Tuple[str, bytes]] = None) -> bool:
+        """
+        A piece of a resumable upload, the file is put in place when the last piece arrives.
+        expected: (algorithm, digest) of the whole file, checked once it is complete
+        """
+        filepath: Path = path_storage / user / filename
+        ledger = FileHandler.usage()
+        store = FileHandler.store()
+        old_size = (store.size(user, filename) if store is not None else file_size(filepath)) or 0
+        if ledger.free < total - old_size:
             return False
+        part = FileHandler._upload_part(user, filename)
+        try:
+            if not part.write(chunks, offset, total):
+                return True
+        except (OSError, ConnectionError, ValueError) as e:
+            print(f"PUT of {filename} for user {user} stopped at {part.load()[0]}: {e}", file=sys.stderr)
+            return False
+        if expected is not None and hash_file(part.part, expected[0]) != expected[1]:
+            print(f"PUT of {filename} for user {user} failed: {expected[0]} does not match", file=sys.stderr)
+            part.discard()
+            return False
+        if not ledger.reserve(user, total - old_size):
+            part.discard()
+            return False
+        try:
+            if store is not None:
+                store.put(user, filename, file_source(part.part).chunks)
+                part.discard()
+            else:
+                filepath.parent.mkdir(exist_ok=True)
+                part.commit(filepath, FileHandler.committer().replace)
+        except (OSError, ValueError) as e:
+            print(f"PUT of {filename} for user {user} failed: {e}", file=sys.stderr)
+            ledger.charge(user, old_size - total)
+            return False
+        FileHandler._changed(user, filename, total)
+        Metrics.count("put.range")
+        return True
+
+    @staticmethod
+    def server_file_put(user: str, filename: str, chunks: Iterable[bytes], length: int,
+                        expected: Optional[Tuple[str, bytes]] = None) -> bool:
+        """
+        expected: (algorithm, digest) the sender computed, the old version stays in place if the bytes don't match
+        """
         path: Path = path_storage / user
-        if not path.is_dir():
-            path.mkdir()
         filepath: Path = path / filename
-        with filepath.open("wb") as f:
-            f.write(data)
-        print(f"PUT file {filename} for user {user}, contents: {data[:30].decode()}")
+        ledger = FileHandler.usage()
+        store = FileHandler.store()
+        old_size = (store.size(user, filename) if store is not None else file_size(filepath)) or 0
+        # quota is charged on the logical size, also for the chunked layout
+        if not ledger.reserve(user, length - old_size):
+            return False
+        digest = hashlib.sha256()
+        check = None if expected is None else digest if expected[0] == "sha256" else new_hash(expected[0])
+
+        def tapped() -> Iterable[bytes]:
+            return tap(chunks, (digest, check) if check is not None and check is not digest else (digest,))
+
+        tmp: Path = path_tmp / f"{user}.{threading.get_ident()}.{filename}"
+        # a checked put to the chunk store goes under a temporary name until the digest matched
+        target = filename if check is None else f".{threading.get_ident()}.{filename}"
+        try:
+            if store is not None:
+                store.put(user, target, tapped())
+            else:
+                if not path.is_dir():
+                    path.mkdir()
+                path_tmp.mkdir(exist_ok=True)
+                with tmp.open("wb") as f:
+                    write_all(f, tapped())
+            if check is not None and check.digest() != expected[1]:
+                raise ValueError(f"{expected[0]} does not match")
+            if store is not None:
+                if target != filename:
+                    store.rename(user, target, filename)
+            else:
+                FileHandler.committer().replace(tmp, filepath)
+        except (OSError, ConnectionError, ValueError) as e:
+            print(f"PUT of {filename} for user {user} failed: {e}", file=sys.stderr)
+            if tmp.exists():
+                tmp.unlink()
+            if store is not None and target != filename:
+                store.delete(user, target)
+            # the old version is still in place
+            ledger.charge(user, old_size - length)
+            return False
+        FileHandler._changed(user, filename, length, digest.hexdigest())
+        if store is None and check is not None and check is not digest:
+            FileHandler.hash_cache().put(filepath, expected[0], expected[1])
+        Metrics.count("put")
         return True
 
+    @staticmethod
+    def server_batch_put(user: str, items: List[Item]) -> List[int]:
+        """
+        Puts many small files, one quota reservation and one index transaction for all of them.
+        Status per item, 0 or the ErrorType value.
+        """
+        path: Path = path_storage / user
+        ledger = FileHandler.usage()
+        store = FileHandler.store()
+        sizes: Dict[str, int] = dict()
+        deltas = list()
+        for item in items:
+            if item.name not in sizes:
+                old_size = store.size(user, item.name) if store is not None else file_size(path / item.name)
+                sizes[item.name] = old_size or 0
+            deltas.append(len(item.data) - sizes[item.name])
+            sizes[item.name] = len(item.data)
+        # if all of them don't fit, each one gets its own chance
+        whole = ledger.reserve(user, sum(deltas))
+        statuses, written, hashes = list(), dict(), dict()
+        # (position, item, quota delta, temporary file) of the plain layout, moved in place together
+        moves: List[Tuple[int, Item, int, Path]] = list()
+        if store is None:
+            path.mkdir(exist_ok=True)
+            path_tmp.mkdir(exist_ok=True)
+        for item, delta in zip(items, deltas):
+            if not whole and not ledger.reserve(user, delta):
+                statuses.append(ErrorType.PUT.value)
+                continue
+            try:
+                if store is not None:
+                    store.put(user, item.name, (item.data,))
+                else:
+                    tmp: Path = path_tmp / f"{user}.{threading.get_ident()}.{len(statuses)}.{item.name}"
+                    tmp.write_bytes(item.data)
+                    moves.append((len(statuses), item, delta, tmp))
+            except (OSError, ValueError) as e:
+                print(f"PUT of {item.name} for user {user} failed: {e}", file=sys.stderr)
+                ledger.charge(user, -delta)
+                statuses.append(ErrorType.PUT.value)
+                continue
+            if store is not None:
+                written[item.name] = len(item.data)
+                hashes[item.name] = hashlib.sha256(item.data).hexdigest()
+            statuses.append(0)
+        errors = FileHandler.committer().replace_many([(tmp, path / item.name) for _, item, _, tmp in moves])
+        for (i, item, delta, tmp), error in zip(moves, errors):
+            if error is not None:
+                print(f"PUT of {item.name} for user {user} failed: {error}", file=sys.stderr)
+                ledger.charge(user, -delta)
+                statuses[i] = ErrorType.PUT.value
+                if tmp.exists():
+                    tmp.unlink()
+                continue
+            written[item.name] = len(item.data)
+            hashes[item.name] = hashlib.sha256(item.data).hexdigest()
+        FileHandler._changed_many(user, written, hashes)
+        Metrics.count("put", len(written))
+        return statuses
+
+    @staticmethod
+    def server_batch_get(user: str, names: List[str], max_bytes: int) -> List[Item]:
+        """
+        Files until max_bytes in total, one that does not fit anymore is LARGE and has to be asked for again.
+        """
+        store = FileHandler.store()
+        results = list()
+        for name in names:
+            data = FileHandler._cached(user, name)
+            if data is not None:
+                source = Source.of_bytes(data)
+            elif store is not None:
+                source = store.get(user, name)
+            else:
+                filepath = path_storage / user / name
+                source = file_source(filepath) if filepath.is_file() else None
+            if source is None:
+                results.append(Item(name, status=ErrorType.GET.value))
+            elif source.length > max_bytes:
+                results.append(Item(name, status=ErrorType.LARGE.value))
+            else:
+                try:
+                    with Metrics.timer("disk.read"):
+                        data = b"".join(source.chunks)
+                    results.append(Item(name, data=data))
+                    max_bytes -= source.length
+                except OSError:
+                    results.append(Item(name, status=ErrorType.GET.value))
+        Metrics.count("get.batch", sum(1 for r in results if r.status == 0))
+        return results
+
+    @staticmethod
+    def server_batch_delete(user: str, names: List[str]) -> List[int]:
+        store = FileHandler.store()
+        statuses, deleted = list(), dict()
+        freed = 0
+        for name in names:
+            if store is not None:
+                size = store.size(user, name)
+                removed = size is not None and store.delete(user, name)
+            else:
+                filepath = path_storage / user / name
+                size = file_size(filepath)
+                try:
+                    removed = size is not None and filepath.is_file()
+                    if removed:
+                        filepath.unlink()
+                except OSError:
+                    removed = False
+            if not removed:
+                statuses.append(ErrorType.GET.value)
+                continue
+            freed += size
+            deleted[name] = None
+            statuses.append(0)
+        FileHandler.usage().charge(user, -freed)
+        FileHandler._changed_many(user, deleted)
+        Metrics.count("delete", len(deleted))
+        return statuses
+
+    @staticmethod
+    def server_batch_rename(user: str, pairs: List[Tuple[str, str]]) -> List[int]:
+        store = FileHandler.store()
+        path = path_storage / user
+        statuses, renamed = list(), list()
+        freed = 0
+        for old, new in pairs:
+            try:
+                if store is not None:
+                    replaced = 0 if old == new else store.size(user, new) or 0
+                    done = store.rename(user, old, new)
+                else:
+                    replaced = 0 if old == new else file_size(path / new) or 0
+                    done = (path / old).is_file()
+                    if done:
+                        os.replace(path / old, path / new)
+            except OSError:
+                done = False
+            if not done:
+                statuses.append(ErrorType.GET.value)
+                continue
+            freed += replaced
+            renamed.append((old, new))
+            statuses.append(0)
+        FileHandler.usage().charge(user, -freed)
+        index = FileHandler.index()
+        index.apply(user, renames=renamed)
+        FileHandler.read_cache().invalidate(user, *(name for pair in renamed for name in pair))
+        for old, new in renamed:
+            if old == new:
+                continue
+            size = store.size(user, new) if store is not None else file_size(path / new)
+            ChangeHandler.record(user, old, None)
+            if index.get(user, new) is None:
+                FileHandler._changed(user, new, size)
+            else:
+                ChangeHandler.record(user, new, size)
+        Metrics.count("rename", len(renamed))
+        return statuses
+
+    @staticmethod
+    def server_file_ranges(user: str, filename: str):
+        """
+        Random access to a stored file: .read_range(offset, length) and .close(), None if it is not there.
+        """
+        store = FileHandler.store()
+        if store is not None:
+            return store.open_ranges(user, filename)
+        try:
+            return FileRanges((path_storage / user / filename).open("rb"))
+        except OSError:
+            return None
+
+    @staticmethod
+    def server_file_signatures(user: str, filename: str) -> Optional[bytes]:
+        store = FileHandler.store()
+        if store is not None:
+            source = store.get(user, filename)
+        else:
+            filepath = path_storage / user / filename
+            source = file_source(filepath) if filepath.is_file() else None
+        if source is None:
+            return None
+        try:
+            return signatures_of(source.chunks, source.length).to_bytes()
+        except OSError:
+            return None
+
+    @staticmethod
+    def server_file_patch(user: str, filename: str, delta, expected: Optional[Tuple[str, bytes]] = None) -> bool:
+        """
+        delta: PayloadReader of a delta against the stored version, see delta.py
+        expected: (algorithm, digest) of the new version, a delta applied to a basis that changed since its
+        signatures were sent rebuilds the wrong bytes and is not kept
+        """
+        size, block_size = DELTA_HEAD.unpack(delta.read(DELTA_HEAD.size))
+        basis = FileHandler.server_file_ranges(user, filename)
+        read_range = basis.read_range if basis is not None else (lambda offset, length: b"")
+        try:
+            # puts go through a temporary file or a new manifest, the basis stays readable until the end
+            return FileHandler.server_file_put(user, filename, apply_delta(delta.read, read_range, size, block_size), size,
+                                              expected)
+        finally:
+            if basis is not None:
+                basis.close()
+
     @staticmethod
     def server_file_delete(user: str, filename: str) -> bool:
-        filepath= path_storage.stem + "/" + user + "/" + filename.decode('utf-8')
+        store = FileHandler.store()
+        if store is not None:
+            size = store.size(user, filename.decode('utf-8'))
+            if size is None or not store.delete(user, filename.decode('utf-8')):
+                return False
+            FileHandler.usage().charge(user, -size)
+            FileHandler._changed(user, filename.decode('utf-8'), None)
+            Metrics.count("delete")
+            return True
+        filepath = path_storage / user / filename.decode('utf-8')
+        size = file_size(filepath)
+        if size is None:
+            return False
         try:
             os.remove(filepath)
-            print(f"DELETE file {filename} for user {user}")
         except PermissionError:
-            print('PermissionError do change')
+            # read-only on Windows
             os.chmod(filepath, stat.S_IWRITE)
             os.remove(filepath)
-            print(f"DELETE file {filename} for user {user}")
-            return True
-        else:
-            return False
+        FileHandler.usage().charge(user, -size)
+        FileHandler._changed(user, filename.decode('utf-8'), None)
+        Metrics.count("delete")
+        return True
 
     @staticmethod
     def server_file_rename(user: str, filename_old: str, filename_new: str) -> bool:
-        filepath1= path_storage.stem + "/" + user + "/" + filename_old
-        filepath2= path_storage.stem + "/" + user + "/" + filename_new
-        if os.path.isfile(filepath1):
-            os.rename(r'{}'.format(filepath1),r'{}'.format(filepath2))
-            print(f"RENAME file {filename_old} into {filename_new} for user {user}")
+        store = FileHandler.store()
+        if store is not None:
+            replaced = 0 if filename_old == filename_new else store.size(user, filename_new) or 0
+            if not store.rename(user, filename_old, filename_new):
+                return False
+            FileHandler.usage().charge(user, -replaced)
+            FileHandler._record_rename(user, filename_old, filename_new, store.size(user, filename_new))
+            Metrics.count("rename")
+            return True
+        filepath1 = path_storage / user / filename_old
+        filepath2 = path_storage / user / filename_new
+        if filepath1.is_file():
+            # an existing target gets overwritten, its bytes are freed
+            replaced = 0 if filepath1 == filepath2 else file_size(filepath2) or 0
+            os.rename(filepath1, filepath2)
+            FileHandler.usage().charge(user, -replaced)
+            FileHandler._record_rename(user, filename_old, filename_new, file_size(filepath2))
+            Metrics.count("rename")
             return True
         else:
             return False
 
     @staticmethod
-    def server_storage_status() -> str:
-        users: List[Tuple[str, int]] = list()
+    def _record_rename(user: str, filename_old: str, filename_new: str, size: Optional[int]) -> None:
+        if filename_old == filename_new:
+            return
+        index = FileHandler.index()
+        # one transaction, the entry keeps its mtime and hash
+        index.rename(user, filename_old, filename_new)
+        FileHandler.read_cache().invalidate(user, filename_old, filename_new)
+        ChangeHandler.record(user, filename_old, None)
+        if index.get(user, filename_new) is None:
+            FileHandler._changed(user, filename_new, size)
+        else:
+            ChangeHandler.record(user, filename_new, size)
 
-        for user in path_storage.iterdir():
-            if not user.is_dir():
-                continue
-            size = user.stat().st_size
-            users.append((user.name, size))
-        return "(User, used space):\n" + str(users)
+    @staticmethod
+    def server_storage_status() -> str:
+        ledger = FileHandler.usage()
+        users: List[Tuple[str, int]] = sorted(ledger.users().items())
+        counts = FileHandler.index().counts()
+        users: List[Tuple[str, int, int]] = [(user, used, counts.get(user, 0)) for user, used in users]
+        status = (f"Total: {ledger.capacity}, used: {ledger.total}, free: {ledger.free}\n"
+                  "(User, used space, files):\n" + str(users))
+        store = FileHandler.store()
+        if store is not None:
+            status += ("\nChunk store: " if isinstance(store, ChunkStore) else "\nPack store: ") + str(store.stats())
+        # counters of the running node, this may be another process
+        counters = load_stats(path_storage)
+        for title, key in (("Read cache", "read"), ("Hash cache", "hash")):
+            if key in counters:
+                status += f"\n{title}: {counters[key]}"
+        return status
         """
         space_total = FileHandler.get_size(path_storage)
         list_of_dirnames = []
@@ -163,18 +783,91 @@ class FileHandler:
         """
 
     @staticmethod
-    def client_file_read(path: Path) -> Optional[bytes]:
+    def client_file_read(path: Path, offset: int = 0) -> Optional[Source]:
         try:
-            with path.open("rb") as f:
-                return f.read()
+            return file_source(path, offset)
         except:
             return None
 
     @staticmethod
-    def client_file_write(path: Path, data: bytes) -> bool:
+    def client_file_map(path: Path) -> Optional[Source]:
+        # one mapping of path for a payload going to several agents at once, see replicate.py
         try:
-            with path.open("wb") as f:
-                f.write(data)
-                return True
+            return mapped_source(path)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def client_part_offset(path: Path, total: Optional[int] = None) -> Tuple[int, int]:
+        # (verified offset, total) of an interrupted download into path.
+        # total: size of the file now if known, a part of another size is dropped
+        part = PartFile(path)
+        offset, known_total = part.load()
+        if total is not None and known_total != total:
+            part.discard()
+            return 0, 0
+        return offset, known_total
+
+    @staticmethod
+    def client_part_received(path: Path) -> int:
+        # bytes in path.part so far, verified or not
+        return file_size(PartFile(path).part) or 0
+
+    @staticmethod
+    def client_part_write(path: Path, chunks: Iterable[bytes], offset: int, total: int,
+                          expected: Optional[Tuple[str, bytes]] = None) -> bool:
+        """
+        Writes a range of a download into path.part, moves it to path when complete.
+        True when complete, raises if the transfer broke, progress is kept for a resume.
+        expected: (algorithm, digest) of the whole file, a complete part that doesn't match is dropped and raises
+        """
+        part = PartFile(path)
+        # a transfer from the start is hashed as it is written, a resumed one is read again at the end
+        check = new_hash(expected[0]) if expected is not None and offset == 0 else None
+        if not part.write(chunks if check is None else tap(chunks, (check,)), offset, total):
+            return False
+        if expected is not None:
+            digest = check.digest() if check is not None else hash_file(part.part, expected[0])
+            if digest != expected[1]:
+                part.discard()
+                raise ValueError(f"{expected[0]} of {path.name} does not match")
+        part.commit(path, FileHandler.committer().replace)
+        if expected is not None:
+            FileHandler.hash_cache().put(path, expected[0], expected[1])
+        return True
+
+    @staticmethod
+    def client_file_write(path: Path, chunks: Iterable[bytes], expected: Optional[Tuple[str, bytes]] = None) -> bool:
+        """
+        Written next to path and moved over it when complete, an earlier version stays until then.
+        expected: (algorithm, digest), a file that doesn't match is not kept
+        """
+        check = new_hash(expected[0]) if expected is not None else None
+        tmp = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+        try:
+            with tmp.open("wb") as f:
+                write_all(f, chunks if check is None else tap(chunks, (check,)))
+            if check is not None and check.digest() != expected[1]:
+                print(f"{expected[0]} of {path.name} does not match", file=sys.stderr)
+                tmp.unlink()
+                return False
+            FileHandler.committer().replace(tmp, path)
+            if check is not None:
+                FileHandler.hash_cache().put(path, expected[0], expected[1])
+            return True
         except:
+            if tmp.exists():
+                tmp.unlink()
             return False
+
+
+class FileRanges:
+    def __init__(self, f):
+        self.f = f
+
+    def read_range(self, offset: int, length: int) -> bytes:
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def close(self) -> None:
+        self.f.close()
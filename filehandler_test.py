@@ -0,0 +1,141 @@
+import hashlib
+import contextlib
+import io
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import filehandler
+from delta import DeltaChunks, compute_delta, signatures_of
+from filehandler import FileHandler
+from metrics import Metrics
+
+
+def reset() -> None:
+    for opened in (FileHandler._index, FileHandler._hash_cache, FileHandler._store):
+        if hasattr(opened, "close"):
+            opened.close()
+    FileHandler._ledger = FileHandler._store = FileHandler._index = None
+    FileHandler._hash_cache = FileHandler._read_cache = FileHandler._committer = None
+    FileHandler._store_loaded = False
+
+
+def use_storage(case: unittest.TestCase, store: dict) -> Path:
+    """
+    FileHandler on a storage directory of its own for the test, store.txt settings given by store.
+    """
+    d = tempfile.TemporaryDirectory()
+    case.addCleanup(d.cleanup)
+    root = Path(d.name)
+    for name, value in (("path_storage", root), ("path_tmp", root / ".tmp")):
+        patcher = mock.patch.object(filehandler, name, value)
+        patcher.start()
+        case.addCleanup(patcher.stop)
+    patcher = mock.patch.object(FileHandler, "__unpickling__", staticmethod(lambda: dict(store)))
+    patcher.start()
+    case.addCleanup(patcher.stop)
+    reset()
+    case.addCleanup(reset)
+    return root
+
+
+class Plain(unittest.TestCase):
+    store = {"size": 1000 * 1000, "layout": "plain", "read_cache": 0}
+
+    def setUp(self):
+        self.root = use_storage(self, self.store)
+
+    def put(self, filename: str, data: bytes) -> bool:
+        return FileHandler.server_file_put("bekir", filename, [data[:3], data[3:]], len(data))
+
+    def get(self, filename: str):
+        source = FileHandler.server_file_get("bekir", filename)
+        return None if source is None else b"".join(bytes(chunk) for chunk in source.chunks)
+
+    def names(self):
+        return sorted(info.name for info in FileHandler.server_overview_of("bekir").files)
+
+    def test_put_get(self):
+        self.assertTrue(self.put("a.txt", b"hello world"))
+        self.assertTrue(self.put("b.txt", b""))
+        self.assertEqual(self.get("a.txt"), b"hello world")
+        self.assertEqual(self.get("b.txt"), b"")
+        self.assertIsNone(self.get("missing"))
+        # a new version replaces the old one, usage follows the size
+        self.assertTrue(self.put("a.txt", b"hi"))
+        self.assertEqual(self.get("a.txt"), b"hi")
+        self.assertEqual(FileHandler.usage().used_by("bekir"), 2)
+        self.assertEqual(self.names(), ["a.txt", "b.txt"])
+
+    def test_put_over_quota(self):
+        self.assertFalse(self.put("big", b"x" * (self.store["size"] + 1)))
+        self.assertIsNone(self.get("big"))
+        self.assertEqual(FileHandler.usage().used_by("bekir"), 0)
+
+    def test_rename(self):
+        self.put("a.txt", b"aaaa")
+        self.put("b.txt", b"bb")
+        self.assertTrue(FileHandler.server_file_rename("bekir", "a.txt", "c.txt"))
+        self.assertIsNone(self.get("a.txt"))
+        self.assertEqual(self.get("c.txt"), b"aaaa")
+        # onto an existing name, the one it replaced is freed
+        self.assertTrue(FileHandler.server_file_rename("bekir", "c.txt", "b.txt"))
+        self.assertEqual(self.get("b.txt"), b"aaaa")
+        self.assertEqual(FileHandler.usage().used_by("bekir"), 4)
+        self.assertEqual(self.names(), ["b.txt"])
+        self.assertFalse(FileHandler.server_file_rename("bekir", "missing", "d.txt"))
+
+    def test_delete(self):
+        self.put("a.txt", b"aaaa")
+        self.assertTrue(FileHandler.server_file_delete("bekir", b"a.txt"))
+        self.assertIsNone(self.get("a.txt"))
+        self.assertFalse(FileHandler.server_file_delete("bekir", b"a.txt"))
+        self.assertEqual(FileHandler.usage().used_by("bekir"), 0)
+        self.assertEqual(self.names(), [])
+
+    def test_patch_checked_against_the_new_version(self):
+        old = bytes(range(256)) * 40
+        new = old[:5000] + b"changed" + old[5000:]
+        self.put("a.bin", old)
+        sigs = signatures_of([old], len(old))
+        ops = compute_delta(new, sigs)
+
+        def delta():
+            return io.BytesIO(b"".join(DeltaChunks(new, ops, sigs.block_size)))
+        # the stored version changed since the signatures, the rebuilt file is not the sender's
+        self.put("a.bin", old[::-1])
+        expected = ("sha256", hashlib.sha256(new).digest())
+        self.assertFalse(FileHandler.server_file_patch("bekir", "a.bin", delta(), expected))
+        self.assertEqual(self.get("a.bin"), old[::-1])
+        self.put("a.bin", old)
+        self.assertTrue(FileHandler.server_file_patch("bekir", "a.bin", delta(), expected))
+        self.assertEqual(self.get("a.bin"), new)
+
+    def test_requests_are_counted_not_printed(self):
+        Metrics.enable()
+        self.addCleanup(setattr, Metrics, "enabled", False)
+        self.addCleanup(Metrics.reset)
+        Metrics.reset()
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.put("a.txt", b"aaaa")
+            self.get("a.txt")
+            self.get("missing")
+            FileHandler.server_file_rename("bekir", "a.txt", "b.txt")
+            FileHandler.server_file_delete("bekir", b"b.txt")
+        self.assertEqual(out.getvalue(), "")
+        counters = Metrics.snapshot()["counters"]
+        self.assertEqual([counters.get(name) for name in ("put", "get.missing", "rename", "delete")], [1, 1, 1, 1])
+
+
+class Chunked(Plain):
+    store = dict(Plain.store, layout="chunked")
+
+
+class Packed(Plain):
+    store = dict(Plain.store, layout="packed")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 
 import click
+import fnmatch
 import time
 from pathlib import Path
 from tabulate import tabulate
 import attr
 import pickle
+import json
 import os
 
+from aio import AsyncBackend
 from backend import Backend
-from filehandler import FileHandler
+from batch import NO_REPLY
+from sync import local_manifest, plan_sync
+from filehandler import FileHandler, path_storage
+from metrics import Metrics
 from containers import *
 
 size = None
@@ -34,24 +40,130 @@ def overview(user: str):
         print(FileHandler.server_storage_status())
 
 
-def wait_and_print_overviews(backend: Backend) -> None:
+@inwards.command()
+@click.option("--json", "as_json", is_flag=True, help="One JSON line, to append to a dashboard's log.")
+def stats(as_json: bool):
+    """
+    Metrics of the node running here, as of its last heartbeat. It collects them with --metrics or --debug.
+    """
+    snapshot = Metrics.load(path_storage)
+    if snapshot is None:
+        print("No metrics, start the node with --metrics.")
+        return
+    if as_json:
+        print(json.dumps(snapshot))
+        return
+    print(f"Uptime: {snapshot['uptime']:.0f} s\n")
+    latency = [{"name": name, "count": h["count"], "mean ms": h["mean"] * 1000, "p50 ms": h["p50"] * 1000,
+                "p99 ms": h["p99"] * 1000, "max ms": h["max"] * 1000} for name, h in snapshot["latency"].items()]
+    print(tabulate(latency, headers="keys", floatfmt=".2f"), end="\n\n")
+    peers = sorted(set(snapshot["bytes"]["in"]) | set(snapshot["bytes"]["out"]))
+    traffic = [(peer, snapshot["bytes"]["in"].get(peer, 0), snapshot["bytes"]["out"].get(peer, 0)) for peer in peers]
+    print(tabulate(traffic, headers=("peer", "bytes in", "bytes out")), end="\n\n")
+    print(tabulate(list(snapshot["counters"].items()) + list(snapshot["gauges"].items()), headers=("metric", "value")))
+    for line in snapshot.get("profile", ()):
+        print(line)
+    if "memory" in snapshot:
+        memory = snapshot["memory"]
+        print(f"\nTraced memory: {memory['current']} bytes, peak {memory['peak']}")
+        print("\n".join(memory["top"]))
+
+
+def wait_and_print_overviews(backend: Backend, timeout: float = 1) -> None:
     print("Loading...", end=" ", flush=True)
-    time.sleep(1)
+    overviews = backend.wait_overviews(timeout)
     print("Done. Your overviews:\n")
-    overviews = backend.get_overviews()
     if len(overviews) > 0:
-        ds = [attr.asdict(o) for o in overviews]
+        # versions are bookkeeping for overview deltas, not for people
+        hidden = ("epoch", "version", "base", "removed")
+        ds = [attr.asdict(o, filter=lambda a, v: a.name not in hidden) for o in overviews]
         print(tabulate(ds, headers="keys"))
     else:
         print("No overviews had been received.")
     print()
 
+def is_pattern(name: str) -> bool:
+    return any(c in name for c in "*?[")
+
+
+def local_files(filepath: Path) -> Optional[List[Path]]:
+    # a directory or a glob stands for the files in it, None for a single file
+    if filepath.is_dir():
+        return sorted(p for p in filepath.iterdir() if p.is_file())
+    if is_pattern(filepath.name):
+        return sorted(p for p in filepath.parent.glob(filepath.name) if p.is_file())
+    return None
+
+
+def remote_files(backend: Backend, who: str, pattern: str) -> List[str]:
+    # names in the last overview of who matching pattern
+    for overview in backend.get_overviews():
+        if overview.username == who:
+            return fnmatch.filter([info.name for info in overview.files], pattern)
+    return []
+
+
+def print_results(statuses: Dict[str, int], what: str = "files") -> None:
+    failed = {name: status for name, status in statuses.items() if status != 0}
+    print(f"{len(statuses) - len(failed)} of {len(statuses)} {what} done.")
+    for name, status in sorted(failed.items()):
+        print(f"  {name}: {'no reply' if status == NO_REPLY else ErrorType(status).name}")
+
+
 @main.group(invoke_without_command=True)
 @click.option("--username", prompt=True)
 @click.option("--debug", is_flag=True)
+@click.option("--engine", type=click.Choice(["threaded", "asyncio"]), default="threaded", show_default=True)
+@click.option("--port", type=int, help="One port for both TCP and UDP, asyncio engine defaults to 8888.")
+@click.option("--ip", help="Only address to listen on and connect from, e.g. 127.0.0.2 for a second node on this machine.")
+@click.option("--workers", default=8, show_default=True, help="Threads handling incoming requests.")
+@click.option("--max-connections", default=64, show_default=True, help="Peers served at the same time.")
+@click.option("--backlog", default=5, show_default=True, help="Listen backlog of the TCP socket.")
+@click.option("--layout", type=click.Choice(["plain", "chunked", "packed"]),
+              help="Storage layout, remembered in store.txt. chunked deduplicates across users, "
+                   "packed appends small files to large segment files.")
+@click.option("--compress", type=click.Choice(["zlib", "lzma", "bz2", "none"]), default="zlib", show_default=True,
+              help="Payload codec, used only with agents that decode it.")
+@click.option("--level", type=int, help="Compression level, the codec's default if not given.")
+@click.option("--read-cache", type=int,
+              help="MiB of small files kept in memory to serve downloads, remembered in store.txt. 0 turns it off.")
+@click.option("--durability", type=click.Choice(["none", "group", "always"]),
+              help="When received files are synced to disk, remembered in store.txt. group, the default, "
+                   "syncs files completing together in shared rounds.")
+@click.option("--commit-window", type=float,
+              help="Milliseconds a group round waits for more files, remembered in store.txt. Default 0.")
+@click.option("--syncfs-min", type=int,
+              help="Files in a group round from which it flushes the whole filesystem instead of each file, "
+                   "which also waits on every other write in progress. Remembered in store.txt, default 16, "
+                   "0 never.")
+@click.option("--rate-limit", type=int, default=0,
+              help="KiB/s of file transfers to all agents together, threaded engine only. 0 is no limit.")
+@click.option("--peer-rate-limit", type=int, default=0,
+              help="KiB/s of file transfers to each agent, threaded engine only. 0 is no limit.")
+@click.option("--metrics", is_flag=True, help="Collect metrics for `inwards stats`, --debug also profiles.")
 @click.pass_context
-def outwards(ctx, username, debug):
-    ctx.obj = Backend(username, debug=debug)
+def outwards(ctx, username, debug, engine, port, ip, workers, max_connections, backlog, layout, compress, level,
+             read_cache, durability, commit_window, syncfs_min, rate_limit, peer_rate_limit, metrics):
+    if layout is not None or read_cache is not None or durability is not None or commit_window is not None \
+            or syncfs_min is not None:
+        store = __unpickling__()
+        if layout is not None:
+            store["layout"] = layout
+        if read_cache is not None:
+            store["read_cache"] = read_cache * 1024 * 1024
+        if durability is not None:
+            store["durability"] = durability
+        if commit_window is not None:
+            store["commit_window"] = commit_window / 1000
+        if syncfs_min is not None:
+            store["syncfs_min"] = syncfs_min
+        __pickling__(store)
+    backend_class = AsyncBackend if engine == "asyncio" else Backend
+    ctx.obj = backend_class(username, debug=debug, port=port, workers=workers,
+                            max_connections=max_connections, backlog=backlog,
+                            compression=None if compress == "none" else compress, compression_level=level,
+                            rate_limit=rate_limit * 1024, peer_rate_limit=peer_rate_limit * 1024, metrics=metrics,
+                            ip=ip)
     wait_and_print_overviews(ctx.obj)
 
 
@@ -71,52 +183,174 @@ def who_around(backend: Backend):
 @outwards.command()
 @click.argument("filepath", type=Path)
 @click.argument("to_who")
+@click.option("--delta", is_flag=True, help="Send only the blocks that differ from the stored version.")
+@click.option("--in-flight", type=int, help="Batches sent before the first is answered, for a directory or glob.")
+@click.option("--quorum", type=int, help="Agents that must store the file when TO_WHO lists several, a majority by default.")
 @click.pass_obj
-def upload(backend: Backend, filepath: Path, to_who: str):
+def upload(backend: Backend, filepath: Path, to_who: str, delta: bool, in_flight: Optional[int], quorum: Optional[int]):
+    """
+    TO_WHO may list several agents separated by commas, the file goes to all of them at once.
+    """
+    if "," in to_who:
+        upload_replicated(backend, filepath, to_who.split(","), quorum)
+        return
     agent = AgentHandler.get_agent(to_who.encode("ascii", "replace"))
+    paths = local_files(filepath)
     if agent is None:
         print(f"No such agent with name '{to_who}' is found.")
+    elif paths is not None:
+        print(f"Uploading {len(paths)} files to '{to_who}'...")
+        print_results(backend.out_upload_many(agent, paths, in_flight))
     else:
         with open(filepath, "r") as f:
             data = f.read(30)
         print(f"Uploading file {filepath.name} to '{to_who}' with data like:\n{ data }...")
-        if not backend.out_upload(agent, filepath):
+        if delta:
+            sent = backend.out_delta_upload(agent, filepath)
+        else:
+            # picks up where an interrupted upload of the same file left off
+            sent = backend.out_upload(agent, filepath, resume=True)
+        if not sent:
             print("Not successful!")
     print()
 
 
+def upload_replicated(backend: Backend, filepath: Path, names: List[str], quorum: Optional[int]) -> None:
+    agents = list()
+    for name in names:
+        agent = AgentHandler.get_agent(name.encode("ascii", "replace"))
+        if agent is None:
+            print(f"No such agent with name '{name}' is found.")
+            return
+        agents.append(agent)
+    if not filepath.is_file():
+        print(f"{filepath} is not a file, only one file goes to several agents at once.")
+        return
+    print(f"Uploading file {filepath.name} to {len(agents)} agents...")
+    replication = backend.out_replicate(agents, filepath, quorum)
+    if replication is None:
+        print("Not successful!")
+        return
+    if replication.quorum_seconds is not None:
+        print(f"Stored on {replication.quorum} agents in {replication.quorum_seconds:.2f} s, finishing the others...")
+    else:
+        print(f"Not successful! Fewer than {replication.quorum} agents stored it.")
+    replication.wait()
+    print_results(replication.results(), "agents")
+    print()
+
+
 @outwards.command()
 @click.argument("filename")
 @click.argument("from_who")
 @click.argument("to_where", type=Path)
+@click.option("--in-flight", type=int, help="Batches asked for before the first is answered, for a glob.")
 @click.pass_obj
-def download(backend: Backend, to_where: Path, from_who: str, filename: str):
+def download(backend: Backend, to_where: Path, from_who: str, filename: str, in_flight: Optional[int]):
     agent = AgentHandler.get_agent(from_who.encode("ascii", "replace"))
     if agent is None:
         print(f"No such agent with name '{from_who}' is found.")
         return
-    sent = backend.out_download(agent, filename, to_where)
-    if not sent:
+    if is_pattern(filename):
+        # to_where is a directory then
+        names = remote_files(backend, from_who, filename)
+        to_where.mkdir(parents=True, exist_ok=True)
+        print(f"Downloading {len(names)} files from '{from_who}' into:\n{ to_where }...")
+        print_results(backend.out_download_many(agent, names, to_where, in_flight))
+        return
+    request = backend.out_download(agent, filename, to_where)
+    if request is None:
         print(f"Couldn't send the download command.")
         return
     print(f"Downloading file {filename} from '{from_who}' into:\n{ to_where }...")
-    print(f"\nPlease wait until your download is ", end=" ")
-    time.sleep(1)
+    print(f"\nPlease wait until your download is ", end=" ", flush=True)
+    # wait as long as bytes keep coming, a stalled download is resumed by the next run
+    received, last_progress = -1, time.monotonic()
+    while not RequestHandler.wait([request], 0.2) and time.monotonic() - last_progress < 10:
+        now_received = FileHandler.client_part_received(to_where)
+        if now_received != received:
+            received, last_progress = now_received, time.monotonic()
+    if not request.future.done():
+        print(f"stalled at {received} bytes. Run the same download again to resume.")
+        return
+    if request.future.exception() is not None:
+        print(f"failed: {request.future.exception()}")
+        return
     print("Done. Your file is: ")
     with to_where.open("rb") as f:
         print(f.read(40))
     print()
 
+@outwards.command()
+@click.argument("filename")
+@click.argument("to_where", type=Path)
+@click.option("--range-size", default=4 * 1024 * 1024, show_default=True, help="Bytes asked from a holder at once.")
+@click.pass_obj
+def swarm_download(backend: Backend, filename: str, to_where: Path, range_size: int):
+    holders = backend.swarm_holders(filename)
+    if not holders:
+        print(f"Nobody around holds {filename}.")
+        return
+    print(f"Downloading file {filename} from {len(holders)} holders into:\n{ to_where }...")
+    if not backend.out_swarm_download(filename, to_where, holders, range_size=range_size):
+        print("Not successful! Holders may have different versions or went away.")
+        return
+    print("Done. Your file is: ")
+    with to_where.open("rb") as f:
+        print(f.read(40))
+    print()
+
+@outwards.command()
+@click.argument("directory", type=Path)
+@click.argument("to_who")
+@click.option("--parallel", default=4, show_default=True, help="Transfers and batches in flight at once.")
+@click.option("--dry-run", is_flag=True, help="Only print what would be sent and deleted.")
+@click.option("--keep", is_flag=True, help="Keep files the agent has but the directory doesn't.")
+@click.pass_obj
+def sync(backend: Backend, directory: Path, to_who: str, parallel: int, dry_run: bool, keep: bool):
+    agent = AgentHandler.get_agent(to_who.encode("ascii", "replace"))
+    if agent is None:
+        print(f"No such agent with name '{to_who}' is found.")
+        return
+    if not directory.is_dir():
+        print(f"{directory} is not a directory.")
+        return
+    local = local_manifest(directory, FileHandler.hash_cache())
+    remote = backend.out_manifest(agent)
+    if remote is None:
+        print(f"Couldn't get the files of '{to_who}'.")
+        return
+    plan = plan_sync(local, remote.files, delete=not keep)
+    for mark, names in (("+", plan.add), ("~", plan.update), ("-", plan.delete)):
+        for name in names:
+            print(f"{mark} {name}")
+    print(f"{len(plan.add)} to add, {len(plan.update)} to update, {len(plan.delete)} to delete.")
+    if dry_run or plan.empty:
+        return
+    print_results(backend.out_sync(agent, directory, plan, parallel))
+
+
 @outwards.command()
 @click.argument("old_filename")
 @click.argument("new_filename")
 @click.argument("from_who")
 @click.pass_obj
 def rename(backend: Backend, old_filename: str, new_filename: str, from_who: str):
+    """
+    With one * in both names renames every match, what * matched is kept: rename "*.txt" "*.bak" bekir
+    """
     agent = AgentHandler.get_agent(from_who.encode("ascii", "replace"))
     if agent is None:
         print(f"No such agent with name '{from_who}' is found.")
         return
+    if old_filename.count("*") == 1 and new_filename.count("*") == 1:
+        old_head, old_tail = old_filename.split("*")
+        new_head, new_tail = new_filename.split("*")
+        pairs = [(name, new_head + name[len(old_head):len(name) - len(old_tail)] + new_tail)
+                 for name in remote_files(backend, from_who, old_filename)]
+        print(f"Renaming {len(pairs)} files...")
+        print_results(backend.out_rename_many(agent, pairs))
+        return
     sent = backend.out_rename(agent, old_filename, new_filename)
     if not sent:
         print(f"Couldn't send the rename command.")
@@ -132,6 +366,11 @@ def delete(backend: Backend, filename: str, from_who: str):
     if agent is None:
         print(f"No such agent with name '{from_who}' is found.")
         return 
+    if is_pattern(filename):
+        names = remote_files(backend, from_who, filename)
+        print(f"Deleting {len(names)} files...")
+        print_results(backend.out_delete_many(agent, names))
+        return
     sent = backend.out_delete(agent, filename)
     if not sent:
         print(f"Couldn't send the delete command.")
@@ -0,0 +1,27 @@
+import unittest
+
+from click.testing import CliRunner
+
+from front_arg import main, outwards
+
+COMMANDS = ("delete", "download", "listen", "rename", "swarm-download", "sync", "upload", "who-around")
+
+
+class Commands(unittest.TestCase):
+    def test_outwards_lists_every_command(self):
+        self.assertEqual(sorted(outwards.commands), sorted(COMMANDS))
+        result = CliRunner().invoke(main, ["outwards", "--help"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        listed = [line.split()[0] for line in result.output.split("Commands:")[1].splitlines() if line.strip()]
+        self.assertEqual(listed, sorted(COMMANDS))
+
+    def test_command_help(self):
+        # called on its own, through outwards the node would start first
+        for name in COMMANDS:
+            result = CliRunner().invoke(outwards.commands[name], ["--help"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Usage:", result.output)
+
+
+if __name__ == '__main__':
+    unittest.main()
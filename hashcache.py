@@ -0,0 +1,106 @@
+import hashlib
+import os
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterable, Optional
+
+# hash algorithms a transfer can be checked with, id on the wire, see protocol.HASH. Most preferred first
+ALGORITHMS = {"blake2b": b"b", "sha256": b"s"}
+NAMES = {v: k for k, v in ALGORITHMS.items()}
+DIGEST_SIZE = 32
+
+
+def new_hash(algo: str):
+    if algo == "blake2b":
+        return hashlib.blake2b(digest_size=DIGEST_SIZE)
+    return hashlib.new(algo)
+
+
+def hash_file(path: Path, algo: str) -> bytes:
+    h = new_hash(algo)
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def tap(chunks: Iterable[bytes], hashes) -> Iterable[bytes]:
+    # chunks unchanged, each one also fed to every hash
+    for chunk in chunks:
+        for h in hashes:
+            h.update(chunk)
+        yield chunk
+
+
+class HashCache:
+    """
+    Digests of files by (device, inode, size, mtime), in storage/.hashes.sqlite.
+    A file that did not change is never read again to be hashed, one that was just received is not read at all.
+    """
+    FILENAME = ".hashes.sqlite"
+
+    def __init__(self, root: Path):
+        self.path = root / self.FILENAME
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                        "dev INTEGER NOT NULL, ino INTEGER NOT NULL, algo TEXT NOT NULL, size INTEGER NOT NULL, "
+                        "mtime INTEGER NOT NULL, digest BLOB NOT NULL, PRIMARY KEY (dev, ino, algo))")
+
+    def digest(self, path: Path, algo: str = "sha256") -> Optional[bytes]:
+        """
+        None if path can't be read.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            row = self.db.execute("SELECT digest FROM hashes WHERE dev = ? AND ino = ? AND algo = ? "
+                                  "AND size = ? AND mtime = ?",
+                                  (st.st_dev, st.st_ino, algo, st.st_size, st.st_mtime_ns)).fetchone()
+            if row is not None:
+                self.hits += 1
+                return row[0]
+            self.misses += 1
+        try:
+            digest = hash_file(path, algo)
+            after = os.stat(path)
+        except OSError:
+            return None
+        # changed while being read, the next call hashes it again
+        if (after.st_size, after.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+            self._store(st, algo, digest)
+        return digest
+
+    def put(self, path: Path, algo: str, digest: bytes) -> None:
+        """
+        Digest of a file just written, computed while its bytes went by.
+        """
+        try:
+            self._store(os.stat(path), algo, digest)
+        except OSError:
+            pass
+
+    def _store(self, st: os.stat_result, algo: str, digest: bytes) -> None:
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                            (st.st_dev, st.st_ino, algo, st.st_size, st.st_mtime_ns, digest))
+
+    @property
+    def hit_rate(self) -> float:
+        asked = self.hits + self.misses
+        return self.hits / asked if asked else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            (entries,) = self.db.execute("SELECT COUNT(*) FROM hashes").fetchone()
+        return {"entries": entries, "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hit_rate, 3)}
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from hashcache import HashCache, hash_file, tap
+
+
+class HashCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.dir.name)
+        self.cache = HashCache(self.root)
+
+    def tearDown(self):
+        self.cache.close()
+        self.dir.cleanup()
+
+    def test_unchanged_file_hashed_once(self):
+        path = self.root / "a.txt"
+        path.write_bytes(b"hello")
+        self.assertEqual(self.cache.digest(path), hashlib.sha256(b"hello").digest())
+        self.assertEqual(self.cache.digest(path), hashlib.sha256(b"hello").digest())
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.cache.hit_rate, 0.5)
+        self.assertEqual(len(self.cache.digest(path, "blake2b")), 32)
+        self.assertEqual(self.cache.stats()["entries"], 2)
+
+    def test_changed_file_hashed_again(self):
+        path = self.root / "a.txt"
+        path.write_bytes(b"hello")
+        self.cache.digest(path)
+        path.write_bytes(b"world")
+        st = path.stat()
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        self.assertEqual(self.cache.digest(path), hashlib.sha256(b"world").digest())
+        self.assertEqual(self.cache.misses, 2)
+        self.assertIsNone(self.cache.digest(self.root / "missing"))
+
+    def test_put_and_persist(self):
+        path = self.root / "a.txt"
+        h = hashlib.sha256()
+        path.write_bytes(b"".join(tap([b"hel", b"lo"], (h,))))
+        self.cache.put(path, "sha256", h.digest())
+        self.cache.close()
+        self.cache = HashCache(self.root)
+        self.assertEqual(self.cache.digest(path), hash_file(path, "sha256"))
+        self.assertEqual(self.cache.hits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
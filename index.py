@@ -0,0 +1,123 @@
+import os
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from containers import FileInfo
+
+
+class MetaIndex:
+    """
+    Name, size, mtime and hash of every stored file, per user, in storage/.index.sqlite.
+    FileHandler updates it in the same step as every put, rename and delete,
+    so an overview is a query instead of a walk over the user's directory.
+    """
+    FILENAME = ".index.sqlite"
+
+    def __init__(self, root: Path):
+        self.path = root / self.FILENAME
+        self._lock = Lock()
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "user TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, "
+                        "mtime REAL NOT NULL, hash TEXT, PRIMARY KEY (user, name))")
+
+    def _transaction(self, statements: Iterable[Tuple[str, tuple]]) -> None:
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, args in statements:
+                    self.db.execute(sql, args)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def put(self, user: str, name: str, size: int, mtime: Optional[float] = None, hash: Optional[str] = None) -> None:
+        self.apply(user, [(name, size, mtime, hash)])
+
+    def delete(self, user: str, name: str) -> None:
+        self.apply(user, deletes=[name])
+
+    def rename(self, user: str, old: str, new: str) -> None:
+        self.apply(user, renames=[(old, new)])
+
+    def apply(self, user: str, puts: Iterable[Tuple[str, int, Optional[float], Optional[str]]] = (),
+              deletes: Iterable[str] = (), renames: Iterable[Tuple[str, str]] = ()) -> None:
+        """
+        Many changes of user's files in one transaction, puts are (name, size, mtime, hash).
+        Renames go last, a renamed entry keeps its mtime and hash.
+        """
+        now = time.time()
+        statements = [("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                       (user, name, size, mtime if mtime is not None else now, hash))
+                      for name, size, mtime, hash in puts]
+        statements += [("DELETE FROM files WHERE user = ? AND name = ?", (user, name)) for name in deletes]
+        for old, new in renames:
+            if old != new:
+                statements.append(("DELETE FROM files WHERE user = ? AND name = ?", (user, new)))
+                statements.append(("UPDATE files SET name = ? WHERE user = ? AND name = ?", (new, user, old)))
+        if statements:
+            self._transaction(statements)
+
+    def files(self, user: str, hashes: bool = False) -> List[FileInfo]:
+        with self._lock:
+            rows = self.db.execute("SELECT name, size, hash FROM files WHERE user = ? ORDER BY name", (user,)).fetchall()
+        return [FileInfo(name, size, hash if hashes else None) for name, size, hash in rows]
+
+    def get(self, user: str, name: str) -> Optional[Tuple[int, float, Optional[str]]]:
+        """
+        (size, mtime, hash)
+        """
+        with self._lock:
+            return self.db.execute("SELECT size, mtime, hash FROM files WHERE user = ? AND name = ?",
+                                   (user, name)).fetchone()
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.db.execute("SELECT user, COUNT(*) FROM files GROUP BY user").fetchall())
+
+    def validate(self, disk: Dict[str, Dict[str, Tuple[int, float]]]) -> int:
+        """
+        Makes the index match what is on disk, user -> name -> (size, mtime).
+        Done once when a node starts, hashes of files that changed behind our back are dropped.
+        Returns how many rows were fixed.
+        """
+        with self._lock:
+            rows = self.db.execute("SELECT user, name, size, mtime FROM files").fetchall()
+        indexed = {(user, name): (size, mtime) for user, name, size, mtime in rows}
+        statements = list()
+        for user, files in disk.items():
+            for name, (size, mtime) in files.items():
+                known = indexed.pop((user, name), None)
+                if known != (size, mtime):
+                    statements.append(("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, NULL)",
+                                       (user, name, size, mtime)))
+        for user, name in indexed:
+            statements.append(("DELETE FROM files WHERE user = ? AND name = ?", (user, name)))
+        if statements:
+            self._transaction(statements)
+        return len(statements)
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def scan_user(path: Path) -> Dict[str, Tuple[int, float]]:
+    """
+    name -> (size, mtime) of every file under path, names of files in subdirectories are relative to path.
+    """
+    files = dict()
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            full = Path(dirpath) / f
+            try:
+                st = full.stat()
+            except OSError:
+                continue
+            files[full.relative_to(path).as_posix()] = (st.st_size, st.st_mtime)
+    return files
@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from containers import FileInfo
+from index import MetaIndex, scan_user
+
+
+class MetaIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.dir.name)
+        self.index = MetaIndex(self.root)
+
+    def tearDown(self):
+        self.index.close()
+        self.dir.cleanup()
+
+    def test_put_rename_delete(self):
+        self.index.put("u", "a.txt", 3, 1.0, "h")
+        self.index.put("u", "b.txt", 5, 2.0)
+        self.index.rename("u", "a.txt", "b.txt")
+        self.assertEqual(self.index.files("u"), [FileInfo("b.txt", 3)])
+        self.assertEqual(self.index.get("u", "b.txt"), (3, 1.0, "h"))
+        self.index.delete("u", "b.txt")
+        self.assertEqual(self.index.files("u"), [])
+
+    def test_validate_against_disk(self):
+        user = self.root / "u"
+        (user / "sub").mkdir(parents=True)
+        (user / "top.txt").write_bytes(b"abc")
+        (user / "sub" / "deep.txt").write_bytes(b"hello")
+        self.index.put("u", "gone.txt", 1)
+        self.assertEqual(self.index.validate({"u": scan_user(user)}), 3)
+        self.assertEqual(self.index.files("u"), [FileInfo("sub/deep.txt", 5), FileInfo("top.txt", 3)])
+        # nothing changed, nothing to fix
+        self.assertEqual(self.index.validate({"u": scan_user(user)}), 0)
+        self.index.close()
+        self.index = MetaIndex(self.root)
+        self.assertEqual(self.index.counts(), {"u": 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import json
+import os
+from pathlib import Path
+from threading import RLock
+from typing import Dict, Optional
+
+from metrics import Metrics
+
+
+class UsageLedger:
+    """
+    Bytes used per user and in total, updated by FileHandler on every put, rename and delete
+    so the quota check never walks the storage tree.
+    The file is written every SAVE_EVERY changes and by save, replaced atomically so `inwards` can read it
+    while a node is running. It is marked clean only by a save at exit, the first change after that
+    unmarks it, and a file that is not clean is rebuilt from the disk when loaded.
+    """
+    FILENAME = ".usage.json"
+    SAVE_EVERY = 256
+
+    def __init__(self, root: Path, capacity: int):
+        self.root = root
+        self.path = root / self.FILENAME
+        self.capacity = capacity
+        self._lock = RLock()
+        self._users: Dict[str, int] = dict()
+        self._total = 0
+        self._unsaved = 0
+        # what the file on disk says
+        self._clean = False
+
+    @classmethod
+    def load(cls, root: Path, capacity: int) -> "UsageLedger":
+        ledger = cls(root, capacity)
+        try:
+            with ledger.path.open("r") as f:
+                saved = json.load(f)
+            if not saved.get("clean"):
+                # a node that is running or did not stop cleanly, changes since its last write are missing
+                raise ValueError("not saved at exit")
+            ledger._users = {user: int(used) for user, used in saved["users"].items()}
+            ledger._total = sum(ledger._users.values())
+            ledger._clean = True
+        except (OSError, ValueError, KeyError, AttributeError):
+            ledger.rebuild()
+        return ledger
+
+    def rebuild(self, users: Optional[Dict[str, int]] = None) -> None:
+        """
+        The only full scan, done once when a node starts.
+        A storage layout that already knows its usage passes it in.
+        """
+        if users is not None:
+            with self._lock:
+                self._users = dict(users)
+                self._total = sum(users.values())
+                self._persist()
+            return
+        users = dict()
+        for user in self.root.iterdir():
+            if not user.is_dir() or user.name.startswith("."):
+                continue
+            used = 0
+            for dirpath, dirnames, filenames in os.walk(user):
+                for f in filenames:
+                    try:
+                        used += os.stat(os.path.join(dirpath, f)).st_size
+                    except OSError:
+                        continue
+            users[user.name] = used
+        with self._lock:
+            self._users = users
+            self._total = sum(users.values())
+            self._persist()
+
+    @property
+    def total(self) -> int:
+        return self._total
+
+    @property
+    def free(self) -> int:
+        return self.capacity - self._total
+
+    def used_by(self, user: str) -> int:
+        return self._users.get(user, 0)
+
+    def users(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._users)
+
+    def reserve(self, user: str, delta: int) -> bool:
+        """
+        Charges delta bytes to user if they fit, atomically with the check.
+        """
+        with Metrics.timer("quota"), self._lock:
+            if delta > 0 and self._total + delta > self.capacity:
+                Metrics.count("quota.refused")
+                return False
+            self.charge(user, delta)
+            return True
+
+    def charge(self, user: str, delta: int) -> None:
+        if delta == 0:
+            return
+        with self._lock:
+            self._users[user] = self._users.get(user, 0) + delta
+            self._total += delta
+            self._unsaved += 1
+            if self._clean or self._unsaved >= self.SAVE_EVERY:
+                self._persist()
+
+    def save(self, clean: bool = False) -> None:
+        """
+        Writes changes not written yet, clean: the node is stopping and makes no more changes.
+        """
+        with self._lock:
+            if self._unsaved or clean != self._clean:
+                self._persist(clean)
+
+    def _persist(self, clean: bool = False) -> None:
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        try:
+            with tmp.open("w") as f:
+                json.dump({"capacity": self.capacity, "total": self._total, "users": self._users,
+                           "clean": clean}, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            # it is rebuilt from the disk next time
+            return
+        self._unsaved = 0
+        self._clean = clean
+
+
+def file_size(path: Path) -> Optional[int]:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return None
@@ -0,0 +1,76 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from ledger import UsageLedger
+
+
+class Quota(unittest.TestCase):
+    def test_reserve_charge_release(self):
+        with tempfile.TemporaryDirectory() as d:
+            ledger = UsageLedger(Path(d), 1000)
+            self.assertTrue(ledger.reserve("bekir", 600))
+            self.assertFalse(ledger.reserve("egemen", 401))
+            self.assertEqual(ledger.used_by("egemen"), 0)
+            self.assertTrue(ledger.reserve("egemen", 400))
+            self.assertEqual(ledger.free, 0)
+            # shrinking always fits, deleting releases
+            self.assertTrue(ledger.reserve("bekir", -100))
+            ledger.charge("egemen", -400)
+            self.assertEqual(ledger.users(), {"bekir": 500, "egemen": 0})
+            self.assertEqual((ledger.total, ledger.free), (500, 500))
+
+    def test_totals_survive_a_restart(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d)
+            ledger = UsageLedger.load(root, 1000)
+            ledger.reserve("bekir", 300)
+            ledger.charge("egemen", 200)
+            # what a node does when it exits
+            ledger.save(clean=True)
+            reloaded = UsageLedger.load(root, 1000)
+            self.assertEqual(reloaded.users(), {"bekir": 300, "egemen": 200})
+            self.assertFalse(reloaded.reserve("bekir", 501))
+
+    def test_written_now_and_then(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d)
+            ledger = UsageLedger.load(root, 10 ** 6)
+            ledger.save(clean=True)
+            ledger = UsageLedger.load(root, 10 ** 6)
+            with mock.patch.object(ledger, "_persist", wraps=ledger._persist) as persist:
+                for _ in range(UsageLedger.SAVE_EVERY * 2):
+                    ledger.charge("bekir", 1)
+                # once to unmark the clean file, then every SAVE_EVERY changes
+                self.assertEqual(persist.call_count, 2)
+                ledger.save()
+                ledger.save()
+                self.assertEqual(persist.call_count, 3)
+            # stopped without a save at exit, the file is behind, so the files on disk count
+            ledger.charge("bekir", 5)
+            (root / "bekir").mkdir()
+            (root / "bekir" / "a").write_bytes(b"x" * 10)
+            self.assertEqual(UsageLedger.load(root, 10 ** 6).users(), {"bekir": 10})
+
+    def test_rebuild_from_disk(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d)
+            (root / "bekir" / "sub").mkdir(parents=True)
+            (root / "bekir" / "a").write_bytes(b"x" * 100)
+            (root / "bekir" / "sub" / "b").write_bytes(b"x" * 50)
+            (root / "egemen").mkdir()
+            (root / "egemen" / "c").write_bytes(b"x" * 7)
+            # bookkeeping of the node is nobody's usage
+            (root / ".packs").mkdir()
+            (root / ".packs" / "index.log").write_bytes(b"x" * 999)
+            # a ledger the node never got to write, or a broken one, is rebuilt from the files
+            (root / UsageLedger.FILENAME).write_text("{not json")
+            ledger = UsageLedger.load(root, 1000)
+            self.assertEqual(ledger.users(), {"bekir": 150, "egemen": 7})
+            self.assertEqual(ledger.total, 157)
+            self.assertEqual(UsageLedger.load(root, 1000).users(), ledger.users())
+
+
+if __name__ == '__main__':
+    unittest.main()
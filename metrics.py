@@ -0,0 +1,222 @@
+"""
+Counters, latency histograms and gauges of a running node.
+
+Everything is off unless Metrics.enabled, then the hot paths only check a flag.
+A running node writes a snapshot to storage/.metrics.json now and then, `inwards stats` reads it,
+since it runs in another process. With profiling on, handlers also run under cProfile and
+allocations are traced with tracemalloc, both end up in the snapshot.
+"""
+import bisect
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+# upper bounds of the histogram buckets in seconds, the last bucket takes the rest
+BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.buckets[bisect.bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket the quantile falls in, never above the largest seen
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(BOUNDS[i], self.max) if i < len(BOUNDS) else self.max
+        return 0.0
+
+    def summary(self) -> Dict[str, float]:
+        return {"count": self.count, "mean": self.total / self.count if self.count else 0.0,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99), "max": self.max}
+
+
+class Metrics:
+    """
+    Used like the handlers in containers.py, Metrics.count("put.failed"), never instantiated.
+    """
+    FILENAME = ".metrics.json"
+    enabled = False
+    profiling = False
+    _lock = threading.Lock()
+    _counters: Dict[str, int] = dict()
+    _histograms: Dict[str, Histogram] = dict()
+    # direction -> peer -> bytes
+    _bytes: Dict[str, Dict[str, int]] = {"in": dict(), "out": dict()}
+    _gauges: Dict[str, Callable[[], float]] = dict()
+    _profiles: List[cProfile.Profile] = list()
+    _local = threading.local()
+    started = time.time()
+
+    @classmethod
+    def enable(cls, profiling: bool = False) -> None:
+        cls.enabled = True
+        cls.profiling = profiling
+        if profiling and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @classmethod
+    def reset(cls) -> None:
+        with cls._lock:
+            cls._counters = dict()
+            cls._histograms = dict()
+            cls._bytes = {"in": dict(), "out": dict()}
+            cls._profiles = list()
+        cls.started = time.time()
+
+    @classmethod
+    def count(cls, name: str, n: int = 1) -> None:
+        if not cls.enabled:
+            return
+        with cls._lock:
+            cls._counters[name] = cls._counters.get(name, 0) + n
+
+    @classmethod
+    def observe(cls, name: str, seconds: float) -> None:
+        if not cls.enabled:
+            return
+        with cls._lock:
+            histogram = cls._histograms.get(name)
+            if histogram is None:
+                histogram = cls._histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @classmethod
+    def transferred(cls, direction: str, peer: str, n: int) -> None:
+        # direction "in" or "out"
+        if not cls.enabled:
+            return
+        with cls._lock:
+            by_peer = cls._bytes[direction]
+            by_peer[peer] = by_peer.get(peer, 0) + n
+
+    @classmethod
+    def gauge(cls, name: str, f: Callable[[], float]) -> None:
+        # read when a snapshot is taken, nothing is done on the hot path
+        cls._gauges[name] = f
+
+    @classmethod
+    @contextmanager
+    def timer(cls, name: str) -> Iterator[None]:
+        if not cls.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.observe(name, time.perf_counter() - start)
+
+    @classmethod
+    def call(cls, name: str, f: Callable, *args):
+        """
+        f(*args) timed as name, under this thread's profiler if profiling.
+        """
+        if not cls.enabled:
+            return f(*args)
+        profiler = cls._profiler() if cls.profiling else None
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError:
+                # newer Pythons profile one thread at a time, this call goes without
+                profiler = None
+        start = time.perf_counter()
+        try:
+            return f(*args)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            cls.observe(name, time.perf_counter() - start)
+
+    @classmethod
+    def _profiler(cls) -> cProfile.Profile:
+        profiler = getattr(cls._local, "profiler", None)
+        if profiler is None:
+            profiler = cls._local.profiler = cProfile.Profile()
+            with cls._lock:
+                cls._profiles.append(profiler)
+        return profiler
+
+    @classmethod
+    def snapshot(cls) -> Dict:
+        with cls._lock:
+            snapshot = {
+                "time": round(time.time(), 3),
+                "uptime": round(time.time() - cls.started, 3),
+                "counters": dict(sorted(cls._counters.items())),
+                "latency": {name: h.summary() for name, h in sorted(cls._histograms.items())},
+                "bytes": {direction: dict(sorted(by_peer.items())) for direction, by_peer in cls._bytes.items()},
+            }
+            profiles = list(cls._profiles)
+        gauges = dict()
+        for name, f in sorted(cls._gauges.items()):
+            try:
+                gauges[name] = f()
+            except Exception:
+                continue
+        snapshot["gauges"] = gauges
+        if cls.profiling:
+            snapshot["profile"] = cls._top_functions(profiles)
+            if tracemalloc.is_tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                top = tracemalloc.take_snapshot().statistics("lineno")[:10]
+                snapshot["memory"] = {"current": current, "peak": peak,
+                                      "top": [f"{stat.traceback[0]}: {stat.size} bytes" for stat in top]}
+        return snapshot
+
+    @staticmethod
+    def _top_functions(profiles: List[cProfile.Profile], n: int = 15) -> List[str]:
+        if not profiles:
+            return list()
+        out = io.StringIO()
+        try:
+            stats = pstats.Stats(profiles[0], stream=out)
+            for profile in profiles[1:]:
+                stats.add(profile)
+        except (TypeError, ValueError):
+            # a profiler that has not run yet
+            return list()
+        stats.sort_stats("cumulative").print_stats(n)
+        return [line for line in out.getvalue().splitlines() if line.strip()]
+
+    @classmethod
+    def save(cls, root: Path) -> None:
+        # replaced atomically, for `inwards stats`
+        if not cls.enabled:
+            return
+        path = root / cls.FILENAME
+        tmp = path.with_name(cls.FILENAME + ".tmp")
+        try:
+            tmp.write_text(json.dumps(cls.snapshot()))
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    @classmethod
+    def load(cls, root: Path) -> Optional[Dict]:
+        try:
+            return json.loads((root / cls.FILENAME).read_text())
+        except (OSError, ValueError):
+            return None
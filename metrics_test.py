@@ -0,0 +1,60 @@
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from metrics import BOUNDS, Histogram, Metrics
+
+
+class HistogramTest(unittest.TestCase):
+    def test_quantiles(self):
+        h = Histogram()
+        for _ in range(98):
+            h.observe(0.0002)
+        h.observe(0.03)
+        h.observe(20)
+        self.assertEqual(h.quantile(0.5), 0.00025)
+        self.assertEqual(h.quantile(0.99), 0.05)
+        self.assertEqual(h.quantile(1.0), 20)
+        self.assertEqual(h.summary()["count"], 100)
+        self.assertEqual(Histogram().quantile(0.5), 0.0)
+        self.assertEqual(len(h.buckets), len(BOUNDS) + 1)
+
+
+class MetricsTest(unittest.TestCase):
+    def tearDown(self):
+        Metrics.enabled = False
+        Metrics.profiling = False
+        Metrics.reset()
+        Metrics._gauges.pop("queued", None)
+
+    def test_disabled_records_nothing(self):
+        Metrics.count("x")
+        Metrics.observe("y", 1)
+        with Metrics.timer("z"):
+            pass
+        self.assertEqual(Metrics.call("c", lambda a: a + 1, 1), 2)
+        snapshot = Metrics.snapshot()
+        self.assertEqual((snapshot["counters"], snapshot["latency"]), ({}, {}))
+
+    def test_snapshot_round_trip(self):
+        Metrics.enable()
+        Metrics.count("put.failed", 2)
+        Metrics.transferred("in", "bekir", 100)
+        Metrics.gauge("queued", lambda: 3)
+        threads = [threading.Thread(target=Metrics.call, args=("command.S", sum, (1, 2))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with tempfile.TemporaryDirectory() as d:
+            Metrics.save(Path(d))
+            snapshot = Metrics.load(Path(d))
+        self.assertEqual(snapshot["counters"], {"put.failed": 2})
+        self.assertEqual(snapshot["latency"]["command.S"]["count"], 4)
+        self.assertEqual(snapshot["bytes"]["in"], {"bekir": 100})
+        self.assertEqual(snapshot["gauges"]["queued"], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
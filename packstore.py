@@ -0,0 +1,427 @@
+"""
+Optional storage layout for many small files: files up to PACK_MAX bytes are appended to segment files,
+larger ones are stored as they are, like in the plain layout.
+
+    storage/.packs/00000001.seg     data of packed files, one after the other
+    storage/.packs/index.log        a RECORD per put and delete, replayed into memory when the store opens
+    storage/<user>/<filename>       files larger than PACK_MAX
+
+Segments are only appended to. Deletes and renames just add records, the bytes they leave behind are
+reclaimed by compaction: the files still live in a mostly dead segment are copied to the current one and the
+segment is removed, and a log of mostly stale records is rewritten with one record per file.
+A put's data and its record are synced in one round, see durable.py. Records keep the crc32 of the data,
+so a record that reached the disk without its data reads as a missing file, never as other bytes.
+"""
+import io
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from pathlib import Path
+from threading import RLock, Thread
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from containers import FileInfo
+from durable import GroupCommit
+from protocol import Source, file_source
+
+PACK_MAX = 64 * 1024
+SEGMENT_SIZE = 64 * 1024 * 1024
+# segments with less than this fraction of live bytes are compacted
+COMPACT_BELOW = 0.5
+# seconds between compactions, 0 for none
+COMPACT_EVERY = 60.0
+# op (P put, X delete), segment (0 stored directly), offset, length, crc32, mtime, then user and filename
+RECORD = struct.Struct("!cIQQIdHH")
+
+
+class Entry(NamedTuple):
+    segment: int
+    offset: int
+    length: int
+    crc: int
+    mtime: float
+
+
+class Segment:
+    def __init__(self, number: int, path: Path, size: int = 0):
+        self.number = number
+        self.path = path
+        self.size = size
+        self.live = 0
+        # reads in progress, a removed segment is closed after the last one
+        self.readers = 0
+        self.removed = False
+        self._fd: Optional[int] = None
+
+    def fd(self) -> int:
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDONLY)
+        return self._fd
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class BytesRanges:
+    def __init__(self, f):
+        self.f = f
+
+    def read_range(self, offset: int, length: int) -> bytes:
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class PackStore:
+    def __init__(self, root: Path, committer: Optional[GroupCommit] = None, pack_max: int = PACK_MAX,
+                 segment_size: int = SEGMENT_SIZE, compact_every: float = COMPACT_EVERY):
+        self.root = root
+        self.dir = root / ".packs"
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.log_path = self.dir / "index.log"
+        self.committer = committer if committer is not None else GroupCommit("none")
+        self.pack_max = pack_max
+        self.segment_size = segment_size
+        self._lock = RLock()
+        # one compaction at a time, it is the only one removing segments
+        self._compacting = threading.Lock()
+        self._files: Dict[str, Dict[str, Entry]] = dict()
+        self._logical: Dict[str, int] = dict()
+        self._segments: Dict[int, Segment] = dict()
+        self._records = 0
+        self._load()
+        self._log_fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._active = self._segments[max(self._segments)] if self._segments else self._new_segment()
+        self._write_fd = os.open(self._active.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.compacted = 0
+        if compact_every > 0:
+            Thread(target=self._compact_forever, args=(compact_every,), name="compaction", daemon=True).start()
+
+    def _load(self) -> None:
+        for path in self.dir.glob("*.tmp"):
+            path.unlink()
+        for path in self.dir.glob("*.seg"):
+            number = int(path.stem)
+            self._segments[number] = Segment(number, path, path.stat().st_size)
+        try:
+            data = self.log_path.read_bytes()
+        except OSError:
+            data = b""
+        position = 0
+        while position + RECORD.size <= len(data):
+            op, segment, offset, length, crc, mtime, user_len, name_len = RECORD.unpack_from(data, position)
+            end = position + RECORD.size + user_len + name_len
+            if end > len(data):
+                break
+            start = position + RECORD.size
+            user = data[start:start + user_len].decode("utf-8", "replace")
+            filename = data[start + user_len:end].decode("utf-8", "replace")
+            self._set(user, filename, Entry(segment, offset, length, crc, mtime) if op == b"P" else None)
+            self._records += 1
+            position = end
+        if position < len(data):
+            # the last record was cut by a crash, its put never returned
+            with self.log_path.open("r+b") as f:
+                f.truncate(position)
+        for user, files in self._files.items():
+            for filename, entry in list(files.items()):
+                if entry.segment and entry.segment not in self._segments:
+                    print(f"{user}/{filename} is in a segment that is gone", file=sys.stderr)
+                    self._set(user, filename, None)
+        newest = max(self._segments, default=0)
+        for segment in list(self._segments.values()):
+            if segment.live == 0 and segment.number != newest:
+                self._remove(segment)
+        if newest and self._segments[newest].size >= self.segment_size:
+            self._new_segment()
+
+    def _new_segment(self) -> Segment:
+        number = max(self._segments, default=0) + 1
+        segment = Segment(number, self.dir / f"{number:08}.seg")
+        segment.path.touch()
+        self._segments[number] = segment
+        return segment
+
+    def _remove(self, segment: Segment) -> None:
+        del self._segments[segment.number]
+        segment.removed = True
+        if segment.readers == 0:
+            segment.close()
+        segment.path.unlink()
+
+    def _direct(self, user: str, filename: str) -> Path:
+        return self.root / user / filename
+
+    def _set(self, user: str, filename: str, entry: Optional[Entry]) -> Optional[Entry]:
+        # the entry of filename in memory, live bytes and usage follow. The one it replaced.
+        files = self._files.setdefault(user, dict())
+        old = files.pop(filename, None) if entry is None else files.get(filename)
+        if entry is not None:
+            files[filename] = entry
+        for e, sign in ((old, -1), (entry, 1)):
+            if e is None:
+                continue
+            self._logical[user] = self._logical.get(user, 0) + sign * e.length
+            if e.segment in self._segments:
+                self._segments[e.segment].live += sign * e.length
+        return old
+
+    @staticmethod
+    def _record(op: bytes, user: str, filename: str, entry: Optional[Entry]) -> bytes:
+        u, n = user.encode("utf-8"), filename.encode("utf-8")
+        entry = entry or Entry(0, 0, 0, 0, 0.0)
+        return RECORD.pack(op, entry.segment, entry.offset, entry.length, entry.crc, entry.mtime, len(u), len(n)) + u + n
+
+    def _log(self, records: List[bytes]) -> None:
+        write_fully(self._log_fd, b"".join(records))
+        self._records += len(records)
+
+    def _append(self, data: bytes) -> Tuple[Segment, int]:
+        # under the lock
+        if self._active.size > 0 and self._active.size + len(data) > self.segment_size:
+            os.close(self._write_fd)
+            self._active = self._new_segment()
+            self._write_fd = os.open(self._active.path, os.O_WRONLY | os.O_APPEND, 0o644)
+        segment, offset = self._active, self._active.size
+        write_fully(self._write_fd, data)
+        segment.size += len(data)
+        return segment, offset
+
+    def size(self, user: str, filename: str) -> Optional[int]:
+        with self._lock:
+            entry = self._files.get(user, {}).get(filename)
+        return entry.length if entry is not None else None
+
+    def put(self, user: str, filename: str, pieces: Iterable[bytes]) -> int:
+        pieces = iter(pieces)
+        buffered = bytearray()
+        for piece in pieces:
+            buffered += piece
+            if len(buffered) > self.pack_max:
+                return self._put_direct(user, filename, buffered, pieces)
+        data = bytes(buffered)
+        with self._lock:
+            segment, offset = self._append(data)
+            entry = Entry(segment.number, offset, len(data), zlib.crc32(data), time.time())
+            old = self._set(user, filename, entry)
+            self._log([self._record(b"P", user, filename, entry)])
+        if old is not None and old.segment == 0:
+            self._direct(user, filename).unlink(missing_ok=True)
+        self.committer.sync([segment.path, self.log_path])
+        return len(data)
+
+    def _put_direct(self, user: str, filename: str, head: bytes, rest: Iterable[bytes]) -> int:
+        tmp = self.dir / f"{threading.get_ident()}.tmp"
+        path = self._direct(user, filename)
+        try:
+            with tmp.open("wb") as f:
+                f.write(head)
+                for piece in rest:
+                    f.write(piece)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.committer.replace(tmp, path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        stat = path.stat()
+        entry = Entry(0, 0, stat.st_size, 0, stat.st_mtime)
+        with self._lock:
+            self._set(user, filename, entry)
+            self._log([self._record(b"P", user, filename, entry)])
+        self.committer.sync([self.log_path])
+        return entry.length
+
+    def _read(self, user: str, filename: str) -> Tuple[Optional[Entry], Optional[bytes]]:
+        """
+        (entry, data) of a packed file with one pread, (entry, None) of a file stored directly
+        """
+        with self._lock:
+            entry = self._files.get(user, {}).get(filename)
+            if entry is None or entry.segment == 0:
+                return entry, None
+            segment = self._segments[entry.segment]
+            segment.readers += 1
+            fd = segment.fd()
+        try:
+            data = os.pread(fd, entry.length, entry.offset)
+        finally:
+            with self._lock:
+                segment.readers -= 1
+                if segment.removed and segment.readers == 0:
+                    segment.close()
+        if len(data) != entry.length or zlib.crc32(data) != entry.crc:
+            print(f"{user}/{filename} in {segment.path.name} is damaged", file=sys.stderr)
+            return None, None
+        return entry, data
+
+    def get(self, user: str, filename: str) -> Optional[Source]:
+        entry, data = self._read(user, filename)
+        if entry is None:
+            return None
+        if data is None:
+            return file_source(self._direct(user, filename))
+        return Source(len(data), (data,))
+
+    def get_range(self, user: str, filename: str, offset: int, length: int) -> Optional[Tuple[int, Source]]:
+        """
+        (file size, source of the range), length 0 means up to the end
+        """
+        entry, data = self._read(user, filename)
+        if entry is None:
+            return None
+        if data is None:
+            return entry.length, file_source(self._direct(user, filename), offset, length)
+        offset = min(offset, len(data))
+        length = len(data) - offset if length == 0 else min(length, len(data) - offset)
+        return len(data), Source(length, (memoryview(data)[offset:offset + length],))
+
+    def open_ranges(self, user: str, filename: str) -> Optional[BytesRanges]:
+        entry, data = self._read(user, filename)
+        if entry is None:
+            return None
+        return BytesRanges(io.BytesIO(data) if data is not None else self._direct(user, filename).open("rb"))
+
+    def delete(self, user: str, filename: str) -> bool:
+        with self._lock:
+            old = self._set(user, filename, None)
+            if old is None:
+                return False
+            self._log([self._record(b"X", user, filename, None)])
+        if old.segment == 0:
+            self._direct(user, filename).unlink(missing_ok=True)
+        self.committer.sync([self.log_path])
+        return True
+
+    def rename(self, user: str, filename_old: str, filename_new: str) -> bool:
+        with self._lock:
+            entry = self._files.get(user, {}).get(filename_old)
+            if entry is None:
+                return False
+            if filename_old == filename_new:
+                return True
+            dirs = list()
+            if entry.segment == 0:
+                path = self._direct(user, filename_new)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(self._direct(user, filename_old), path)
+                dirs.append(path.parent)
+            replaced = self._set(user, filename_new, entry)
+            self._set(user, filename_old, None)
+            # the new name first, a crash in between leaves both rather than neither
+            self._log([self._record(b"P", user, filename_new, entry), self._record(b"X", user, filename_old, None)])
+        if replaced is not None and replaced.segment == 0 and entry.segment != 0:
+            self._direct(user, filename_new).unlink(missing_ok=True)
+        self.committer.sync([self.log_path], dirs)
+        return True
+
+    def mtime(self, user: str, filename: str) -> Optional[float]:
+        with self._lock:
+            entry = self._files.get(user, {}).get(filename)
+        return entry.mtime if entry is not None else None
+
+    def users(self) -> List[str]:
+        with self._lock:
+            return [user for user, files in self._files.items() if files]
+
+    def files(self, user: str) -> List[FileInfo]:
+        with self._lock:
+            return [FileInfo(filename, entry.length) for filename, entry in self._files.get(user, {}).items()]
+
+    def usage(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._logical)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            packed = sum(entry.segment != 0 for files in self._files.values() for entry in files.values())
+            size = sum(segment.size for segment in self._segments.values())
+            live = sum(segment.live for segment in self._segments.values())
+            return {"files": sum(len(files) for files in self._files.values()), "packed": packed,
+                    "segments": len(self._segments), "segment_bytes": size, "live_bytes": live,
+                    "dead_ratio": round(1 - live / size, 3) if size else 0.0, "compacted_bytes": self.compacted}
+
+    def compact(self) -> int:
+        """
+        Moves the live files out of mostly dead segments and removes those, rewrites a mostly stale log.
+        Bytes reclaimed.
+        """
+        with self._compacting:
+            return self._compact()
+
+    def _compact(self) -> int:
+        with self._lock:
+            sparse = [segment for segment in self._segments.values() if segment is not self._active
+                      and segment.size > 0 and segment.live < segment.size * COMPACT_BELOW]
+        reclaimed = 0
+        for segment in sparse:
+            with self._lock:
+                live = [(user, filename, entry) for user, files in self._files.items()
+                        for filename, entry in files.items() if entry.segment == segment.number]
+            records, written = list(), set()
+            for user, filename, entry in live:
+                data = os.pread(segment.fd(), entry.length, entry.offset)
+                if zlib.crc32(data) != entry.crc:
+                    continue
+                with self._lock:
+                    if self._files.get(user, {}).get(filename) != entry:
+                        # changed meanwhile
+                        continue
+                    target, offset = self._append(data)
+                    moved = entry._replace(segment=target.number, offset=offset)
+                    self._set(user, filename, moved)
+                    records.append(self._record(b"P", user, filename, moved))
+                    written.add(target.path)
+            with self._lock:
+                self._log(records)
+            # the new places are on disk before the old one goes
+            self.committer.sync(list(written) + [self.log_path])
+            with self._lock:
+                if segment.live == 0 and segment.number in self._segments:
+                    reclaimed += segment.size
+                    self._remove(segment)
+        with self._lock:
+            if self._records > 2 * sum(len(files) for files in self._files.values()) + 1024:
+                self._rewrite_log()
+            self.compacted += reclaimed
+        return reclaimed
+
+    def _rewrite_log(self) -> None:
+        # under the lock, one record per file
+        tmp = self.log_path.with_name(self.log_path.name + ".tmp")
+        records = [self._record(b"P", user, filename, entry)
+                   for user, files in self._files.items() for filename, entry in files.items()]
+        tmp.write_bytes(b"".join(records))
+        self.committer.sync([tmp])
+        os.replace(tmp, self.log_path)
+        self.committer.sync(dirs=[self.dir])
+        os.close(self._log_fd)
+        self._log_fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND, 0o644)
+        self._records = len(records)
+
+    def _compact_forever(self, every: float) -> None:
+        while True:
+            time.sleep(every)
+            try:
+                self.compact()
+            except OSError as e:
+                print(f"Compaction failed: {e}", file=sys.stderr)
+
+    def close(self) -> None:
+        with self._lock:
+            os.close(self._log_fd)
+            os.close(self._write_fd)
+            for segment in self._segments.values():
+                segment.close()
+
+
+def write_fully(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
@@ -0,0 +1,71 @@
+import random
+import tempfile
+import unittest
+from pathlib import Path
+
+from packstore import *
+
+
+class Store(unittest.TestCase):
+    def test_packed_and_direct(self):
+        rng = random.Random(1)
+        small, large = rng.randbytes(3000), rng.randbytes(PACK_MAX + 1)
+        with tempfile.TemporaryDirectory() as d:
+            store = PackStore(Path(d), compact_every=0)
+            self.assertEqual(store.put("bekir", "a", [small[:1000], small[1000:]]), len(small))
+            store.put("bekir", "big", [large])
+            self.assertTrue((Path(d) / "bekir" / "big").is_file())
+            self.assertFalse((Path(d) / "bekir" / "a").exists())
+            self.assertEqual(b"".join(store.get("bekir", "a").chunks), small)
+            self.assertEqual(bytes(store.get_range("bekir", "a", 10, 5)[1].chunks[0]), small[10:15])
+            self.assertTrue(store.rename("bekir", "a", "b"))
+            self.assertTrue(store.rename("bekir", "big", "huge"))
+            self.assertTrue(store.delete("bekir", "huge"))
+            self.assertIsNone(store.get("bekir", "a"))
+            self.assertEqual(store.usage(), {"bekir": len(small)})
+            store.close()
+
+            reopened = PackStore(Path(d), compact_every=0)
+            self.assertEqual([info.name for info in reopened.files("bekir")], ["b"])
+            self.assertEqual(b"".join(reopened.get("bekir", "b").chunks), small)
+            self.assertEqual(list((Path(d) / "bekir").iterdir()), [])
+            reopened.close()
+
+    def test_compaction_reclaims_dead_segments(self):
+        rng = random.Random(2)
+        files = {f"f{i}": rng.randbytes(1000) for i in range(40)}
+        with tempfile.TemporaryDirectory() as d:
+            store = PackStore(Path(d), segment_size=4000, compact_every=0)
+            for name, data in files.items():
+                store.put("egemen", name, [data])
+            for i in range(0, 40, 4):
+                for j in (1, 2, 3):
+                    store.delete("egemen", f"f{i + j}")
+            before = store.stats()["segment_bytes"]
+            self.assertGreater(store.compact(), 0)
+            self.assertLess(store.stats()["segment_bytes"], before)
+            for i in range(0, 40, 4):
+                self.assertEqual(b"".join(store.get("egemen", f"f{i}").chunks), files[f"f{i}"])
+            store.close()
+            reopened = PackStore(Path(d), compact_every=0)
+            self.assertEqual(len(reopened.files("egemen")), 10)
+            reopened.close()
+
+    def test_torn_log_and_damaged_data(self):
+        with tempfile.TemporaryDirectory() as d:
+            store = PackStore(Path(d), compact_every=0)
+            store.put("bekir", "a", [b"hello"])
+            store.put("bekir", "b", [b"world"])
+            store.close()
+            log = Path(d) / ".packs" / "index.log"
+            log.write_bytes(log.read_bytes()[:-3])
+            segment = next((Path(d) / ".packs").glob("*.seg"))
+            segment.write_bytes(b"jello" + segment.read_bytes()[5:])
+            reopened = PackStore(Path(d), compact_every=0)
+            self.assertEqual([info.name for info in reopened.files("bekir")], ["a"])
+            self.assertIsNone(reopened.get("bekir", "a"))
+            reopened.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import json
+import os
+from pathlib import Path
+from typing import Callable, Iterable, Tuple
+
+
+class PartFile:
+    """
+    A transfer that may be cut and resumed.
+    <path>.part holds the bytes received so far, <path>.part.json how many of them are known to be on disk.
+    Bytes past the saved offset are not trusted and get overwritten on resume.
+    """
+    SAVE_EVERY = 4 * 1024 * 1024
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.part = path.with_name(path.name + ".part")
+        self.state = path.with_name(path.name + ".part.json")
+
+    def load(self) -> Tuple[int, int]:
+        """
+        (verified offset, total size), (0, 0) when there is nothing to resume.
+        """
+        try:
+            with self.state.open("r") as f:
+                d = json.load(f)
+            offset, total = int(d["offset"]), int(d["total"])
+        except (OSError, ValueError, KeyError):
+            return 0, 0
+        if not self.part.is_file() or self.part.stat().st_size < offset:
+            return 0, 0
+        return offset, total
+
+    def _save(self, offset: int, total: int) -> None:
+        tmp = self.state.with_name(self.state.name + ".tmp")
+        with tmp.open("w") as f:
+            json.dump({"offset": offset, "total": total}, f)
+        os.replace(tmp, self.state)
+
+    def write(self, chunks: Iterable[bytes], offset: int, total: int) -> bool:
+        """
+        Writes chunks at offset, True when the part reached total.
+        Raises ValueError if offset leaves a gap after what is stored.
+        A part of another total is of another version of the file, it is dropped and the transfer starts over.
+        """
+        verified, known_total = self.load()
+        if known_total != total:
+            if self.part.exists() or self.state.exists():
+                self.discard()
+            verified = 0
+        if offset > verified:
+            raise ValueError(f"{self.part} has {verified} bytes, can't continue at {offset}")
+        self.part.parent.mkdir(parents=True, exist_ok=True)
+        position = offset
+        saved = offset
+        with self.part.open("r+b" if self.part.exists() else "w+b") as f:
+            f.truncate(offset)
+            f.seek(offset)
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+                    position += len(chunk)
+                    if position - saved >= self.SAVE_EVERY:
+                        f.flush()
+                        os.fsync(f.fileno())
+                        self._save(position, total)
+                        saved = position
+            finally:
+                f.flush()
+                os.fsync(f.fileno())
+                self._save(position, total)
+        if position > total:
+            self.discard()
+            raise ValueError(f"{self.part} got {position} bytes, expected {total}")
+        return position == total
+
+    def commit(self, dest: Path, replace: Callable[[Path, Path], None] = os.replace) -> None:
+        # replace: a GroupCommit's, to wait for the directory entry as well, see durable.py
+        replace(self.part, dest)
+        self.state.unlink()
+
+    def discard(self) -> None:
+        for path in (self.part, self.state):
+            if path.exists():
+                path.unlink()
@@ -0,0 +1,58 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from partial import PartFile
+
+
+def broken(data: bytes, at: int):
+    yield data[:at]
+    raise ConnectionError("cut")
+
+
+class Resume(unittest.TestCase):
+    def test_resume_at_offset(self):
+        data = bytes(range(256)) * 64
+        with tempfile.TemporaryDirectory() as d:
+            part = PartFile(Path(d) / "f")
+            with self.assertRaises(ConnectionError):
+                part.write(broken(data, 5000), 0, len(data))
+            offset, total = part.load()
+            self.assertEqual((offset, total), (5000, len(data)))
+            self.assertTrue(part.write([data[offset:]], offset, total))
+            self.assertEqual(part.part.read_bytes(), data)
+            part.commit(Path(d) / "f")
+            self.assertEqual((Path(d) / "f").read_bytes(), data)
+            self.assertFalse(part.state.exists())
+
+    def test_total_changed_restarts(self):
+        old, new = b"a" * 8000, b"b" * 9000
+        with tempfile.TemporaryDirectory() as d:
+            part = PartFile(Path(d) / "f")
+            with self.assertRaises(ConnectionError):
+                part.write(broken(old, 3000), 0, len(old))
+            # the sender already has a new version and continues at the old offset
+            with self.assertRaises(ValueError):
+                part.write([new[3000:]], 3000, len(new))
+            self.assertEqual(part.load(), (0, 0))
+            self.assertTrue(part.write([new], 0, len(new)))
+            self.assertEqual(part.part.read_bytes(), new)
+
+    def test_truncated_part(self):
+        data = b"c" * 10000
+        with tempfile.TemporaryDirectory() as d:
+            part = PartFile(Path(d) / "f")
+            with self.assertRaises(ConnectionError):
+                part.write(broken(data, 6000), 0, len(data))
+            with part.part.open("r+b") as f:
+                f.truncate(100)
+            # fewer bytes on disk than recorded, nothing can be trusted
+            self.assertEqual(part.load(), (0, 0))
+            with self.assertRaises(ValueError):
+                part.write([data[6000:]], 6000, len(data))
+            self.assertTrue(part.write([data], 0, len(data)))
+            self.assertEqual(part.part.read_bytes(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,293 @@
+"""
+Every message is one frame:
+
+    username   10 bytes, \0 padded from right
+    command     1 byte
+    name len    2 bytes, big endian
+    length      8 bytes, big endian, payload length
+    name        <name len> bytes
+    payload     <length> bytes, streamed in CHUNK_SIZE pieces
+
+The end of a message is known from the length field, so many frames can
+share a connection and payloads never have to be held in memory whole.
+"""
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterable, Iterator, NamedTuple, Optional, Tuple
+
+
+CHUNK_SIZE = 64 * 1024
+
+HEADER = struct.Struct("!10scHQ")
+
+# Ranged transfers carry it after the filename: name\0RANGE
+#   D: offset, length (0 is up to the end)   U, P: offset, total file size   V: offset, total
+RANGE = struct.Struct("!QQ")
+# A request whose replies must be told apart sets TAGGED in the command byte and puts REQUEST_ID
+# before the name, replies carry the same id. Only sent to agents that understand it, see Backend
+TAGGED = 0x80
+REQUEST_ID = struct.Struct("!I")
+# Compressed U and P payloads end the name with it: name\0[RANGE]CODEC, see compress.py
+#   U, P: codec id, decoded length   D: codec id the requester accepts, 0
+CODEC = struct.Struct("!cQ")
+# Checked U and P names end with it after everything else: name\0[RANGE][CODEC]HASH, see hashcache.py
+#   U, P: algorithm id, digest of the whole file   D: algorithm the requester checks with, zeros
+HASH = struct.Struct("!c32s")
+
+Recv = Callable[[int], bytes]
+# recv_into(buffer, nbytes) -> received, like socket.recv_into
+RecvInto = Callable[[memoryview, int], int]
+# sendfile(file, offset, count) -> sent, like socket.sendfile
+SendFile = Callable[[BinaryIO, int, int], int]
+
+
+class Head(NamedTuple):
+    user: bytes
+    command: bytes
+    name: bytes
+    length: int
+    # 0 if the frame is not tagged
+    request: int = 0
+
+
+class Source(NamedTuple):
+    length: int
+    chunks: Iterable[bytes]
+
+    @classmethod
+    def of_bytes(cls, data: bytes) -> "Source":
+        return cls(len(data), (data,) if data else ())
+
+
+class FileChunks:
+    """
+    Re-iterable, every iteration opens the file again, so a failed send can be retried.
+    """
+    def __init__(self, path: Path, length: int, offset: int = 0):
+        self.path = path
+        self.length = length
+        self.offset = offset
+
+    def __iter__(self) -> Iterator[bytes]:
+        remaining = self.length
+        with self.path.open("rb") as f:
+            f.seek(self.offset)
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"{self.path} shrank while being sent")
+                remaining -= len(chunk)
+                yield chunk
+
+    def send_with(self, sendfile: SendFile) -> None:
+        """
+        Lets the kernel copy the file to the socket, nothing passes through Python.
+        """
+        with self.path.open("rb") as f:
+            sent = sendfile(f, self.offset, self.length)
+        if sent != self.length:
+            raise IOError(f"{self.path} shrank while being sent")
+
+
+def file_source(path: Path, offset: int = 0, length: int = 0) -> Source:
+    """
+    length 0 means up to the end of the file
+    """
+    size = path.stat().st_size
+    offset = min(offset, size)
+    length = size - offset if length == 0 else min(length, size - offset)
+    return Source(length, FileChunks(path, length, offset))
+
+
+class MappedChunks:
+    """
+    Re-iterable views of a file mapped once, any number of sends can go through it at the same time
+    and the file is read from disk once for all of them.
+    """
+    def __init__(self, data: mmap.mmap):
+        self.data = data
+
+    def __iter__(self) -> Iterator[memoryview]:
+        view = memoryview(self.data)
+        for start in range(0, len(view), CHUNK_SIZE):
+            yield view[start:start + CHUNK_SIZE]
+
+
+def mapped_source(path: Path) -> Source:
+    with path.open("rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return Source(0, ())
+        # the mapping outlives the file object, it is unmapped when the last view is gone
+        return Source(size, MappedChunks(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)))
+
+
+def is_replayable(source: Source) -> bool:
+    return iter(source.chunks) is not source.chunks
+
+
+def with_range(filename: bytes, offset: int, length: int) -> bytes:
+    return filename + b"\0" + RANGE.pack(offset, length)
+
+
+def split_range(name: bytes) -> Tuple[bytes, Optional[Tuple[int, int]]]:
+    filename, sep, rest = name.partition(b"\0")
+    if not sep or len(rest) != RANGE.size:
+        return filename, None
+    return filename, RANGE.unpack(rest)
+
+
+def with_codec(name: bytes, codec: bytes, length: int) -> bytes:
+    return name + (b"" if b"\0" in name else b"\0") + CODEC.pack(codec, length)
+
+
+def split_codec(name: bytes) -> Tuple[bytes, Optional[Tuple[bytes, int]]]:
+    """
+    (name without the codec, (codec id, length) or None), the rest is left to split_range.
+    """
+    filename, sep, rest = name.partition(b"\0")
+    if len(rest) == CODEC.size:
+        return filename, CODEC.unpack(rest)
+    if len(rest) == RANGE.size + CODEC.size:
+        return filename + sep + rest[:RANGE.size], CODEC.unpack(rest[RANGE.size:])
+    return name, None
+
+
+def with_hash(name: bytes, algo: bytes, digest: bytes = b"") -> bytes:
+    return name + (b"" if b"\0" in name else b"\0") + HASH.pack(algo, digest)
+
+
+def split_hash(name: bytes) -> Tuple[bytes, Optional[Tuple[bytes, bytes]]]:
+    """
+    (name without the hash, (algorithm id, digest) or None), the rest is left to split_codec.
+    """
+    filename, sep, rest = name.partition(b"\0")
+    if len(rest) - HASH.size not in (0, RANGE.size, CODEC.size, RANGE.size + CODEC.size):
+        return name, None
+    algo, digest = HASH.unpack(rest[-HASH.size:])
+    rest = rest[:-HASH.size]
+    return filename + (sep if rest else b"") + rest, (algo, digest)
+
+
+def pack_head(user: bytes, command: bytes, name: bytes, length: int, request: int = 0) -> bytes:
+    if request:
+        command = bytes([command[0] | TAGGED])
+        name = REQUEST_ID.pack(request) + name
+    return HEADER.pack(user.ljust(10, b"\0")[:10], command, len(name), length) + name
+
+
+def make_head(user: bytes, command: bytes, name: bytes, length: int) -> Head:
+    """
+    Head of the fields as they came off the wire, a tag is taken apart.
+    """
+    user = user.rstrip(b"\0")
+    if command[0] & TAGGED and len(name) >= REQUEST_ID.size:
+        (request,) = REQUEST_ID.unpack_from(name)
+        return Head(user, bytes([command[0] & ~TAGGED]), name[REQUEST_ID.size:], length, request)
+    return Head(user, command, name, length)
+
+
+def recv_exact(recv: Recv, n: int, eof_ok: bool = False) -> Optional[bytes]:
+    """
+    Reads exactly n bytes. If eof_ok, a clean close before the first byte returns None.
+    """
+    parts = list()
+    remaining = n
+    while remaining > 0:
+        part = recv(remaining)
+        if not part:
+            if eof_ok and remaining == n:
+                return None
+            raise ConnectionError(f"connection closed, {remaining} of {n} bytes missing")
+        parts.append(part)
+        remaining -= len(part)
+    return b"".join(parts)
+
+
+def read_head(recv: Recv) -> Optional[Head]:
+    fixed = recv_exact(recv, HEADER.size, eof_ok=True)
+    if fixed is None:
+        return None
+    user, command, name_len, length = HEADER.unpack(fixed)
+    name = recv_exact(recv, name_len)
+    return make_head(user, command, name, length)
+
+
+class PayloadReader:
+    """
+    Yields the payload of one frame chunk by chunk, never reading past its end.
+    """
+    def __init__(self, recv: Recv, length: int, recv_into: Optional[RecvInto] = None,
+                 buffer: Optional[bytearray] = None):
+        """
+        recv_into, buffer: the connection's reusable receive buffer, see views
+        """
+        self.recv = recv
+        self.length = length
+        self.remaining = length
+        self.recv_into = recv_into
+        self.buffer = buffer
+
+    def __iter__(self) -> Iterator[bytes]:
+        while self.remaining > 0:
+            part = self.recv(min(CHUNK_SIZE, self.remaining))
+            if not part:
+                raise ConnectionError(f"connection closed, {self.remaining} payload bytes missing")
+            self.remaining -= len(part)
+            yield part
+
+    def views(self) -> Iterator[memoryview]:
+        """
+        Like iterating, but every piece is received into the same buffer without allocating.
+        A view is only valid until the next one is taken, consumers must write it out or copy it.
+        """
+        if self.recv_into is None:
+            yield from self
+            return
+        view = memoryview(self.buffer if self.buffer is not None else bytearray(CHUNK_SIZE))
+        while self.remaining > 0:
+            n = self.recv_into(view, min(len(view), self.remaining))
+            if not n:
+                raise ConnectionError(f"connection closed, {self.remaining} payload bytes missing")
+            self.remaining -= n
+            yield view[:n]
+
+    def read(self, n: int) -> bytes:
+        """
+        Exactly n bytes of the payload, for payloads with their own structure.
+        """
+        if n > self.remaining:
+            raise ConnectionError(f"{n} bytes asked, {self.remaining} left in payload")
+        data = recv_exact(self.recv, n)
+        self.remaining -= n
+        return data
+
+    def read_all(self) -> bytes:
+        return b"".join(self)
+
+    def drain(self) -> None:
+        for _ in self:
+            pass
+
+
+def send_frame(sendall: Callable[[bytes], None], user: bytes, command: bytes,
+               name: bytes = b"", source: Source = Source(0, ()), sendfile: Optional[SendFile] = None,
+               request: int = 0) -> None:
+    """
+    sendfile: if given, a payload read from a file goes with it
+    request: tags the frame, see TAGGED
+    """
+    sendall(pack_head(user, command, name, source.length, request))
+    if sendfile is not None and isinstance(source.chunks, FileChunks) and source.chunks.length == source.length:
+        source.chunks.send_with(sendfile)
+        return
+    sent = 0
+    for chunk in source.chunks:
+        sent += len(chunk)
+        if sent > source.length:
+            raise IOError("payload is longer than announced")
+        sendall(chunk)
+    if sent != source.length:
+        raise IOError(f"payload is {sent} bytes, announced {source.length}")
@@ -0,0 +1,109 @@
+import io
+import socket
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from protocol import *
+
+
+class Framing(unittest.TestCase):
+    def test_roundtrip_many_frames(self):
+        out = io.BytesIO()
+        send_frame(out.write, b"bekir", b"U", b"a.txt", Source.of_bytes(b"hello"))
+        send_frame(out.write, b"bekir", b"S")
+        recv = io.BytesIO(out.getvalue()).read
+
+        head = read_head(recv)
+        self.assertEqual(head, Head(b"bekir", b"U", b"a.txt", 5))
+        self.assertEqual(PayloadReader(recv, head.length).read_all(), b"hello")
+        head = read_head(recv)
+        self.assertEqual(head, Head(b"bekir", b"S", b"", 0))
+        self.assertIsNone(read_head(recv))
+
+    def test_tagged_frame(self):
+        out = io.BytesIO()
+        send_frame(out.write, b"bekir", b"D", b"a.txt", request=7)
+        send_frame(out.write, b"bekir", b"D", b"a.txt")
+        recv = io.BytesIO(out.getvalue()).read
+        self.assertEqual(read_head(recv), Head(b"bekir", b"D", b"a.txt", 0, 7))
+        self.assertEqual(read_head(recv), Head(b"bekir", b"D", b"a.txt", 0))
+
+    def test_hash_suffix(self):
+        digest = bytes(range(32))
+        for name in (b"a.txt", with_range(b"a.txt", 4, 10), with_codec(with_range(b"a.txt", 4, 10), b"z", 10)):
+            self.assertEqual(split_hash(with_hash(name, b"s", digest)), (name, (b"s", digest)))
+            self.assertEqual(split_hash(name), (name, None))
+        name, _ = split_hash(with_hash(with_codec(b"a.txt", b"z", 10), b"b"))
+        self.assertEqual(split_codec(name), (b"a.txt", (b"z", 10)))
+
+    def test_truncated_payload(self):
+        out = io.BytesIO()
+        send_frame(out.write, b"bekir", b"P", b"a", Source.of_bytes(b"0123456789"))
+        recv = io.BytesIO(out.getvalue()[:-3]).read
+        head = read_head(recv)
+        with self.assertRaises(ConnectionError):
+            PayloadReader(recv, head.length).read_all()
+
+    def test_announced_length_enforced(self):
+        with self.assertRaises(IOError):
+            send_frame(io.BytesIO().write, b"bekir", b"U", b"a", Source(3, (b"toolong",)))
+
+    def test_file_streams_in_chunks(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = Path(d) / "big"
+            path.write_bytes(b"x" * (CHUNK_SIZE * 3 + 7))
+            source = file_source(path)
+            a, b = socket.socketpair()
+            with a, b:
+                t = threading.Thread(target=send_frame, args=(a.sendall, b"egemen", b"U", b"big", source))
+                t.start()
+                head = read_head(b.recv)
+                sizes = [len(c) for c in PayloadReader(b.recv, head.length)]
+                t.join()
+            self.assertEqual(sum(sizes), path.stat().st_size)
+            self.assertLessEqual(max(sizes), CHUNK_SIZE)
+
+    def test_sendfile_into_reused_buffer(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = Path(d) / "big"
+            data = bytes(range(256)) * 1000
+            path.write_bytes(data)
+            source = file_source(path, offset=100, length=200000)
+            a, b = socket.socketpair()
+            with a, b:
+                t = threading.Thread(target=send_frame, args=(a.sendall, b"egemen", b"P", b"big", source, a.sendfile))
+                t.start()
+                head = read_head(b.recv)
+                buffer = bytearray(4096)
+                out = bytearray()
+                for view in PayloadReader(b.recv, head.length, b.recv_into, buffer).views():
+                    self.assertIs(view.obj, buffer)
+                    out += view
+                t.join()
+            self.assertEqual(bytes(out), data[100:200100])
+
+    def test_mapped_source_to_several(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = Path(d) / "big"
+            data = bytes(range(256)) * 1000
+            path.write_bytes(data)
+            source = mapped_source(path)
+            outs = [io.BytesIO() for _ in range(3)]
+            threads = [threading.Thread(target=send_frame, args=(out.write, b"egemen", b"U", b"big", source))
+                       for out in outs]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            for out in outs:
+                recv = io.BytesIO(out.getvalue()).read
+                head = read_head(recv)
+                self.assertEqual(PayloadReader(recv, head.length).read_all(), data)
+            (Path(d) / "empty").touch()
+            self.assertEqual(mapped_source(Path(d) / "empty").length, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
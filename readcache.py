@@ -0,0 +1,106 @@
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+
+class ReadCache:
+    """
+    Whole stored files by (user, filename) in memory, the least recently used go once budget bytes are held.
+    Files larger than max_file are never kept, asking for one is a bypass rather than a miss. Every put, rename and delete invalidates, and a file read
+    while it was being replaced is not kept, so what the cache returns is always what is stored.
+    """
+    STATS = ".cache-stats.json"
+
+    def __init__(self, budget: int, max_file: Optional[int] = None):
+        self.budget = budget
+        self.max_file = max_file if max_file is not None else budget // 8
+        self._lock = Lock()
+        self._files: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._size = 0
+        # bumped by every invalidation, a read that saw it change is not kept
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+    def fits(self, size: int) -> bool:
+        return 0 < size <= self.max_file
+
+    def get(self, user: str, filename: str, size: Optional[int] = None) -> Optional[bytes]:
+        """
+        size: of the stored file if known, so one the cache doesn't take isn't counted as a miss.
+        """
+        with self._lock:
+            if size is not None and not self.fits(size):
+                self.bypasses += 1
+                return None
+            data = self._files.get((user, filename))
+            if data is None:
+                self.misses += 1
+                return None
+            self._files.move_to_end((user, filename))
+            self.hits += 1
+            return data
+
+    def generation(self) -> int:
+        # taken before reading a file from disk, passed to put
+        return self._generation
+
+    def put(self, user: str, filename: str, data: bytes, generation: int) -> None:
+        if not self.fits(len(data)):
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            old = self._files.pop((user, filename), None)
+            if old is not None:
+                self._size -= len(old)
+            self._files[(user, filename)] = data
+            self._size += len(data)
+            while self._size > self.budget:
+                _, dropped = self._files.popitem(last=False)
+                self._size -= len(dropped)
+                self.evictions += 1
+
+    def invalidate(self, user: str, *filenames: str) -> None:
+        with self._lock:
+            self._generation += 1
+            for filename in filenames:
+                old = self._files.pop((user, filename), None)
+                if old is not None:
+                    self._size -= len(old)
+
+    @property
+    def hit_rate(self) -> float:
+        asked = self.hits + self.misses
+        return self.hits / asked if asked else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {"files": len(self._files), "bytes": self._size, "budget": self.budget,
+                    "hits": self.hits, "misses": self.misses, "bypasses": self.bypasses, "evictions": self.evictions,
+                    "hit_rate": round(self.hit_rate, 3)}
+
+
+def save_stats(root: Path, stats: Dict[str, Dict[str, float]]) -> None:
+    """
+    Counters of a running node for `inwards`, which runs in a process of its own. Replaced atomically.
+    """
+    path = root / ReadCache.STATS
+    tmp = path.with_name(ReadCache.STATS + ".tmp")
+    try:
+        tmp.write_text(json.dumps(stats))
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def load_stats(root: Path) -> Dict[str, Dict[str, float]]:
+    try:
+        return json.loads((root / ReadCache.STATS).read_text())
+    except (OSError, ValueError):
+        return dict()
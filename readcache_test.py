@@ -0,0 +1,54 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from readcache import ReadCache, load_stats, save_stats
+
+
+class ReadCacheTest(unittest.TestCase):
+    def test_least_recently_used_go_first(self):
+        cache = ReadCache(budget=10, max_file=5)
+        for name in "abc":
+            cache.put("u", name, name.encode() * 4, cache.generation())
+        # a and b don't fit together with c, a was used longest ago
+        self.assertIsNone(cache.get("u", "a"))
+        self.assertEqual(cache.get("u", "b"), b"bbbb")
+        cache.put("u", "d", b"dddd", cache.generation())
+        self.assertIsNone(cache.get("u", "c"))
+        self.assertEqual(cache.get("u", "b"), b"bbbb")
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (2, 2, 2))
+
+    def test_large_files_bypass(self):
+        cache = ReadCache(budget=100, max_file=5)
+        cache.put("u", "big", b"x" * 6, cache.generation())
+        self.assertIsNone(cache.get("u", "big", 6))
+        self.assertFalse(cache.fits(0))
+        disabled = ReadCache(budget=0)
+        self.assertFalse(disabled.fits(1))
+        self.assertIsNone(disabled.get("u", "small", 1))
+        # files the cache never takes don't drag its hit rate down
+        cache.put("u", "small", b"x" * 5, cache.generation())
+        self.assertEqual(cache.get("u", "small", 5), b"xxxxx")
+        self.assertEqual((cache.hits, cache.misses, cache.bypasses, cache.hit_rate), (1, 0, 1, 1.0))
+        self.assertEqual((disabled.misses, disabled.stats()["bypasses"]), (0, 1))
+
+    def test_invalidation(self):
+        cache = ReadCache(budget=100)
+        cache.put("u", "a", b"old", cache.generation())
+        generation = cache.generation()
+        cache.invalidate("u", "a")
+        self.assertIsNone(cache.get("u", "a"))
+        # read before the change, not kept
+        cache.put("u", "a", b"old", generation)
+        self.assertIsNone(cache.get("u", "a"))
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+    def test_stats_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            self.assertEqual(load_stats(Path(d)), {})
+            save_stats(Path(d), {"read": ReadCache(100).stats()})
+            self.assertEqual(load_stats(Path(d))["read"]["budget"], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Upload of one file to several agents at once.
+
+The file is mapped once and every replica sends views of the same pages, agents taking the same codec share
+one compressed payload. Each replica goes as an upload tagged with a request id, which the agent acknowledges
+with V(length, length) once the file is stored and matched its hash, or answers with F.
+The upload has succeeded when quorum agents acknowledged, the others keep going in the background.
+An agent's status is 0 or the ErrorType value of its failure like in batches, NO_REPLY if it never answered.
+"""
+import time
+from threading import Condition
+from typing import Dict, List, Optional
+
+from batch import NO_REPLY
+from containers import Agent, ErrorType
+
+
+class Replication:
+    def __init__(self, filename: str, length: int, agents: List[Agent], quorum: int):
+        self.filename = filename
+        self.length = length
+        self.agents = agents
+        self.quorum = quorum
+        self.statuses: Dict[Agent, int] = dict()
+        self.seconds: Dict[Agent, float] = dict()
+        self.started = time.monotonic()
+        self._cond = Condition()
+
+    def finish(self, agent: Agent, status: int) -> None:
+        with self._cond:
+            self.statuses[agent] = status
+            self.seconds[agent] = time.monotonic() - self.started
+            self._cond.notify_all()
+
+    @property
+    def acknowledged(self) -> int:
+        with self._cond:
+            return sum(status == 0 for status in self.statuses.values())
+
+    @property
+    def failed(self) -> int:
+        with self._cond:
+            return sum(status != 0 for status in self.statuses.values())
+
+    def _decided(self) -> bool:
+        # under the lock, the quorum is reached or can't be anymore
+        return self.acknowledged >= self.quorum or len(self.agents) - self.failed < self.quorum
+
+    def wait_quorum(self, timeout: Optional[float] = None) -> bool:
+        """
+        True once quorum agents acknowledged, False when too many failed or at the deadline.
+        """
+        with self._cond:
+            self._cond.wait_for(self._decided, timeout)
+            return self.acknowledged >= self.quorum
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Blocks until every agent acknowledged or failed.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self.statuses) == len(self.agents), timeout)
+
+    @property
+    def quorum_seconds(self) -> Optional[float]:
+        """
+        Seconds until the quorum was reached, None if it was not
+        """
+        with self._cond:
+            done = sorted(self.seconds[agent] for agent, status in self.statuses.items() if status == 0)
+        return done[self.quorum - 1] if len(done) >= self.quorum else None
+
+    def results(self) -> Dict[str, int]:
+        """
+        agent name -> status, agents still going are left out
+        """
+        with self._cond:
+            return {agent.name.decode("ascii", "replace"): status for agent, status in self.statuses.items()}
+
+    def report(self) -> str:
+        lines = [f"{self.filename}: {self.acknowledged} of {len(self.agents)} stored, quorum {self.quorum}"]
+        with self._cond:
+            for agent in self.agents:
+                status = self.statuses.get(agent)
+                if status is None:
+                    state = "sending"
+                elif status == 0:
+                    state = f"stored in {self.seconds[agent]:.2f} s"
+                else:
+                    state = "no reply" if status == NO_REPLY else ErrorType(status).name
+                lines.append(f"  {agent.name.decode('ascii', 'replace')}: {state}")
+        return "\n".join(lines)
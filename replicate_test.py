@@ -0,0 +1,34 @@
+import unittest
+from threading import Thread
+
+from batch import NO_REPLY
+from containers import Agent, ErrorType
+from replicate import Replication
+
+AGENTS = [Agent(name=name, ip="127.0.0.1") for name in (b"a", b"b", b"c")]
+
+
+class Quorum(unittest.TestCase):
+    def test_reached_before_the_slowest(self):
+        replication = Replication("f", 10, AGENTS, 2)
+        replication.finish(AGENTS[0], 0)
+        self.assertFalse(replication.wait_quorum(0.01))
+        Thread(target=replication.finish, args=(AGENTS[2], 0)).start()
+        self.assertTrue(replication.wait_quorum(5))
+        self.assertIsNotNone(replication.quorum_seconds)
+        self.assertFalse(replication.wait(0.01))
+        replication.finish(AGENTS[1], ErrorType.PUT.value)
+        self.assertTrue(replication.wait(0))
+        self.assertEqual(replication.results(), {"a": 0, "b": ErrorType.PUT.value, "c": 0})
+
+    def test_lost_without_waiting_for_the_rest(self):
+        replication = Replication("f", 10, AGENTS, 2)
+        replication.finish(AGENTS[0], NO_REPLY)
+        replication.finish(AGENTS[1], ErrorType.PUT.value)
+        self.assertFalse(replication.wait_quorum())
+        self.assertIsNone(replication.quorum_seconds)
+        self.assertIn("no reply", replication.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+"""
+Outgoing frames in two classes. Control frames (status, overviews, failures, requests) go at once over
+a peer's connection. Bulk frames, file payloads and the renames and deletes that have to stay behind them,
+go over a second connection to the peer so a long payload never holds a control frame up.
+That connection is opened by whoever can reach the other, before it sends or asks for bulk frames,
+and starts with a heartbeat to say whose it is. Both sides send bulk frames over it.
+
+Bulk payloads are paced in QUANTUM pieces by token buckets, one per peer and one for all of them.
+Waiting pieces take turns round robin across peers, and across transfers to the same peer.
+"""
+import time
+from collections import OrderedDict, deque
+from threading import Condition
+from typing import Deque, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+from protocol import FileChunks, SendFile, Source
+
+BULK = (b"U", b"P", b"T", b"B", b"Y", b"R", b"X")
+# requests answered with bulk frames
+ASKS_BULK = (b"D", b"B")
+QUANTUM = 64 * 1024
+
+
+def is_bulk(command: bytes) -> bool:
+    return command in BULK
+
+
+def asks_bulk(command: bytes) -> bool:
+    return command in ASKS_BULK
+
+
+class TokenBucket:
+    """
+    rate bytes a second, up to burst saved up. A take larger than burst waits for a full bucket and leaves it empty.
+    """
+    def __init__(self, rate: float, burst: Optional[float] = None, now: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate / 4, QUANTUM)
+        self.tokens = self.burst
+        self.stamp = time.monotonic() if now is None else now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, n: int, now: float) -> float:
+        # seconds until n can be taken, 0 if now
+        self._refill(now)
+        missing = min(n, self.burst) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, n: int, now: float) -> None:
+        self._refill(now)
+        self.tokens -= min(n, self.burst)
+
+
+class Scheduler:
+    """
+    rate, peer_rate: bytes a second in total and to each peer, 0 for no limit
+    """
+    def __init__(self, rate: float = 0, peer_rate: float = 0):
+        self.rate = rate
+        self.peer_rate = peer_rate
+        self._total = TokenBucket(rate) if rate > 0 else None
+        self._peers: Dict[Hashable, TokenBucket] = dict()
+        self._cond = Condition()
+        # peers with pieces waiting, in turn order, each with its pieces in turn order
+        self._waiting: "OrderedDict[Hashable, Deque[Tuple[object, int]]]" = OrderedDict()
+
+    @property
+    def limited(self) -> bool:
+        return self.rate > 0 or self.peer_rate > 0
+
+    def waiting(self) -> int:
+        # pieces waiting for their turn
+        with self._cond:
+            return sum(len(pieces) for pieces in self._waiting.values())
+
+    def _buckets(self, key: Hashable) -> List[TokenBucket]:
+        buckets = [self._total] if self._total is not None else []
+        if self.peer_rate > 0:
+            if key not in self._peers:
+                self._peers[key] = TokenBucket(self.peer_rate)
+            buckets.append(self._peers[key])
+        return buckets
+
+    def _next(self, now: float) -> Tuple[Optional[object], float]:
+        """
+        (the first piece in turn that may go now, None if none) and the seconds until one may go
+        """
+        soonest = float("inf")
+        for key, pieces in self._waiting.items():
+            ticket, n = pieces[0]
+            delay = max((bucket.delay(n, now) for bucket in self._buckets(key)), default=0.0)
+            if delay == 0:
+                return ticket, 0.0
+            soonest = min(soonest, delay)
+        return None, soonest
+
+    def acquire(self, key: Hashable, n: int) -> None:
+        """
+        Blocks until n bytes may go to key.
+        """
+        if not self.limited:
+            return
+        ticket = object()
+        with self._cond:
+            self._waiting.setdefault(key, deque()).append((ticket, n))
+            while True:
+                now = time.monotonic()
+                chosen, delay = self._next(now)
+                if chosen is ticket:
+                    break
+                # whoever may go is running or wakes from its own timeout, and its grant wakes everyone,
+                # so only a wait for the buckets needs a timeout
+                self._cond.wait(delay if chosen is None else None)
+            for bucket in self._buckets(key):
+                bucket.take(n, now)
+            pieces = self._waiting[key]
+            pieces.popleft()
+            if pieces:
+                # a transfer waits with one piece at a time, its next one queues up behind the others
+                self._waiting.move_to_end(key)
+            else:
+                del self._waiting[key]
+            self._cond.notify_all()
+
+    def paced(self, key: Hashable, source: Source) -> Source:
+        """
+        source with every piece of it waiting for its turn, files still go with sendfile.
+        """
+        if not self.limited or source.length == 0:
+            return source
+        if isinstance(source.chunks, FileChunks):
+            return Source(source.length, PacedFile(source.chunks, self, key))
+        return Source(source.length, PacedChunks(source.chunks, self, key))
+
+
+class PacedChunks:
+    # re-iterable if chunks is
+    def __init__(self, chunks: Iterable[bytes], scheduler: Scheduler, key: Hashable):
+        self.chunks = chunks
+        self.scheduler = scheduler
+        self.key = key
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self.chunks:
+            view = memoryview(chunk)
+            for start in range(0, len(view), QUANTUM):
+                piece = view[start:start + QUANTUM]
+                self.scheduler.acquire(self.key, len(piece))
+                yield piece
+
+
+class PacedFile(FileChunks):
+    def __init__(self, chunks: FileChunks, scheduler: Scheduler, key: Hashable):
+        super().__init__(chunks.path, chunks.length, chunks.offset)
+        self.scheduler = scheduler
+        self.key = key
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in super().__iter__():
+            self.scheduler.acquire(self.key, len(chunk))
+            yield chunk
+
+    def send_with(self, sendfile: SendFile) -> None:
+        with self.path.open("rb") as f:
+            offset, remaining = self.offset, self.length
+            while remaining > 0:
+                n = min(QUANTUM, remaining)
+                self.scheduler.acquire(self.key, n)
+                if sendfile(f, offset, n) != n:
+                    raise IOError(f"{self.path} shrank while being sent")
+                offset += n
+                remaining -= n
@@ -0,0 +1,85 @@
+import io
+from collections import deque
+import threading
+import time
+import unittest
+from unittest import mock
+
+from protocol import Source
+from scheduler import QUANTUM, Scheduler, TokenBucket, is_bulk
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_delay_and_take(self):
+        bucket = TokenBucket(rate=1000, burst=500, now=0)
+        self.assertEqual(bucket.delay(500, 0), 0)
+        bucket.take(500, 0)
+        self.assertAlmostEqual(bucket.delay(100, 0), 0.1)
+        self.assertEqual(bucket.delay(100, 0.1), 0)
+        # more than a burst waits for a full bucket
+        self.assertAlmostEqual(bucket.delay(5000, 0.1), 0.4)
+
+
+class SchedulerTest(unittest.TestCase):
+    def test_unlimited_passes_through(self):
+        scheduler = Scheduler()
+        source = Source.of_bytes(b"x")
+        self.assertIs(scheduler.paced("a", source), source)
+        self.assertTrue(is_bulk(b"U"))
+        self.assertFalse(is_bulk(b"O"))
+
+    def test_rate_is_kept(self):
+        scheduler = Scheduler(peer_rate=4 * QUANTUM)
+        source = scheduler.paced("a", Source.of_bytes(b"x" * 3 * QUANTUM))
+        out = io.BytesIO()
+        start = time.monotonic()
+        for chunk in source.chunks:
+            out.write(chunk)
+        # the first quantum is in the bucket, two more at four a second
+        self.assertGreater(time.monotonic() - start, 0.4)
+        self.assertEqual(len(out.getvalue()), 3 * QUANTUM)
+
+    def test_peers_take_turns(self):
+        scheduler = Scheduler(rate=40 * QUANTUM)
+        # an empty bucket, so everyone waits from the start
+        scheduler.acquire("z", 10 * QUANTUM)
+        order, lock = list(), threading.Lock()
+
+        def send(key):
+            for _ in range(4):
+                scheduler.acquire(key, QUANTUM)
+                with lock:
+                    order.append(key)
+        threads = [threading.Thread(target=send, args=(key,)) for key in "abc"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(0, 12, 3):
+            self.assertEqual(sorted(order[i:i + 3]), ["a", "b", "c"], order)
+
+    def test_waiting_for_a_turn_does_not_poll(self):
+        scheduler = Scheduler(rate=1e12)
+        # a piece in turn whose sender is busy elsewhere, the buckets are full
+        held = (object(), QUANTUM)
+        scheduler._waiting["x"] = deque([held])
+
+        def granted():
+            with scheduler._cond:
+                scheduler._waiting.pop("x", None)
+                scheduler._cond.notify_all()
+        with mock.patch.object(scheduler._cond, "wait", wraps=scheduler._cond.wait) as wait:
+            thread = threading.Thread(target=scheduler.acquire, args=("y", QUANTUM), daemon=True)
+            thread.start()
+            self.addCleanup(granted)
+            time.sleep(0.1)
+            # it sleeps until the piece in turn is granted instead of checking again and again
+            self.assertEqual(wait.call_count, 1)
+            granted()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(scheduler.waiting(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
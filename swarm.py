@@ -0,0 +1,228 @@
+"""
+Multi-source download of one file from every agent holding a copy.
+
+The file is split into ranges aligned to the delta block size, so each range can be checked
+against the block signatures the holders agree on. Every holder keeps a few ranges in flight,
+faster holders get more. Ranges stuck on a slow holder are asked again from an idle one,
+whichever copy arrives first and verifies is kept.
+"""
+import os
+import sys
+import time
+import zlib
+from pathlib import Path
+from threading import Condition
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from containers import Agent
+from delta import Signatures, reblock, strong_hash
+
+# fetch(agent, offset, length) -> sent
+Fetch = Callable[[Agent, int, int], bool]
+
+
+class Peer:
+    def __init__(self, agent: Agent):
+        self.agent = agent
+        self.in_flight: Dict[int, float] = dict()  # range index -> asked at
+        self.bytes = 0
+        self.seconds = 0.0
+        self.failures = 0
+
+    @property
+    def rate(self) -> float:
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+
+class Swarm:
+    # filename -> running swarm, for Backend._inc_payload
+    active: Dict[str, "Swarm"] = dict()
+
+    MAX_DEPTH = 4
+    MAX_FAILURES = 3
+
+    def __init__(self, filename: str, path: Path, sigs: Signatures, agents: List[Agent], fetch: Fetch,
+                 range_size: int = 4 * 1024 * 1024):
+        self.filename = filename
+        self.path = path
+        # not .part, an interrupted download of the same file keeps its progress there, see partial.py
+        self.part = path.with_name(path.name + ".swarm.part")
+        self.sigs = sigs
+        self.fetch = fetch
+        blocks_per_range = max(1, range_size // sigs.block_size)
+        self.range_size = blocks_per_range * sigs.block_size
+        self.ranges = (sigs.size + self.range_size - 1) // self.range_size
+        self.pending: List[int] = list(range(self.ranges))
+        self.done: Set[int] = set()
+        self.peers: Dict[Agent, Peer] = {agent: Peer(agent) for agent in agents}
+        self.cond = Condition()
+        self.failed = False
+        self.fd = os.open(self.part, os.O_RDWR | os.O_CREAT)
+        os.ftruncate(self.fd, sigs.size)
+
+    def _range(self, index: int) -> Tuple[int, int]:
+        offset = index * self.range_size
+        return offset, min(self.range_size, self.sigs.size - offset)
+
+    def _depth(self, peer: Peer) -> int:
+        # holders get in-flight ranges in proportion to their measured rate
+        best = max((p.rate for p in self.peers.values()), default=0.0)
+        if best == 0 or peer.rate == 0:
+            return 2
+        return max(1, round(self.MAX_DEPTH * peer.rate / best))
+
+    def _assign(self) -> List[Tuple[Agent, int]]:
+        """
+        Called with cond held, picks work; the requests are sent after releasing it.
+        """
+        asks = list()
+        for peer in sorted(self.peers.values(), key=lambda p: -p.rate):
+            while self.pending and len(peer.in_flight) < self._depth(peer):
+                index = self.pending.pop(0)
+                peer.in_flight[index] = time.monotonic()
+                asks.append((peer.agent, index))
+        return asks
+
+    def _send(self, asks: List[Tuple[Agent, int]]) -> None:
+        for agent, index in asks:
+            if not self.fetch(agent, *self._range(index)):
+                self._give_back(agent, index, failed=True)
+
+    def _give_back(self, agent: Agent, index: int, failed: bool, corrupt: bool = False) -> None:
+        with self.cond:
+            peer = self.peers.get(agent)
+            if peer is not None:
+                peer.in_flight.pop(index, None)
+                if failed:
+                    peer.failures += 1
+                    # a holder sending bad blocks has another version, not a bad connection
+                    if peer.failures >= self.MAX_FAILURES or corrupt:
+                        print(f"Swarm drops {agent}", file=sys.stderr)
+                        for other in peer.in_flight:
+                            if other not in self.done and other not in self.pending:
+                                self.pending.append(other)
+                        del self.peers[agent]
+            if index not in self.done and index not in self.pending and \
+                    not any(index in p.in_flight for p in self.peers.values()):
+                self.pending.insert(0, index)
+            if not self.peers:
+                self.failed = True
+            asks = self._assign()
+            self.cond.notify_all()
+        self._send(asks)
+
+    def receive(self, agent: Agent, offset: int, chunks: Iterable[bytes]) -> None:
+        """
+        A ranged payload from agent, verified block by block while it is written.
+        """
+        index = offset // self.range_size
+        with self.cond:
+            peer = self.peers.get(agent)
+            asked = peer.in_flight.get(index) if peer is not None else None
+            duplicate = index in self.done
+        if asked is None or duplicate or offset != self._range(index)[0]:
+            for _ in chunks:
+                pass
+            if peer is not None and duplicate:
+                self._give_back(agent, index, failed=False)
+            return
+        block = offset // self.sigs.block_size
+        position = offset
+        corrupt = False
+        try:
+            for data in reblock(chunks, self.sigs.block_size):
+                weak, strong = self.sigs.blocks[block]
+                if zlib.adler32(data) != weak or strong_hash(data) != strong:
+                    corrupt = True
+                    raise ValueError(f"block {block} from {agent} does not match")
+                os.pwrite(self.fd, data, position)
+                position += len(data)
+                block += 1
+            if position - offset != self._range(index)[1]:
+                raise ValueError(f"range {index} from {agent} is {position - offset} bytes")
+        except (ValueError, IndexError, OSError, ConnectionError) as e:
+            print(f"Swarm range failed: {e}", file=sys.stderr)
+            for _ in chunks:
+                pass
+            self._give_back(agent, index, failed=True, corrupt=corrupt)
+            return
+        with self.cond:
+            peer.bytes += position - offset
+            peer.seconds += time.monotonic() - asked
+            peer.in_flight.pop(index, None)
+            self.done.add(index)
+            for other in self.peers.values():
+                other.in_flight.pop(index, None)
+            asks = self._assign()
+            self.cond.notify_all()
+        self._send(asks)
+
+    def _steal(self) -> None:
+        """
+        Nothing pending but a range is late on a slow holder: ask an idle holder too.
+        """
+        with self.cond:
+            if self.pending:
+                return
+            now = time.monotonic()
+            idle = [p for p in self.peers.values() if not p.in_flight]
+            if not idle:
+                return
+            best = max([p.rate for p in self.peers.values()] + [1.0])
+            expected = max(2.0, 3 * self.range_size / best)
+            asks = list()
+            for peer in self.peers.values():
+                for index, asked in list(peer.in_flight.items()):
+                    if idle and now - asked > expected:
+                        helper = max(idle, key=lambda p: p.rate)
+                        idle.remove(helper)
+                        helper.in_flight[index] = now
+                        asks.append((helper.agent, index))
+        self._send(asks)
+
+    def run(self, timeout: float) -> bool:
+        Swarm.active[self.filename] = self
+        try:
+            with self.cond:
+                asks = self._assign()
+            self._send(asks)
+            deadline = time.monotonic() + timeout
+            with self.cond:
+                while len(self.done) < self.ranges and not self.failed and time.monotonic() < deadline:
+                    self.cond.wait(0.5)
+                    self.cond.release()
+                    try:
+                        self._steal()
+                    finally:
+                        self.cond.acquire()
+                complete = len(self.done) == self.ranges
+        finally:
+            Swarm.active.pop(self.filename, None)
+            os.fsync(self.fd)
+            os.close(self.fd)
+        if complete:
+            os.replace(self.part, self.path)
+        else:
+            # ranges are not checkpointed, the next swarm starts over
+            self.part.unlink()
+        return complete
+
+    def report(self) -> str:
+        lines = [f"{len(self.done)}/{self.ranges} ranges of {self.range_size} B"]
+        for peer in self.peers.values():
+            lines.append(f"  {peer.agent}: {peer.bytes} B at {peer.rate / 1e6:.2f} MB/s, {peer.failures} failures")
+        return "\n".join(lines)
+
+
+def agree_on(signatures: Dict[Agent, bytes]) -> Tuple[Optional[Signatures], List[Agent]]:
+    """
+    The signatures most holders sent and those holders. Holders of a different version are left out.
+    """
+    votes: Dict[bytes, List[Agent]] = dict()
+    for agent, data in signatures.items():
+        if data:
+            votes.setdefault(data, list()).append(agent)
+    if not votes:
+        return None, list()
+    data, agents = max(votes.items(), key=lambda item: len(item[1]))
+    return Signatures.from_bytes(data), agents
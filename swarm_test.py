@@ -0,0 +1,79 @@
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from threading import Thread
+
+from containers import Agent
+from delta import signatures_of
+from swarm import Swarm, agree_on
+
+
+class SwarmTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.dir.name) / "out.bin"
+        self.data = os.urandom(300 * 1024 + 123)
+        self.sigs = signatures_of([self.data], len(self.data))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _run(self, contents, delays=None):
+        delays = delays or dict()
+        agents = list(contents)
+        swarm = None
+
+        def fetch(agent, offset, length):
+            def reply():
+                time.sleep(delays.get(agent, 0))
+                data = contents[agent][offset:offset + length]
+                swarm.receive(agent, offset, [data[i:i + 8192] for i in range(0, len(data), 8192)])
+            Thread(target=reply, daemon=True).start()
+            return True
+        swarm = Swarm("f", self.path, self.sigs, agents, fetch, range_size=32 * 1024)
+        return swarm, swarm.run(timeout=20)
+
+    def test_parallel_holders(self):
+        a, b, c = (Agent(name, "127.0.0.1") for name in (b"a", b"b", b"c"))
+        swarm, complete = self._run({a: self.data, b: self.data, c: self.data})
+        self.assertTrue(complete)
+        self.assertEqual(self.path.read_bytes(), self.data)
+        self.assertTrue(all(peer.bytes > 0 for peer in swarm.peers.values()))
+
+    def test_corrupt_holder_is_dropped(self):
+        good, bad = Agent(b"good", "127.0.0.1"), Agent(b"bad", "127.0.0.2")
+        corrupt = bytes(x ^ 1 for x in self.data)
+        swarm, complete = self._run({good: self.data, bad: corrupt})
+        self.assertTrue(complete)
+        self.assertEqual(self.path.read_bytes(), self.data)
+        self.assertTrue(bad not in swarm.peers or swarm.peers[bad].bytes == 0)
+
+    def test_slow_holder_gets_less(self):
+        fast, slow = Agent(b"fast", "127.0.0.1"), Agent(b"slow", "127.0.0.2")
+        swarm, complete = self._run({fast: self.data, slow: self.data}, delays={slow: 0.3})
+        self.assertTrue(complete)
+        self.assertEqual(self.path.read_bytes(), self.data)
+        self.assertGreater(swarm.peers[fast].bytes, swarm.peers[slow].bytes)
+
+    def test_interrupted_download_is_kept(self):
+        part = self.path.with_name(self.path.name + ".part")
+        part.write_bytes(b"progress of a resumable download")
+        good, bad = Agent(b"good", "127.0.0.1"), Agent(b"bad", "127.0.0.2")
+        swarm, complete = self._run({bad: bytes(x ^ 1 for x in self.data)})
+        self.assertFalse(complete)
+        swarm, complete = self._run({good: self.data})
+        self.assertTrue(complete)
+        self.assertEqual(part.read_bytes(), b"progress of a resumable download")
+
+    def test_majority_signatures(self):
+        a, b, c = (Agent(name, "127.0.0.1") for name in (b"a", b"b", b"c"))
+        other = signatures_of([b"other"], 5).to_bytes()
+        sigs, agents = agree_on({a: self.sigs.to_bytes(), b: other, c: self.sigs.to_bytes()})
+        self.assertEqual(sigs, self.sigs)
+        self.assertEqual(sorted(agents), [a, c])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+One-way sync of a local directory to what an agent stores for us.
+
+The local manifest is name -> (size, mtime, sha256) of the files directly in the directory.
+Hashes come from the node's HashCache and are only computed again for files whose size or mtime changed,
+so comparing an unchanged tree costs a stat per file. The agent's side is its overview asked with MANIFEST_ASK.
+"""
+import os
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from containers import FileInfo
+from hashcache import HashCache
+
+
+class LocalFile(NamedTuple):
+    size: int
+    mtime: float
+    sha256: str
+
+
+class SyncPlan(NamedTuple):
+    add: List[str]
+    update: List[str]
+    delete: List[str]
+
+    @property
+    def empty(self) -> bool:
+        return not (self.add or self.update or self.delete)
+
+
+def local_manifest(directory: Path, hashes: HashCache) -> Dict[str, LocalFile]:
+    manifest = dict()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            digest = hashes.digest(Path(entry.path))
+            if digest is not None:
+                manifest[entry.name] = LocalFile(st.st_size, st.st_mtime, digest.hex())
+    return manifest
+
+
+def plan_sync(local: Dict[str, LocalFile], remote: List[FileInfo], delete: bool = True) -> SyncPlan:
+    """
+    What to send so remote matches local. A remote file without a hash is compared by size only.
+    delete: also remove remote files that are not in local
+    """
+    remote_by_name = {info.name: info for info in remote}
+    add, update = list(), list()
+    for name, mine in sorted(local.items()):
+        theirs: Optional[FileInfo] = remote_by_name.get(name)
+        if theirs is None:
+            add.append(name)
+        elif theirs.length_Byte != mine.size or (theirs.sha256 is not None and theirs.sha256 != mine.sha256):
+            update.append(name)
+    removed = sorted(set(remote_by_name) - set(local)) if delete else list()
+    return SyncPlan(add, update, removed)
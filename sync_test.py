@@ -0,0 +1,51 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from containers import FileInfo
+from hashcache import HashCache
+from sync import local_manifest, plan_sync
+
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.hashes = HashCache(Path(self.dir.name))
+
+    def tearDown(self):
+        self.hashes.close()
+        self.dir.cleanup()
+
+    def test_manifest_cached(self):
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            (d / "a.txt").write_bytes(b"hello")
+            first = local_manifest(d, self.hashes)
+            self.assertEqual(set(first), {"a.txt"})
+            self.assertEqual(first["a.txt"].sha256, hashlib.sha256(b"hello").hexdigest())
+            # same size and mtime, the cached hash is trusted
+            st = (d / "a.txt").stat()
+            (d / "a.txt").write_bytes(b"jello")
+            os.utime(d / "a.txt", ns=(st.st_atime_ns, st.st_mtime_ns))
+            self.assertEqual(local_manifest(d, self.hashes)["a.txt"].sha256, first["a.txt"].sha256)
+            self.assertEqual((self.hashes.hits, self.hashes.misses), (1, 1))
+            os.utime(d / "a.txt", (st.st_atime, st.st_mtime + 10))
+            self.assertNotEqual(local_manifest(d, self.hashes)["a.txt"].sha256, first["a.txt"].sha256)
+
+    def test_plan(self):
+        with tempfile.TemporaryDirectory() as d:
+            d = Path(d)
+            for name, data in (("same", b"1"), ("changed", b"22"), ("new", b"3"), ("unhashed", b"4")):
+                (d / name).write_bytes(data)
+            local = local_manifest(d, self.hashes)
+            remote = [FileInfo("same", 1, local["same"].sha256), FileInfo("changed", 2, "00" * 32),
+                      FileInfo("unhashed", 1), FileInfo("gone", 5)]
+            plan = plan_sync(local, remote)
+            self.assertEqual((plan.add, plan.update, plan.delete), (["new"], ["changed"], ["gone"]))
+            self.assertEqual(plan_sync(local, remote, delete=False).delete, [])
+
+
+if __name__ == '__main__':
+    unittest.main()